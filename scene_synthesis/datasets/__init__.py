@@ -1,7 +1,7 @@
 
 from .base import THREED_FRONT_BEDROOM_FURNITURE, \
     THREED_FRONT_LIVINGROOM_FURNITURE, THREED_FRONT_LIBRARY_FURNITURE
-from .common import BaseDataset
+from .common import BaseDataset, LengthBucketBatchSampler
 from .threed_front import ThreedFront, CachedThreedFront
 from .threed_front_dataset import dataset_encoding_factory
 
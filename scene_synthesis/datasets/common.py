@@ -3,7 +3,7 @@ from collections import Counter
 
 import numpy as np
 import torch
-from torch.utils.data import IterableDataset, Dataset
+from torch.utils.data import IterableDataset, Dataset, Sampler
 
 
 class InfiniteDataset(IterableDataset):
@@ -37,6 +37,45 @@ class InfiniteDataset(IterableDataset):
                 yield self.dataset[i]
 
 
+class LengthBucketBatchSampler(Sampler):
+    """Batch sampler that groups scenes with similar numbers of objects, so
+    that padding every batch to its longest scene wastes little. Every epoch
+    the shuffled scenes are split into pools of pool_size batches, sorted by
+    length within a pool and cut into batches, which are shuffled again."""
+    def __init__(self, lengths, batch_size, pool_size=50, shuffle=True, drop_last=False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        N = len(self.lengths)
+        indices = np.random.permutation(N) if self.shuffle else np.arange(N)
+        pool = self.batch_size * self.pool_size
+        batches = []
+        for start in range(0, N, pool):
+            chunk = indices[start:start + pool]
+            chunk = chunk[np.argsort(self.lengths[chunk], kind="stable")]
+            batches.extend(
+                chunk[i:i + self.batch_size] for i in range(0, len(chunk), self.batch_size)
+            )
+        if self.drop_last:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        for b in batches:
+            yield b.tolist()
+
+    def __len__(self):
+        N = len(self.lengths)
+        pool = self.batch_size * self.pool_size
+        if self.drop_last:
+            # only the last pool may end with a partial batch
+            return (N // pool) * self.pool_size + (N % pool) // self.batch_size
+        return (N // pool) * self.pool_size + (N % pool + self.batch_size - 1) // self.batch_size
+
+
 class BaseDataset(Dataset):
     """Implements the interface for all datasets that consist of scenes."""
     def __init__(self, scenes):
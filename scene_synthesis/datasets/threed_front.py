@@ -50,6 +50,10 @@ class ThreedFront(BaseDataset):
                 len(self.scenes), self.n_object_types
         )
 
+    def object_counts(self):
+        """The number of objects of every scene, without encoding the scenes."""
+        return [len(s.bboxes) for s in self.scenes]
+
     @property
     def bbox(self):
         """The bbox for the entire dataset is simply computed based on the
@@ -376,6 +380,14 @@ class CachedThreedFront(ThreedFront):
     def __len__(self):
         return len(self._path_to_rooms)
 
+    def object_counts(self):
+        # only the class labels of every boxes.npz are read
+        counts = []
+        for path in self._path_to_rooms:
+            with np.load(path) as D:
+                counts.append(D["class_labels"].shape[0])
+        return counts
+
     def __str__(self):
         return "Dataset contains {} scenes with {} discrete types".format(
                 len(self), self.n_object_types
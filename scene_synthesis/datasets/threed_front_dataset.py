@@ -61,6 +61,10 @@ class DatasetDecoratorBase(Dataset):
     def post_process(self, s):
         return self._dataset.post_process(s)
 
+    def object_counts(self):
+        """The number of objects of every scene, e.g. for LengthBucketBatchSampler."""
+        return self._dataset.object_counts()
+
 
 class BoxOrderedDataset(DatasetDecoratorBase):
     def __init__(self, dataset, box_ordering=None):
@@ -934,6 +938,21 @@ class Diffusion(DatasetDecoratorBase):
         samples = list(filter(lambda x: x is not None, samples))
         return dataloader.default_collate(samples)
 
+    def collate_fn_to_batch_length(self, samples):
+        ''' Collater that pads the object attributes of each batch to its longest
+            scene only, instead of max_length (see LengthBucketBatchSampler).
+        Args:
+            samples: samples
+        '''
+        batch = self.collate_fn(samples)
+        num_points = max(int(batch["length"].max()), 1)
+        for k, v in batch.items():
+            if k in ["room_layout", "length", "relations", "description", "desc_emb"]:
+                continue
+            if torch.is_tensor(v) and v.dim() >= 2 and v.shape[1] == self._dataset.max_length:
+                batch[k] = v[:, :num_points]
+        return batch
+
     @property
     def bbox_dims(self):
         return 7
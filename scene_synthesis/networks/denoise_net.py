@@ -9,6 +9,7 @@ from tkinter.tix import Tree
 import torch
 from torch import nn, einsum
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from einops import rearrange, reduce
 from einops.layers.torch import Rearrange
@@ -34,6 +35,24 @@ def cycle(dl):
         for data in dl:
             yield data
 
+def masked_softmax(x, mask, dim):
+    """softmax of x over dim, the padded slots (mask False, broadcastable against x) get no weight"""
+    if exists(mask):
+        x = x.masked_fill(~mask, -torch.finfo(x.dtype).max)
+    return x.softmax(dim = dim)
+
+def attend(q, k, v, mask = None):
+    """
+    softmax attention of q, k, v (b h n d) over the keys valid in mask (b n), with the
+    fused F.scaled_dot_product_attention kernel when available (torch >= 2.0)
+    """
+    attn_mask = rearrange(mask, 'b j -> b 1 1 j') if exists(mask) else None
+    if hasattr(F, 'scaled_dot_product_attention'):
+        return F.scaled_dot_product_attention(q, k, v, attn_mask = attn_mask)
+    sim = einsum('b h i d, b h j d -> b h i j', q, k) * q.shape[-1] ** -0.5
+    attn = masked_softmax(sim, attn_mask, dim = -1)
+    return einsum('b h i j, b h j d -> b h i d', attn, v)
+
 # small helper modules
 
 class Residual(nn.Module):
@@ -102,25 +121,25 @@ class LayerNorm(nn.Module):
         return (x - mean) * (var + eps).rsqrt() * self.g
 
 class PreNorm(nn.Module):
-    def __init__(self, dim, fn):
+    def __init__(self, dim, fn, norm_klass = None):
         super().__init__()
         self.fn = fn
-        self.norm = LayerNorm(dim)
+        self.norm = default(norm_klass, LayerNorm)(dim)
 
-    def forward(self, x):
+    def forward(self, x, **kwargs):
         x = self.norm(x)
-        return self.fn(x)
+        return self.fn(x, **kwargs)
     
 
 class PreNormCross(nn.Module):
-    def __init__(self, dim, fn):
+    def __init__(self, dim, fn, norm_klass = None):
         super().__init__()
         self.fn = fn
-        self.norm = LayerNorm(dim)
+        self.norm = default(norm_klass, LayerNorm)(dim)
 
-    def forward(self, x, context):
+    def forward(self, x, context, **kwargs):
         x = self.norm(x)
-        return self.fn(x, context)
+        return self.fn(x, context, **kwargs)
 
 # sinusoidal positional embeds
 
@@ -218,21 +237,19 @@ class LinearAttention(nn.Module):
             LayerNorm(dim)
         )
 
-    def forward(self, x):
+    def forward(self, x, mask = None):
         b, c, n = x.shape
-        qkv = self.to_qkv(x).chunk(3, dim = 1)
-        q, k, v = map(lambda t: rearrange(t, 'b (h c) n -> b h c n', h = self.heads), qkv)
+        # one view for q, k, v: b h c n each
+        q, k, v = self.to_qkv(x).reshape(b, 3, self.heads, -1, n).unbind(dim = 1)
 
         q = q.softmax(dim = -2)
-        k = k.softmax(dim = -1)
+        k = masked_softmax(k, rearrange(mask, 'b n -> b 1 1 n') if exists(mask) else None, dim = -1)
 
-        q = q * self.scale        
+        # the scale of q applied to the (h x c x c) context instead
+        context = torch.matmul(k, v.transpose(-1, -2)) * self.scale
 
-        context = torch.einsum('b h d n, b h e n -> b h d e', k, v)
-
-        out = torch.einsum('b h d e, b h d n -> b h e n', context, q)
-        out = rearrange(out, 'b h c n -> b (h c) n', h = self.heads)
-        return self.to_out(out)
+        out = torch.matmul(context.transpose(-1, -2), q)
+        return self.to_out(out.reshape(b, -1, n))
 
 class Attention(nn.Module):
     def __init__(self, dim, heads = 4, dim_head = 32):
@@ -244,16 +261,12 @@ class Attention(nn.Module):
         self.to_qkv = nn.Conv1d(dim, hidden_dim * 3, 1, bias = False)
         self.to_out = nn.Conv1d(hidden_dim, dim, 1)
 
-    def forward(self, x):
+    def forward(self, x, mask = None):
         b, c, n = x.shape
         qkv = self.to_qkv(x).chunk(3, dim = 1)
-        q, k, v = map(lambda t: rearrange(t, 'b (h c) n -> b h c n', h = self.heads), qkv)
-
-        q = q * self.scale
+        q, k, v = map(lambda t: rearrange(t, 'b (h d) n -> b h n d', h = self.heads), qkv)
 
-        sim = einsum('b h d i, b h d j -> b h i j', q, k)
-        attn = sim.softmax(dim = -1)
-        out = einsum('b h i j, b h d j -> b h i d', attn, v)
+        out = attend(q, k, v, mask)
 
         out = rearrange(out, 'b h n d -> b (h d) n')
         return self.to_out(out)
@@ -275,26 +288,20 @@ class LinearAttentionCross(nn.Module):
             LayerNorm(dim)
         )
 
-    def forward(self, x, context): #=None):
+    def forward(self, x, context, mask = None):
         b, c, n = x.shape
 
-        q = self.to_q(x)
-        # if context is None:
-        #     context = x
-        kv = self.to_kv(context).chunk(2, dim = 1)
-        q    = rearrange(q, 'b (h c) n -> b h c n', h = self.heads)
-        k, v = map(lambda t: rearrange(t, 'b (h c) n -> b h c n', h = self.heads), kv)
+        # mask: the valid tokens of context
+        q = self.to_q(x).reshape(b, self.heads, -1, n)
+        k, v = self.to_kv(context).reshape(b, 2, self.heads, -1, context.shape[-1]).unbind(dim = 1)
 
         q = q.softmax(dim = -2)
-        k = k.softmax(dim = -1)
+        k = masked_softmax(k, rearrange(mask, 'b n -> b 1 1 n') if exists(mask) else None, dim = -1)
 
-        q = q * self.scale        
+        context = torch.matmul(k, v.transpose(-1, -2)) * self.scale
 
-        context = torch.einsum('b h d n, b h e n -> b h d e', k, v)
-
-        out = torch.einsum('b h d e, b h d n -> b h e n', context, q)
-        out = rearrange(out, 'b h c n -> b (h c) n', h = self.heads)
-        return self.to_out(out)
+        out = torch.matmul(context.transpose(-1, -2), q)
+        return self.to_out(out.reshape(b, -1, n))
 
 class AttentionCross(nn.Module):
     def __init__(self, dim, context_dim=None, heads = 4, dim_head = 32):
@@ -310,27 +317,260 @@ class AttentionCross(nn.Module):
         self.to_kv = nn.Conv1d(context_dim, hidden_dim * 2, 1, bias = False)
         self.to_out = nn.Conv1d(hidden_dim, dim, 1)
 
-    def forward(self, x, context): #=None):
+    def forward(self, x, context, mask = None):
         b, c, n = x.shape
 
-        q = self.to_q(x)
-        # if context is None:
-        #     context = x
-        kv = self.to_kv(context).chunk(2, dim = 1)
-        q    = rearrange(q, 'b (h c) n -> b h c n', h = self.heads)
-        k, v = map(lambda t: rearrange(t, 'b (h c) n -> b h c n', h = self.heads), kv)
+        # mask: the valid tokens of context
+        q = self.to_q(x).reshape(b, self.heads, -1, n)
+        k, v = self.to_kv(context).reshape(b, 2, self.heads, -1, context.shape[-1]).unbind(dim = 1)
 
         q = q.softmax(dim = -2)
-        k = k.softmax(dim = -1)
+        k = masked_softmax(k, rearrange(mask, 'b n -> b 1 1 n') if exists(mask) else None, dim = -1)
+
+        context = torch.matmul(k, v.transpose(-1, -2)) * self.scale
+
+        out = torch.matmul(context.transpose(-1, -2), q)
+        return self.to_out(out.reshape(b, -1, n))
+
+
+# channels-last building blocks: the same layers on BxNxC inputs, with nn.Linear
+# instead of the 1x1 convs, parameters named as in the blocks above
+
+class WeightStandardizedLinear(nn.Linear):
+    def forward(self, x):
+        eps = 1e-5 if x.dtype == torch.float32 else 1e-3
+
+        var, mean = torch.var_mean(self.weight, dim = 1, unbiased = False, keepdim = True)
+        normalized_weight = (self.weight - mean) * (var + eps).rsqrt()
+
+        return F.linear(x, normalized_weight, self.bias)
+
+class LayerNormLast(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.g = nn.Parameter(torch.ones(dim))
+
+    def forward(self, x):
+        eps = 1e-5 if x.dtype == torch.float32 else 1e-3
+        return F.layer_norm(x, (x.shape[-1],), self.g, None, eps)
+
+class GroupNormLast(nn.GroupNorm):
+    """nn.GroupNorm of BxNxC inputs, the statistics of a group are still taken over all the objects"""
+    def forward(self, x):
+        b, n, c = x.shape
+        x = x.reshape(b, n, self.num_groups, c // self.num_groups)
+        var, mean = torch.var_mean(x, dim = (1, 3), unbiased = False, keepdim = True)
+        x = ((x - mean) * (var + self.eps).rsqrt()).reshape(b, n, c)
+        return x * self.weight + self.bias
+
+class BlockLast(nn.Module):
+    def __init__(self, dim, dim_out, groups = 8):
+        super().__init__()
+        self.proj = WeightStandardizedLinear(dim, dim_out)
+        self.norm = GroupNormLast(groups, dim_out)
+        self.act = nn.SiLU()
+
+    forward = Block.forward
+
+class ResnetBlockLast(nn.Module):
+    def __init__(self, dim, dim_out, *, time_emb_dim = None, groups = 8):
+        super().__init__()
+        self.mlp = nn.Sequential(
+            nn.SiLU(),
+            nn.Linear(time_emb_dim, dim_out * 2)
+        ) if exists(time_emb_dim) else None
+
+        self.block1 = BlockLast(dim, dim_out, groups = groups)
+        self.block2 = BlockLast(dim_out, dim_out, groups = groups)
+        self.res_conv = nn.Linear(dim, dim_out) if dim != dim_out else nn.Identity()
+
+    def forward(self, x, time_emb = None):
+
+        scale_shift = None
+        if exists(self.mlp) and exists(time_emb):
+            time_emb = self.mlp(time_emb)
+            if len(time_emb.shape) ==2:
+                time_emb = rearrange(time_emb, 'b c -> b 1 c')
+            scale_shift = time_emb.chunk(2, dim = -1)
+
+        h = self.block1(x, scale_shift = scale_shift)
+
+        h = self.block2(h)
+
+        return h + self.res_conv(x)
+
+class LinearAttentionLast(nn.Module):
+    def __init__(self, dim, heads = 4, dim_head = 32):
+        super().__init__()
+        self.scale = dim_head ** -0.5
+        self.heads = heads
+        hidden_dim = dim_head * heads
+        self.to_qkv = nn.Linear(dim, hidden_dim * 3, bias = False)
+
+        self.to_out = nn.Sequential(
+            nn.Linear(hidden_dim, dim),
+            LayerNormLast(dim)
+        )
+
+    def forward(self, x, mask = None):
+        b, n, c = x.shape
+        q, k, v = rearrange(self.to_qkv(x), 'b n (qkv h c) -> qkv b h n c', qkv = 3, h = self.heads).unbind(dim = 0)
 
-        q = q * self.scale        
+        q = q.softmax(dim = -1)
+        k = masked_softmax(k, rearrange(mask, 'b n -> b 1 n 1') if exists(mask) else None, dim = -2)
 
-        context = torch.einsum('b h d n, b h e n -> b h d e', k, v)
+        context = torch.matmul(k.transpose(-1, -2), v) * self.scale
 
-        out = torch.einsum('b h d e, b h d n -> b h e n', context, q)
-        out = rearrange(out, 'b h c n -> b (h c) n', h = self.heads)
+        out = torch.matmul(q, context)
+        return self.to_out(out.transpose(1, 2).reshape(b, n, -1))
+
+class AttentionLast(nn.Module):
+    def __init__(self, dim, heads = 4, dim_head = 32):
+        super().__init__()
+        self.scale = dim_head ** -0.5
+        self.heads = heads
+        hidden_dim = dim_head * heads
+
+        self.to_qkv = nn.Linear(dim, hidden_dim * 3, bias = False)
+        self.to_out = nn.Linear(hidden_dim, dim)
+
+    def forward(self, x, mask = None):
+        q, k, v = rearrange(self.to_qkv(x), 'b n (qkv h d) -> qkv b h n d', qkv = 3, h = self.heads).unbind(dim = 0)
+
+        out = attend(q, k, v, mask)
+
+        out = rearrange(out, 'b h n d -> b n (h d)')
         return self.to_out(out)
 
+class LinearAttentionCrossLast(nn.Module):
+    def __init__(self, dim, context_dim=None, heads = 4, dim_head = 32):
+        super().__init__()
+        self.scale = dim_head ** -0.5
+        self.heads = heads
+        hidden_dim = dim_head * heads
+
+        if context_dim is None:
+            context_dim = dim
+        self.to_q  = nn.Linear(dim, hidden_dim, bias = False)
+        self.to_kv = nn.Linear(context_dim, hidden_dim*2, bias = False)
+
+        self.to_out = nn.Sequential(
+            nn.Linear(hidden_dim, dim),
+            LayerNormLast(dim)
+        )
+
+    def forward(self, x, context, mask = None):
+        b, n, c = x.shape
+
+        # mask: the valid tokens of context
+        q    = rearrange(self.to_q(x), 'b n (h c) -> b h n c', h = self.heads)
+        k, v = rearrange(self.to_kv(context), 'b n (kv h c) -> kv b h n c', kv = 2, h = self.heads).unbind(dim = 0)
+
+        q = q.softmax(dim = -1)
+        k = masked_softmax(k, rearrange(mask, 'b n -> b 1 n 1') if exists(mask) else None, dim = -2)
+
+        context = torch.matmul(k.transpose(-1, -2), v) * self.scale
+
+        out = torch.matmul(q, context)
+        return self.to_out(out.transpose(1, 2).reshape(b, n, -1))
+
+# fused per-attribute MLPs
+
+class GroupedProjection(nn.Module):
+    """
+    Independent projections of consecutive channel groups (in_splits[i] --> out_splits[i])
+    as one block-diagonal 1x1 conv (nn.Linear if channels_last). The off-diagonal
+    blocks stay zero: they are masked out of the forward pass during training
+    """
+    def __init__(self, in_splits, out_splits, channels_last = False):
+        super().__init__()
+        assert len(in_splits) == len(out_splits)
+        self.in_splits = list(in_splits)
+        self.out_splits = list(out_splits)
+        self.channels_last = channels_last
+        shape = (sum(out_splits), sum(in_splits)) + (() if channels_last else (1,))
+
+        self.weight = nn.Parameter(torch.empty(shape))
+        self.bias = nn.Parameter(torch.empty(shape[0]))
+        mask = torch.zeros(shape)
+        for (o0, o1), (i0, i1) in self._blocks():
+            mask[o0:o1, i0:i1] = 1.
+        self.register_buffer('mask', mask, persistent = False)
+        self.reset_parameters()
+
+    def _blocks(self):
+        out_ends = torch.tensor(self.out_splits).cumsum(0).tolist()
+        in_ends = torch.tensor(self.in_splits).cumsum(0).tolist()
+        return [((o1 - o, o1), (i1 - i, i1)) for o, o1, i, i1 in zip(self.out_splits, out_ends, self.in_splits, in_ends)]
+
+    @torch.no_grad()
+    def reset_parameters(self):
+        # every block initialized like the nn.Conv1d it replaces
+        self.weight.zero_()
+        for (o0, o1), (i0, i1) in self._blocks():
+            block = self.weight[o0:o1, i0:i1]
+            nn.init.kaiming_uniform_(block, a = math.sqrt(5))
+            bound = 1 / math.sqrt(block[0].numel())
+            nn.init.uniform_(self.bias[o0:o1], -bound, bound)
+
+    def forward(self, x):
+        weight = self.weight * self.mask if self.training else self.weight
+        if self.channels_last:
+            return F.linear(x, weight, self.bias)
+        return F.conv1d(x, weight, self.bias)
+
+def _block_diag(weights):
+    """Block-diagonal stack of the [out_i, in_i, ...] weights of consecutive groups."""
+    out = weights[0].new_zeros((sum(w.shape[0] for w in weights), sum(w.shape[1] for w in weights)) + tuple(weights[0].shape[2:]))
+    o, i = 0, 0
+    for w in weights:
+        out[o:o + w.shape[0], i:i + w.shape[1]] = w
+        o, i = o + w.shape[0], i + w.shape[1]
+    return out
+
+def fused_attribute_state_dict(state_dict, attributes, prefix = ''):
+    """
+    Convert (in place) the weights of the separate per-attribute encoder / decoder
+    MLPs (<attribute>_embedf, <attribute>_hidden2output) of a seperate_all Unet1D
+    stored under prefix for one with fuse_attribute_mlps; attributes are ordered as
+    the object features. Already converted weights are kept.
+    """
+    encoders = [prefix + a + '_embedf.' for a in attributes]
+    decoders = [prefix + a + '_hidden2output.' for a in attributes]
+    if encoders[0] + '0.weight' not in state_dict:
+        return state_dict
+
+    def pop(names, key):
+        return [state_dict.pop(name + key) for name in names]
+
+    # encoder: block-diagonal layers, the last one sums the attribute embeddings
+    for layer in ['0', '2']:
+        state_dict[prefix + 'attribute_encoder.' + layer + '.weight'] = _block_diag(pop(encoders, layer + '.weight'))
+        state_dict[prefix + 'attribute_encoder.' + layer + '.bias'] = torch.cat(pop(encoders, layer + '.bias'))
+    state_dict[prefix + 'attribute_encoder.4.weight'] = torch.cat(pop(encoders, '4.weight'), dim = 1)
+    state_dict[prefix + 'attribute_encoder.4.bias'] = sum(pop(encoders, '4.bias'))
+
+    # decoder: the first layer is shared by the attributes, the others are block-diagonal
+    state_dict[prefix + 'attribute_decoder.0.weight'] = torch.cat(pop(decoders, '0.weight'), dim = 0)
+    state_dict[prefix + 'attribute_decoder.0.bias'] = torch.cat(pop(decoders, '0.bias'))
+    for layer in ['2', '4']:
+        state_dict[prefix + 'attribute_decoder.' + layer + '.weight'] = _block_diag(pop(decoders, layer + '.weight'))
+        state_dict[prefix + 'attribute_decoder.' + layer + '.bias'] = torch.cat(pop(decoders, layer + '.bias'))
+    return state_dict
+
+def channels_last_state_dict(state_dict, prefix = ''):
+    """
+    Convert (in place) the weights of a channels-first Unet1D stored under prefix
+    for a channels_last one: the 1x1 conv kernels drop their last axis and the
+    LayerNorm gains their broadcasting axes. Already converted weights are kept.
+    """
+    for key in list(state_dict.keys()):
+        value = state_dict[key]
+        if not key.startswith(prefix) or value.dim() != 3 or value.shape[-1] != 1:
+            continue
+        state_dict[key] = value.reshape(-1) if key.endswith('.g') else value[..., 0]
+    return state_dict
+
 
 class Unet1D(nn.Module):
     def __init__(
@@ -358,7 +598,10 @@ class Unet1D(nn.Module):
         learned_variance = False,
         learned_sinusoidal_cond = False,
         random_fourier_features = False,
-        learned_sinusoidal_dim = 16
+        learned_sinusoidal_dim = 16,
+        channels_last = False,
+        fuse_attribute_mlps = False,
+        gradient_checkpointing = False
     ):
         super().__init__()
 
@@ -376,15 +619,48 @@ class Unet1D(nn.Module):
         #self.modulate_time_context_instanclass =  modulate_time_context_instanclass
         self.text_condition = text_condition
         self.text_dim = text_dim
-        if self.seperate_all:
+        # channels_last: BxNxC features all the way with nn.Linear layers instead of
+        # the 1x1 convs on BxCxN features, loads the channels-first checkpoints
+        self.channels_last = channels_last
+        self.channel_dim = -1 if channels_last else 1
+        # gradient_checkpointing: the resnet / attention blocks keep no activations for
+        # the backward pass when training, they are recomputed instead
+        self.gradient_checkpointing = gradient_checkpointing
+        # fuse_attribute_mlps: the per-attribute MLPs of seperate_all run as one MLP of
+        # GroupedProjection layers, loads the checkpoints of the separate MLPs
+        self.fuse_attribute_mlps = seperate_all and fuse_attribute_mlps
+        if self.fuse_attribute_mlps:
+            attributes = ['bbox', 'class'] + (['objectness'] if objectness_dim > 0 else []) + (['objfeat'] if objfeat_dim > 0 else [])
+            attribute_dims = [translation_dim + size_dim + angle_dim, class_dim] + \
+                ([objectness_dim] if objectness_dim > 0 else []) + ([objfeat_dim] if objfeat_dim > 0 else [])
+            self._register_load_state_dict_pre_hook(
+                lambda state_dict, prefix, *args: fused_attribute_state_dict(state_dict, attributes, prefix))
+        if channels_last:
+            proj = nn.Linear
+            block_klass, norm_klass = ResnetBlockLast, LayerNormLast
+            linear_attn, attn, linear_attn_cross = LinearAttentionLast, AttentionLast, LinearAttentionCrossLast
+            self._register_load_state_dict_pre_hook(
+                lambda state_dict, prefix, *args: channels_last_state_dict(state_dict, prefix))
+        else:
+            proj = partial(nn.Conv1d, kernel_size = 1)
+            block_klass, norm_klass = ResnetBlock, LayerNorm
+            linear_attn, attn, linear_attn_cross = LinearAttention, Attention, LinearAttentionCross
+
+        if self.fuse_attribute_mlps:
+            self.attribute_encoder = Unet1D._fused_encoder_mlp(dim, attribute_dims, proj, channels_last)
+
+            input_channels = dim
+            print('fused unet1d encoder of objectness/class/translation/size/angle')
+
+        elif self.seperate_all:
             if self.objectness_dim >0:
-                self.objectness_embedf = Unet1D._encoder_mlp(dim, self.objectness_dim)
+                self.objectness_embedf = Unet1D._encoder_mlp(dim, self.objectness_dim, proj)
 
             if self.objfeat_dim  >0:
-                self.objfeat_embedf = Unet1D._encoder_mlp(dim, self.objfeat_dim)
+                self.objfeat_embedf = Unet1D._encoder_mlp(dim, self.objfeat_dim, proj)
             
-            self.class_embedf = Unet1D._encoder_mlp(dim, self.class_dim)
-            self.bbox_embedf = Unet1D._encoder_mlp(dim, self.translation_dim+self.size_dim+self.angle_dim)
+            self.class_embedf = Unet1D._encoder_mlp(dim, self.class_dim, proj)
+            self.bbox_embedf = Unet1D._encoder_mlp(dim, self.translation_dim+self.size_dim+self.angle_dim, proj)
             
             input_channels = dim 
             print('separate unet1d encoder of objectness/class/translation/size/angle')
@@ -394,12 +670,12 @@ class Unet1D(nn.Module):
             print('unet1d encoder of all object properties')
 
         init_dim = default(init_dim, dim)
-        self.init_conv = nn.Conv1d(input_channels, init_dim, 1) #nn.Conv1d(input_channels, init_dim, 7, padding = 3)
+        self.init_conv = proj(input_channels, init_dim) #nn.Conv1d(input_channels, init_dim, 7, padding = 3)
 
         dims = [init_dim, *map(lambda m: dim * m, dim_mults)]
         in_out = list(zip(dims[:-1], dims[1:]))
 
-        block_klass = partial(ResnetBlock, groups = resnet_block_groups)
+        block_klass = partial(block_klass, groups = resnet_block_groups)
         
         # time embeddings
 
@@ -434,17 +710,17 @@ class Unet1D(nn.Module):
             self.downs.append(nn.ModuleList([
                 block_klass(dim_in, dim_in, time_emb_dim = context_dim + instanclass_dim), 
                 block_klass(dim_in, dim_in, time_emb_dim = time_dim),
-                ResidualCross(PreNormCross(dim_in, LinearAttentionCross(dim_in, text_dim))) if text_condition else nn.Identity(),
+                ResidualCross(PreNormCross(dim_in, linear_attn_cross(dim_in, text_dim), norm_klass)) if text_condition else nn.Identity(),
                 block_klass(dim_in, dim_in, time_emb_dim = time_dim),
-                Residual(PreNorm(dim_in, LinearAttention(dim_in))),
-                Downsample(dim_in, dim_out) if not is_last else nn.Conv1d(dim_in, dim_out, 1) #3, padding = 1)
+                Residual(PreNorm(dim_in, linear_attn(dim_in), norm_klass)),
+                Downsample(dim_in, dim_out) if not is_last else proj(dim_in, dim_out) #3, padding = 1)
             ]))
 
         mid_dim = dims[-1]
         self.mid_block0 = block_klass(mid_dim, mid_dim, time_emb_dim = context_dim + instanclass_dim) 
         self.mid_block1 = block_klass(mid_dim, mid_dim, time_emb_dim = time_dim)
-        self.mid_attn_cross = ResidualCross(PreNormCross(mid_dim, LinearAttentionCross(mid_dim, text_dim))) if text_condition else nn.Identity()
-        self.mid_attn = Residual(PreNorm(mid_dim, Attention(mid_dim)))
+        self.mid_attn_cross = ResidualCross(PreNormCross(mid_dim, linear_attn_cross(mid_dim, text_dim), norm_klass)) if text_condition else nn.Identity()
+        self.mid_attn = Residual(PreNorm(mid_dim, attn(mid_dim), norm_klass))
         self.mid_block2 = block_klass(mid_dim, mid_dim, time_emb_dim = time_dim)
 
         for ind, (dim_in, dim_out) in enumerate(reversed(in_out)):
@@ -453,10 +729,10 @@ class Unet1D(nn.Module):
             self.ups.append(nn.ModuleList([
                 block_klass(dim_out, dim_in, time_emb_dim = context_dim + instanclass_dim), 
                 block_klass(dim_out + dim_in, dim_out, time_emb_dim = time_dim),
-                ResidualCross(PreNormCross(dim_out, LinearAttentionCross(dim_out, text_dim))) if text_condition else nn.Identity(),
+                ResidualCross(PreNormCross(dim_out, linear_attn_cross(dim_out, text_dim), norm_klass)) if text_condition else nn.Identity(),
                 block_klass(dim_out + dim_in, dim_out, time_emb_dim = time_dim),
-                Residual(PreNorm(dim_out, LinearAttention(dim_out))),
-                Upsample(dim_out, dim_in) if not is_last else  nn.Conv1d(dim_out, dim_in, 1) #3, padding = 1)
+                Residual(PreNorm(dim_out, linear_attn(dim_out), norm_klass)),
+                Upsample(dim_out, dim_in) if not is_last else  proj(dim_out, dim_in) #3, padding = 1)
             ]))
 
 
@@ -465,73 +741,161 @@ class Unet1D(nn.Module):
 
         self.final_res_block = block_klass(dim * 2, dim, time_emb_dim = time_dim)
         
-        if self.seperate_all:
+        if self.fuse_attribute_mlps:
+            self.attribute_decoder = Unet1D._fused_decoder_mlp(dim, attribute_dims, proj, channels_last)
+            print('fused unet1d decoder of objectness/class/translation/size/angle')
+
+        elif self.seperate_all:
             if self.objectness_dim >0:
-                self.objectness_hidden2output = Unet1D._decoder_mlp(dim, self.objectness_dim)
+                self.objectness_hidden2output = Unet1D._decoder_mlp(dim, self.objectness_dim, proj)
 
             if self.objfeat_dim >0:
-                self.objfeat_hidden2output = Unet1D._decoder_mlp(dim, self.objfeat_dim)
+                self.objfeat_hidden2output = Unet1D._decoder_mlp(dim, self.objfeat_dim, proj)
 
-            self.class_hidden2output = Unet1D._decoder_mlp(dim, self.class_dim)
+            self.class_hidden2output = Unet1D._decoder_mlp(dim, self.class_dim, proj)
 
-            self.bbox_hidden2output = Unet1D._decoder_mlp(dim, self.translation_dim+self.size_dim+self.angle_dim)
+            self.bbox_hidden2output = Unet1D._decoder_mlp(dim, self.translation_dim+self.size_dim+self.angle_dim, proj)
             print('separate unet1d decoder of objectness/class/translation/size/angle')
 
         else:
-            self.final_conv = nn.Conv1d(dim, self.out_dim, 1)
+            self.final_conv = proj(dim, self.out_dim)
             print('unet1d decoder of all object properties')
         
     @staticmethod
-    def _encoder_mlp(hidden_size, input_size):
+    def _encoder_mlp(hidden_size, input_size, proj=partial(nn.Conv1d, kernel_size=1)):
         mlp_layers = [
-                nn.Conv1d(input_size, hidden_size, 1),
+                proj(input_size, hidden_size),
                 nn.GELU(),
-                nn.Conv1d(hidden_size, hidden_size*2, 1),
+                proj(hidden_size, hidden_size*2),
                 nn.GELU(),
-                nn.Conv1d(hidden_size*2, hidden_size, 1),
+                proj(hidden_size*2, hidden_size),
             ]
         return nn.Sequential(*mlp_layers)
     
     @staticmethod
-    def _decoder_mlp(hidden_size, output_size):
+    def _decoder_mlp(hidden_size, output_size, proj=partial(nn.Conv1d, kernel_size=1)):
+        mlp_layers = [
+            proj(hidden_size, hidden_size*2),
+            nn.GELU(),
+            proj(hidden_size*2, hidden_size),
+            nn.GELU(),
+            proj(hidden_size, output_size),
+        ]
+        return nn.Sequential(*mlp_layers)
+
+    @staticmethod
+    def _fused_encoder_mlp(hidden_size, input_sizes, proj=partial(nn.Conv1d, kernel_size=1), channels_last=False):
+        # the _encoder_mlp of every attribute, the last layer sums their outputs
+        groups = len(input_sizes)
+        mlp_layers = [
+                GroupedProjection(input_sizes, [hidden_size]*groups, channels_last),
+                nn.GELU(),
+                GroupedProjection([hidden_size]*groups, [hidden_size*2]*groups, channels_last),
+                nn.GELU(),
+                proj(hidden_size*2*groups, hidden_size),
+            ]
+        return nn.Sequential(*mlp_layers)
+
+    @staticmethod
+    def _fused_decoder_mlp(hidden_size, output_sizes, proj=partial(nn.Conv1d, kernel_size=1), channels_last=False):
+        # the _decoder_mlp of every attribute, with their outputs concatenated
+        groups = len(output_sizes)
         mlp_layers = [
-            nn.Conv1d(hidden_size, hidden_size*2, 1),
+            proj(hidden_size, hidden_size*2*groups),
             nn.GELU(),
-            nn.Conv1d(hidden_size*2, hidden_size, 1),
+            GroupedProjection([hidden_size*2]*groups, [hidden_size]*groups, channels_last),
             nn.GELU(),
-            nn.Conv1d(hidden_size, output_size, 1),
+            GroupedProjection([hidden_size]*groups, output_sizes, channels_last),
         ]
         return nn.Sequential(*mlp_layers)
     
 
-    def forward(self, x, beta, context=None, context_cross=None): 
-        # (B, N, C) --> (B, C, N)
+    def _run(self, block, *args, **kwargs):
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled() and not isinstance(block, nn.Identity):
+            return checkpoint(partial(block, **kwargs), *args, use_reentrant = False)
+        return block(*args, **kwargs)
+
+    def _down_level(self, level, x, h, t, context, context_cross, mask, context_mask):
+        block0, block1, attncross, block2, attn, downsample = level
+        x = self._run(block0, x, context) 
+        x = self._run(block1, x, t)
+        h.append(x)
+
+        x = self._run(attncross, x, context_cross, mask = context_mask) if self.text_condition else attncross(x)
+        x = self._run(block2, x, t)
+        x = self._run(attn, x, mask = mask)
+        h.append(x)
+
+        return downsample(x)
+
+    def _up_level(self, level, x, h, t, context, context_cross, mask, context_mask):
+        block0, block1, attncross, block2, attn, upsample = level
+        x = self._run(block0, x, context) 
+        x = torch.cat((x, h.pop()), dim = self.channel_dim)
+        x = self._run(block1, x, t)
+
+        x = self._run(attncross, x, context_cross, mask = context_mask) if self.text_condition else self.mid_attn_cross(x)
+        x = torch.cat((x, h.pop()), dim = self.channel_dim)
+        x = self._run(block2, x, t)
+        x = self._run(attn, x, mask = mask)
+
+        return upsample(x)
+
+    def _deep(self, x, h, t, context, context_cross, mask, context_mask):
+        # all the levels but the outermost down / up ones, the features DeepCache reuses
+        for level in self.downs[1:]:
+            x = self._down_level(level, x, h, t, context, context_cross, mask, context_mask)
+
+        x = self._run(self.mid_block0, x, context)
+        x = self._run(self.mid_block1, x, t)
+        x = self._run(self.mid_attn_cross, x, context_cross, mask = context_mask) if self.text_condition else self.mid_attn_cross(x)
+        x = self._run(self.mid_attn, x, mask = mask)
+        x = self._run(self.mid_block2, x, t)
+
+        for level in self.ups[:-1]:
+            x = self._up_level(level, x, h, t, context, context_cross, mask, context_mask)
+        return x
+
+    def forward(self, x, beta, context=None, context_cross=None, mask=None, deep_cache=None, context_mask=None): 
+        # mask: optional (B, N) bool of the valid object slots, the padded ones are
+        # skipped as keys of the self-attention layers
+        # context_mask: optional (B, L) bool of the valid tokens of context_cross, for
+        # prompts of different lengths padded into one batch
+        # deep_cache: optional DeepCache of the sampling loop, the deep features are
+        # read from it instead of recomputed between its refreshes
         batch_size, num_points, point_dim = x.size()
-        x = torch.permute(x, (0, 2, 1)).contiguous()
+        channel_dim = self.channel_dim
+        if not self.channels_last:
+            # (B, N, C) --> (B, C, N)
+            # a view, the 1x1 convs read the strided layout without a copy
+            x = torch.permute(x, (0, 2, 1))
         
-        if self.seperate_all:
-            x_class = self.class_embedf(x[:, self.bbox_dim:self.bbox_dim+self.class_dim, :])
+        if self.fuse_attribute_mlps:
+            x = self.attribute_encoder(x.narrow(channel_dim, 0, sum(self.attribute_encoder[0].in_splits)))
+
+        elif self.seperate_all:
+            x_class = self.class_embedf(x.narrow(channel_dim, self.bbox_dim, self.class_dim))
             if self.objectness_dim >0:
-                x_object = self.objectness_embedf(x[:, self.bbox_dim+self.class_dim:self.bbox_dim+self.class_dim+self.objectness_dim, :])
+                x_object = self.objectness_embedf(x.narrow(channel_dim, self.bbox_dim+self.class_dim, self.objectness_dim))
             else:
                 x_object = 0
             
             if self.objfeat_dim > 0:
-                x_objfeat = self.objfeat_embedf(x[:, self.bbox_dim+self.class_dim+self.objectness_dim:self.bbox_dim+self.class_dim+self.objectness_dim+self.objfeat_dim, :])
+                x_objfeat = self.objfeat_embedf(x.narrow(channel_dim, self.bbox_dim+self.class_dim+self.objectness_dim, self.objfeat_dim))
             else:
                 x_objfeat = 0
                 
-            x_bbox = self.bbox_embedf(x[:, 0:self.bbox_dim, :])
+            x_bbox = self.bbox_embedf(x.narrow(channel_dim, 0, self.bbox_dim))
             x = x_class + x_bbox + x_object + x_objfeat
 
 
         # denosing 
-        if context_cross is not None:
+        if context_cross is not None and not self.channels_last:
             # [B, N, C] --> [B, C, N]
-            context_cross = torch.permute(context_cross, (0, 2, 1)).contiguous()
+            context_cross = torch.permute(context_cross, (0, 2, 1))
 
         x = self.init_conv(x)
-        r = x.clone()
+        r = x
 
         t = self.time_mlp(beta) 
 
@@ -539,55 +903,40 @@ class Unet1D(nn.Module):
 
 
         # unet-1D
-        for block0, block1, attncross, block2, attn, downsample in self.downs:
-            x = block0(x, context) 
-            x = block1(x, t)
-            h.append(x)
-
-            x = attncross(x, context_cross) if self.text_condition else attncross(x)
-            x = block2(x, t)
-            x = attn(x)
-            h.append(x)
+        x = self._down_level(self.downs[0], x, h, t, context, context_cross, mask, context_mask)
 
-            x = downsample(x)
-
-        x = self.mid_block0(x, context)
-        x = self.mid_block1(x, t)
-        x = self.mid_attn_cross(x, context_cross) if self.text_condition else self.mid_attn_cross(x)
-        x = self.mid_attn(x)
-        x = self.mid_block2(x, t)
-
-        for block0, block1, attncross, block2, attn, upsample in self.ups:
-            x = block0(x, context) 
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block1(x, t)
-
-            x = attncross(x, context_cross) if self.text_condition else self.mid_attn_cross(x)
-            x = torch.cat((x, h.pop()), dim = 1)
-            x = block2(x, t)
-            x = attn(x)
+        cached = deep_cache.lookup(x) if deep_cache is not None else None
+        if cached is None:
+            x = self._deep(x, h, t, context, context_cross, mask, context_mask)
+            if deep_cache is not None:
+                deep_cache.store(x)
+        else:
+            x = cached
 
-            x = upsample(x)
+        x = self._up_level(self.ups[-1], x, h, t, context, context_cross, mask, context_mask)
 
  
-        x = torch.cat((x, r), dim = 1)
+        x = torch.cat((x, r), dim = channel_dim)
 
-        x = self.final_res_block(x, t)
+        x = self._run(self.final_res_block, x, t)
         
-        if self.seperate_all:
+        if self.fuse_attribute_mlps:
+            out = self.attribute_decoder(x)
+        elif self.seperate_all:
             out_bbox  = self.bbox_hidden2output(x)
             out_class = self.class_hidden2output(x)
-            out = torch.cat([out_bbox, out_class], dim=1).contiguous()
+            out = torch.cat([out_bbox, out_class], dim=channel_dim).contiguous()
             if self.objectness_dim >0:
                 out_object = self.objectness_hidden2output(x)
-                out = torch.cat([out, out_object], dim=1).contiguous()
+                out = torch.cat([out, out_object], dim=channel_dim).contiguous()
 
             if self.objfeat_dim >0:
                 out_objfeat = self.objfeat_hidden2output(x)
-                out = torch.cat([out, out_objfeat], dim=1).contiguous()
+                out = torch.cat([out, out_objfeat], dim=channel_dim).contiguous()
         else:
             out = self.final_conv(x)
         
-        # (B, N, C) <-- (B, C, N)
-        out = torch.permute(out, (0, 2, 1)).contiguous()
+        if not self.channels_last:
+            # (B, N, C) <-- (B, C, N)
+            out = torch.permute(out, (0, 2, 1))
         return out
\ No newline at end of file
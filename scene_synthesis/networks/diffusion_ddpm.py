@@ -5,6 +5,7 @@ import torch.utils.data
 from torch.distributions import Normal
 import torch.distributed as dist
 import math
+import copy
 import numpy as np
 import torch.distributed as dist
 from tqdm.auto import tqdm
@@ -13,11 +14,18 @@ import torch.nn.functional as F
 from einops import rearrange, reduce
 from functools import partial
 from collections import namedtuple
-from .loss import axis_aligned_bbox_overlaps_3d
+from .loss import axis_aligned_bbox_pairwise_overlaps_3d, axis_aligned_bbox_self_ious_3d
+from .samplers import DDPMSampler, DDIMSampler
 
 
 ModelPrediction =  namedtuple('ModelPrediction', ['pred_noise', 'pred_x_start'])
 
+def _randn_(noise_fn, out):
+    """Draw standard normal noise into out, without allocating for torch.randn."""
+    if noise_fn is torch.randn:
+        return out.normal_()
+    return out.copy_(noise_fn(size=out.shape, dtype=out.dtype, device=out.device))
+
 def identity(t, *args, **kwargs):
     return t
 
@@ -122,6 +130,36 @@ def discretized_gaussian_log_likelihood(x, *, means, log_scales):
     assert log_probs.shape == x.shape
     return log_probs
 
+class _SampleLoopState:
+    """
+    The tensors of GaussianDiffusion.sample_loop that follow the samples of
+    the batch: the current samples, the buffers reused by the steps, the
+    conditions and the known boxes.
+    """
+    def __init__(self, img_t, condition, condition_cross, context_mask, known, stochastic=False, pred_x0=False):
+        self.img_t = img_t
+        self.condition, self.condition_cross, self.context_mask = condition, condition_cross, context_mask
+        self.known = known
+        self.t = torch.empty(img_t.shape[0], dtype=torch.int64, device=img_t.device)
+        self.t_next = torch.empty_like(self.t)
+        self._alloc(stochastic, pred_x0)
+
+    def _alloc(self, stochastic, pred_x0):
+        self.img_next = torch.empty_like(self.img_t)
+        self.noise = torch.empty_like(self.img_t) if stochastic else None
+        self.pred_x0 = torch.empty_like(self.img_t) if pred_x0 else None
+        self.known_noise = torch.empty_like(self.known) if self.known is not None else None
+
+    def select_(self, index):
+        """Keep the samples of index, the step buffers are allocated again."""
+        self.img_t = self.img_t[index]
+        self.t, self.t_next = self.t[index], self.t_next[index]
+        self.condition = self.condition[index] if self.condition is not None else None
+        self.condition_cross = self.condition_cross[index] if self.condition_cross is not None else None
+        self.context_mask = self.context_mask[index] if self.context_mask is not None else None
+        self.known = self.known[index] if self.known is not None else None
+        self._alloc(self.noise is not None, self.pred_x0 is not None)
+
 class GaussianDiffusion:
     def __init__(self, config, betas, loss_type, model_mean_type, model_var_type, loss_separate, loss_iou, train_stats_file):
         # read object property dimension
@@ -152,11 +190,30 @@ class GaussianDiffusion:
 
         self.room_partial_condition = config.get("room_partial_condition", False)
         self.room_arrange_condition = config.get("room_arrange_condition", False)
+        self._loss_segment_names, self._loss_segment_index, self._loss_segment_size = self._build_loss_segments()
 
         self.loss_type = loss_type
         self.model_mean_type = model_mean_type
         self.model_var_type = model_var_type
         assert isinstance(betas, np.ndarray)
+        self._set_betas(betas)
+        alphas_cumprod = self.alphas_cumprod
+
+        # calculate loss weight
+        snr = alphas_cumprod / (1 - alphas_cumprod)
+
+        if model_mean_type == 'eps':
+            loss_weight = torch.ones_like(snr)
+        elif model_mean_type == 'x0':
+            loss_weight = snr
+        elif model_mean_type == 'v':
+            loss_weight = snr / (snr + 1)
+        self.loss_weight = loss_weight
+
+    def _set_betas(self, betas):
+        """
+        Set the noise schedule and all the coefficients derived from it
+        """
         self.np_betas = betas = betas.astype(np.float64)  # computations here in float64 for accuracy
         assert (betas > 0).all() and (betas <= 1).all()
         timesteps, = betas.shape
@@ -166,7 +223,8 @@ class GaussianDiffusion:
         # betas = np.concatenate([betas, np.full_like(betas[:int(0.2*len(betas))], betas[-1])])
 
         alphas = 1. - betas
-        alphas_cumprod = torch.from_numpy(np.cumprod(alphas, axis=0)).float()
+        self.np_alphas_cumprod = np.cumprod(alphas, axis=0)
+        alphas_cumprod = torch.from_numpy(self.np_alphas_cumprod).float()
         alphas_cumprod_prev = torch.from_numpy(np.append(1., alphas_cumprod[:-1])).float()
 
         self.betas = torch.from_numpy(betas).float()
@@ -191,16 +249,56 @@ class GaussianDiffusion:
         self.posterior_mean_coef1 = betas * torch.sqrt(alphas_cumprod_prev) / (1. - alphas_cumprod)
         self.posterior_mean_coef2 = (1. - alphas_cumprod_prev) * torch.sqrt(alphas) / (1. - alphas_cumprod)
 
-        # calculate loss weight
-        snr = alphas_cumprod / (1 - alphas_cumprod)
-
-        if model_mean_type == 'eps':
-            loss_weight = torch.ones_like(snr)
-        elif model_mean_type == 'x0':
-            loss_weight = snr
-        elif model_mean_type == 'v':
-            loss_weight = snr / (snr + 1)
-        self.loss_weight = loss_weight
+    def respace(self, use_timesteps):
+        """
+        Timestep respacing of improved DDPM (https://arxiv.org/abs/2102.09672):
+        a copy of this diffusion whose Markov chain only visits use_timesteps, with
+        the betas derived from the trained alphas_cumprod. Its timestep_map converts
+        the new timestep indices back to the ones the denoiser was trained on.
+        """
+        use_timesteps = sorted(set(int(t) for t in use_timesteps))
+        last_alpha_cumprod = 1.0
+        new_betas = []
+        for t in use_timesteps:
+            new_betas.append(1 - self.np_alphas_cumprod[t] / last_alpha_cumprod)
+            last_alpha_cumprod = self.np_alphas_cumprod[t]
+
+        spaced = copy.copy(self)
+        spaced._set_betas(np.array(new_betas))
+        spaced.timestep_map = torch.tensor(use_timesteps, dtype=torch.int64)
+        return spaced
+
+    def _build_loss_segments(self):
+        """
+        Map every channel of the diffusion target to the attribute it encodes,
+        so that all per-attribute losses come out of one scatter_add over channels.
+        """
+        if self.room_arrange_condition:
+            segments = [('trans', self.translation_dim), ('angle', self.angle_dim)]
+        else:
+            segments = [('trans', self.translation_dim), ('size', self.size_dim), ('angle', self.angle_dim),
+                        ('class', self.class_dim), ('object', self.objectness_dim), ('objfeat', self.objfeat_dim)]
+        segments = [(name, dim) for name, dim in segments if dim > 0]
+        names = [name for name, _ in segments]
+        index = torch.cat([torch.full((dim,), i, dtype=torch.int64) for i, (_, dim) in enumerate(segments)])
+        size = torch.tensor([dim for _, dim in segments], dtype=torch.float)
+        return names, index, size
+
+    def _segment_losses(self, sq_err):
+        """
+        Reduce a squared error of shape BxNxC into per-attribute losses.
+        Returns the per-channel sums (BxC), the per-segment sums (BxS) and a dict
+        of per-segment mean losses (each of shape B).
+        """
+        B, C = sq_err.shape[0], sq_err.shape[-1]
+        assert C == self._loss_segment_index.shape[0]
+        num_points = sq_err.numel() // (B * C)
+        sq_err_c = sq_err.reshape(B, -1, C).sum(dim=1)
+        index = self._loss_segment_index.to(sq_err.device)[None, :].expand(B, C)
+        seg_sum = torch.zeros(B, len(self._loss_segment_names), dtype=sq_err.dtype, device=sq_err.device)
+        seg_sum.scatter_add_(1, index, sq_err_c)
+        seg_loss = seg_sum / (num_points * self._loss_segment_size.to(sq_err.device))
+        return sq_err_c, seg_sum, dict(zip(self._loss_segment_names, seg_loss.unbind(dim=1)))
 
     @staticmethod
     def _extract(a, t, x_shape):
@@ -319,8 +417,8 @@ class GaussianDiffusion:
                                torch.log(torch.cat([self.posterior_variance[1:2], self.betas[1:]])).to(data.device)),
                 'fixedsmall': (self.posterior_variance.to(data.device), self.posterior_log_variance_clipped.to(data.device)),
             }[self.model_var_type]
-            model_variance = self._extract(model_variance, t, data.shape) * torch.ones_like(data)
-            model_log_variance = self._extract(model_log_variance, t, data.shape) * torch.ones_like(data)
+            model_variance = self._extract(model_variance, t, data.shape).expand(data.shape)
+            model_log_variance = self._extract(model_log_variance, t, data.shape).expand(data.shape)
         else:
             raise NotImplementedError(self.model_var_type)
 
@@ -353,154 +451,323 @@ class GaussianDiffusion:
 
 
     def p_sample_loop(self, denoise_fn, shape, device, condition, condition_cross,
-                      noise_fn=torch.randn, clip_denoised=True, keep_running=False):
+                      noise_fn=torch.randn, clip_denoised=True, sampler=None, context_mask=None):
         """
         Generate samples
-        keep_running: True if we run 2 x num_timesteps, False if we just run num_timesteps
+        sampler: Sampler used for the reverse process, the full DDPM chain by default
 
         """
 
-        assert isinstance(shape, (tuple, list))
-        img_t = noise_fn(size=shape, dtype=torch.float, device=device)
-        for t in reversed(range(0, self.num_timesteps if not keep_running else len(self.betas))):
-            t_ = torch.empty(shape[0], dtype=torch.int64, device=device).fill_(t)
-            img_t = self.p_sample(denoise_fn=denoise_fn, data=img_t,t=t_, condition=condition, condition_cross=condition_cross, noise_fn=noise_fn,
-                                  clip_denoised=clip_denoised, return_pred_xstart=False)
-
-        assert img_t.shape == shape
-        return img_t
+        return self.sample_loop(denoise_fn, shape, device, condition, condition_cross, sampler=sampler, noise_fn=noise_fn,
+                                clip_denoised=clip_denoised, context_mask=context_mask)
 
     def p_sample_loop_trajectory(self, denoise_fn, shape, device, freq, condition, condition_cross,
-                                 noise_fn=torch.randn,clip_denoised=True, keep_running=False):
+                                 noise_fn=torch.randn,clip_denoised=True, sampler=None, context_mask=None):
         """
         Generate samples, returning intermediate images
         Useful for visualizing how denoised images evolve over time
         Args:
-          repeat_noise_steps (int): Number of denoising timesteps in which the same noise
-            is used across the batch. If >= 0, the initial noise is the same for all batch elemements.
+          freq (int): keep the sample every freq timesteps (of the full chain)
+          sampler: Sampler used for the reverse process, the full DDPM chain by default
+        """
+        return self.sample_loop(denoise_fn, shape, device, condition, condition_cross, sampler=sampler, noise_fn=noise_fn,
+                                clip_denoised=clip_denoised, freq=freq, context_mask=context_mask)
+    
+    def sample_loop(self, denoise_fn, shape, device, condition, condition_cross, sampler=None,
+                    noise_fn=torch.randn, clip_denoised=True, known_boxes=None, freq=None, inplace=True,
+                    x_start=None, t_start=None, context_mask=None):
+        """
+        Generate samples with any Sampler (the full DDPM chain by default)
+        known_boxes: clean values of the first slots (scene completion), re-noised to the
+            current timestep before every step and restored after the last one
+        x_start, t_start: warm start (SDEdit), only the steps of the sampler from
+            timesteps <= t_start are run, starting from x_start diffused to the first of them
+        context_mask: optional (B, L) bool of the valid tokens of condition_cross, given
+            to denoise_fn when prompts of different lengths share the batch; the compiled
+            and exported backends take no mask, their eager sampler is used then
+        freq: if given, return the initial noise, the sample after the first step and
+            the samples whenever a multiple of freq timesteps is crossed
+        inplace: run the steps with Sampler.step_ on buffers allocated once, the noise
+            is drawn into a reused tensor; False calls Sampler.step, which allocates its
+            outputs at every step
+        With the early_exit ConvergenceMonitor of the sampler, the samples whose
+        predicted x_0 has converged leave the batch with it as their final value.
+        With the prune_empty SlotPruner of the sampler, the object slots predicted
+        empty for long enough are frozen and no longer given to the denoiser.
         """
         assert isinstance(shape, (tuple, list))
-
-        total_steps =  self.num_timesteps if not keep_running else len(self.betas)
+        sampler = sampler if sampler is not None else DDPMSampler(self)
+        if context_mask is not None:
+            sampler = sampler.eager()
+        # no slots to prune without the class channels (rearrangement)
+        pruner = sampler.prune_empty if shape[-1] >= self.bbox_dim + self.class_dim else None
+        if sampler.parallel is not None:
+            assert freq is None and sampler.early_exit is None, "no trajectory / early exit with parallel sampling"
+            assert t_start is None, "no warm start with parallel sampling"
+            assert sampler.deep_cache is None, "no feature reuse across the steps of a parallel window"
+            assert pruner is None, "no slot pruning with parallel sampling"
+            return self.picard_sample_loop(denoise_fn, shape, device, condition, condition_cross, sampler=sampler,
+                                           noise_fn=noise_fn, clip_denoised=clip_denoised, known_boxes=known_boxes,
+                                           context_mask=context_mask, **sampler.parallel)
+        sampler.reset()
+        timesteps = sampler.timesteps()
+        if t_start is not None:
+            timesteps = [(time, time_next) for time, time_next in timesteps if time <= t_start]
+        monitor = sampler.early_exit
+        assert monitor is None or freq is None, "no trajectory with early exit"
 
         img_t = noise_fn(size=shape, dtype=torch.float, device=device)
-        imgs = [img_t]
-        for t in reversed(range(0,total_steps)):
-
-            t_ = torch.empty(shape[0], dtype=torch.int64, device=device).fill_(t)
-            img_t = self.p_sample(denoise_fn=denoise_fn, data=img_t, t=t_, condition=condition, condition_cross=condition_cross, noise_fn=noise_fn,
-                                  clip_denoised=clip_denoised,
-                                  return_pred_xstart=False)
-            if t % freq == 0 or t == total_steps-1:
-                imgs.append(img_t)
-
-        assert imgs[-1].shape == shape
-        return imgs
-    
-    ## from https://github.com/lucidrains/denoising-diffusion-pytorch/blob/main/denoising_diffusion_pytorch/denoising_diffusion_pytorch.py
-    @torch.no_grad()
-    def ddim_sample_loop(self, denoise_fn, shape, device, condition, condition_cross, noise_fn=torch.randn, clip_denoised=True, sampling_timesteps=50, ddim_sampling_eta=0., return_all_timesteps = False):
-        self.ddim_sampling_eta = ddim_sampling_eta
-        self.sampling_timesteps = sampling_timesteps
-        batch, total_timesteps, sampling_timesteps, eta = shape[0], self.num_timesteps, self.sampling_timesteps, self.ddim_sampling_eta
-
-        times = torch.linspace(-1, total_timesteps - 1, steps = sampling_timesteps + 1)   # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
-        times = list(reversed(times.int().tolist()))
-        time_pairs = list(zip(times[:-1], times[1:])) # [(T-1, T-2), (T-2, T-3), ..., (1, 0), (0, -1)]
-
-        img = noise_fn(size=shape, dtype=torch.float, device=device) 
-        imgs = [img]
-
-        x_start = None
-
-        for time, time_next in tqdm(time_pairs, desc = 'sampling loop time step'):
-            t_ = torch.empty(shape[0], dtype=torch.int64, device=device).fill_(time)
-    
-            self_cond = x_start if self.self_condition else None
-            pred_noise, x_start, *_ = self.model_predictions(img, t_, condition, condition_cross, self_cond, clip_x_start = True)
-                
-                
-            if time_next < 0:
-                img = x_start
-                imgs.append(img)
-                continue
-
-            alpha = self.alphas_cumprod[time]
-            alpha_next = self.alphas_cumprod[time_next]
-
-            sigma = eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
-            c = (1 - alpha_next - sigma ** 2).sqrt()
-
-            noise = noise_fn(size=shape, dtype=torch.float, device=device)  #torch.randn_like(img)
-
-            img = x_start * alpha_next.sqrt() + \
-                  c * pred_noise + \
-                  sigma * noise
+        if x_start is not None:
+            if timesteps:
+                t_0 = torch.full((shape[0],), timesteps[0][0], dtype=torch.int64, device=device)
+                img_t = self.q_sample(x_start, t_0, noise=img_t)
+            else:
+                img_t = x_start.clone()
+        imgs = [img_t.clone() if inplace else img_t]
+        state = _SampleLoopState(img_t, condition, condition_cross, context_mask, known_boxes,
+                                 stochastic=sampler.stochastic, pred_x0=monitor is not None or pruner is not None)
+        if known_boxes is not None:
+            known_scales = (self.sqrt_alphas_cumprod.tolist(), self.sqrt_one_minus_alphas_cumprod.tolist())
+        if monitor is not None:
+            monitor.reset(self, shape, len(timesteps), device)
+            samples = torch.empty_like(img_t)
+        if pruner is not None:
+            pruner.reset(self, shape, known_boxes.shape[1] if known_boxes is not None else 0, device)
+        denoise_fn = self._sample_loop_denoise_fn(denoise_fn, sampler, pruner, state)
+
+        for time, time_next in timesteps:
+            state.t.fill_(time)
+            state.t_next.fill_(time_next)
+            if known_boxes is not None:
+                self._noise_known_(state, time, known_scales, noise_fn, inplace)
+
+            if inplace:
+                if state.noise is not None:
+                    _randn_(noise_fn, state.noise)
+                sampler.step_(denoise_fn, state.img_t, time, time_next, state.t, state.t_next, state.condition,
+                              state.condition_cross, noise=state.noise, out=state.img_next, clip_denoised=clip_denoised,
+                              pred_x0=state.pred_x0)
+                state.img_t, state.img_next = state.img_next, state.img_t
+            else:
+                state.img_t, x_start = sampler.step(denoise_fn, state.img_t, state.t, state.t_next, state.condition,
+                                                    state.condition_cross, noise_fn=noise_fn, clip_denoised=clip_denoised)
+                state.pred_x0 = x_start if state.pred_x0 is not None else None
+
+            if pruner is not None:
+                self._prune_slots(sampler, pruner, state, inplace)
+            if freq is not None and (time // freq != time_next // freq or time == timesteps[0][0]):
+                imgs.append(state.img_t.clone() if inplace else state.img_t)
+            if monitor is not None and self._exit_converged(sampler, pruner, state, samples):
+                break
+
+        img_t = state.img_t
+        if pruner is not None:
+            img_t = pruner.apply(img_t, inplace)
+        if monitor is not None:
+            samples[monitor.active] = img_t
+            img_t = samples
+
+        if known_boxes is not None:
+            img_t[:, :known_boxes.shape[1], :].copy_(known_boxes)
+            if freq is not None:
+                imgs[-1] = img_t
 
-            imgs.append(img)
+        assert img_t.shape == shape
+        return imgs if freq is not None else img_t
 
-        ret = img if not return_all_timesteps else imgs
+    def _sample_loop_denoise_fn(self, denoise_fn, sampler, pruner, state):
+        """
+        denoise_fn of sample_loop with the feature cache of the sampler, the
+        context mask of the samples left in state and the slot pruning.
+        """
+        if sampler.deep_cache is not None:
+            # the cached features follow the denoiser calls of this loop
+            sampler.deep_cache.reset()
+            denoise_fn = partial(denoise_fn, deep_cache=sampler.deep_cache)
+        if state.context_mask is not None:
+            # reads the mask when called, it follows condition_cross out of the batch on early exit
+            unmasked_denoise_fn = denoise_fn
+            denoise_fn = lambda *args, **kwargs: unmasked_denoise_fn(*args, context_mask=state.context_mask, **kwargs)
+        if pruner is not None:
+            denoise_fn = pruner.wrap(denoise_fn)
+        return denoise_fn
+
+    def _noise_known_(self, state, time, known_scales, noise_fn, inplace):
+        """Diffuse the clean known boxes to timestep time into the first slots of the samples."""
+        sqrt_alphas_cumprod, sqrt_one_minus_alphas_cumprod = known_scales
+        _randn_(noise_fn, state.known_noise)
+        if not inplace:
+            # the previous samples may be kept in the trajectory
+            state.img_t = state.img_t.clone()
+        state.img_t[:, :state.known.shape[1], :].copy_(state.known).mul_(sqrt_alphas_cumprod[time]).add_(
+            state.known_noise, alpha=sqrt_one_minus_alphas_cumprod[time])
+
+    def _prune_slots(self, sampler, pruner, state, inplace):
+        """After a step, the frozen slots keep their value and the others may freeze now."""
+        state.img_t, state.pred_x0 = pruner.apply(state.img_t, inplace), pruner.apply(state.pred_x0, inplace)
+        if pruner.update(state.pred_x0) and sampler.deep_cache is not None:
+            sampler.deep_cache.invalidate()
+
+    def _exit_converged(self, sampler, pruner, state, samples):
+        """
+        After a step, the converged samples jump to their predicted x_0 in
+        samples and leave the batch. Returns whether no sample is left.
+        """
+        monitor = sampler.early_exit
+        done = monitor.update(state.pred_x0)
+        if not done.any():
+            return False
+        samples[monitor.active[done]] = state.pred_x0[done]
+        keep = (~done).nonzero()[:, 0]
+        monitor.select_(keep)
+        sampler.select_(keep)
+        if sampler.deep_cache is not None:
+            sampler.deep_cache.select_(keep)
+        if pruner is not None:
+            pruner.select_(keep)
+        state.select_(keep)
+        return keep.numel() == 0
+
+    def picard_sample_loop(self, denoise_fn, shape, device, condition, condition_cross, sampler=None,
+                           noise_fn=torch.randn, clip_denoised=True, known_boxes=None, window=16, tolerance=0.1,
+                           context_mask=None):
+        """
+        Parallel-in-time sampling (ParaDiGMS, https://arxiv.org/abs/2305.16317):
+        with all the noise drawn up front, the chain of sampler steps is solved
+        by Picard iterations over a sliding window of window steps, each
+        iteration evaluating the steps of the window in one batched denoiser
+        call. A step is final once its change between two iterations is below
+        tolerance (relative to the noise level of the step) for every sample,
+        the window then slides past the final steps. Gives the samples of
+        sample_loop (same noise) up to the tolerance, in fewer sequential
+        denoiser calls, counted in sampler.picard_iterations; the sampler must be
+        stateless (ddpm, ddim).
+        """
+        sampler = sampler if sampler is not None else DDPMSampler(self)
+        assert sampler.stateless, "parallel sampling needs a stateless sampler"
+        timesteps = sampler.timesteps()
+        num_steps, batch_size = len(timesteps), shape[0]
+
+        # the noise in the order sample_loop draws it
+        x_T = noise_fn(size=shape, dtype=torch.float, device=device)
+        noises = torch.zeros((num_steps,) + tuple(shape), device=device)
+        if known_boxes is not None:
+            num_known = known_boxes.shape[1]
+            known_noises = torch.empty((num_steps,) + tuple(known_boxes.shape), device=device)
+        for k in range(num_steps):
+            if known_boxes is not None:
+                _randn_(noise_fn, known_noises[k])
+            if sampler.stochastic:
+                _randn_(noise_fn, noises[k])
+
+        t_all = torch.tensor([t for t, _ in timesteps], dtype=torch.int64, device=device)
+        t_next_all = torch.tensor([t_next for _, t_next in timesteps], dtype=torch.int64, device=device)
+        # squared tolerance of every step, scaled by the noise level it reaches
+        variances = 1. - self.alphas_cumprod.to(device)[t_next_all.clamp(min=0)]
+        thresholds = tolerance ** 2 * variances
+
+        # xs[k]: the current guess of the sample after k steps
+        xs = x_T[None].repeat(num_steps + 1, *([1] * len(shape)))
+        window = min(window, num_steps)
+        begin, sampler.picard_iterations = 0, 0
+        while begin < num_steps:
+            end = min(begin + window, num_steps)
+            size = end - begin
+            x_window = xs[begin:end]
+            if known_boxes is not None:
+                # the given objects diffused to the timestep of every step
+                x_window = x_window.clone()
+                t = t_all[begin:end]
+                x_window[:, :, :num_known, :] = (
+                    self.sqrt_alphas_cumprod.to(device)[t].view(-1, 1, 1, 1) * known_boxes[None] +
+                    self.sqrt_one_minus_alphas_cumprod.to(device)[t].view(-1, 1, 1, 1) * known_noises[begin:end]
+                )
+
+            window_noise = noises[begin:end].flatten(0, 1)
+            x_next, _ = sampler.step(
+                partial(denoise_fn, context_mask=context_mask.repeat(size, 1)) if context_mask is not None else denoise_fn,
+                x_window.flatten(0, 1),
+                t_all[begin:end].repeat_interleave(batch_size), t_next_all[begin:end].repeat_interleave(batch_size),
+                condition.repeat(size, *([1] * (condition.dim() - 1))) if condition is not None else None,
+                condition_cross.repeat(size, *([1] * (condition_cross.dim() - 1))) if condition_cross is not None else None,
+                noise_fn=lambda **kwargs: window_noise, clip_denoised=clip_denoised
+            )
+            sampler.picard_iterations += 1
+
+            # x_{k+1} = x_begin + the increments of the steps begin..k
+            increments = x_next.view(size, *shape) - xs[begin:end]
+            new = xs[begin][None] + increments.cumsum(dim=0)
+            errors = (new - xs[begin + 1:end + 1]).pow(2).flatten(2).mean(dim=-1).amax(dim=-1)
+            xs[begin + 1:end + 1] = new
+
+            # the first step of the window is exact, slide past the converged ones
+            failed = (errors > thresholds[begin:end]).nonzero()
+            stride = max(int(failed[0, 0]), 1) if failed.numel() > 0 else size
+            begin += stride
+            new_end = min(begin + window, num_steps)
+            if new_end > end:
+                xs[end + 1:new_end + 1] = xs[end]
+
+        img_t = xs[num_steps]
+        if known_boxes is not None:
+            img_t[:, :num_known, :] = known_boxes
+        return img_t
 
-        return ret
+    @torch.no_grad()
+    def ddim_sample_loop(self, denoise_fn, shape, device, condition, condition_cross, noise_fn=torch.randn, clip_denoised=True, sampling_timesteps=50, ddim_sampling_eta=0., return_all_timesteps = False):
+        sampler = DDIMSampler(self, num_steps=sampling_timesteps, eta=ddim_sampling_eta)
+        return self.sample_loop(denoise_fn, shape, device, condition, condition_cross, sampler=sampler, noise_fn=noise_fn,
+                                clip_denoised=clip_denoised, freq=1 if return_all_timesteps else None)
     
 
     def p_sample_loop_complete(self, denoise_fn, shape, device, condition, condition_cross,
-                      noise_fn=torch.randn, clip_denoised=True, keep_running=False, partial_boxes=None):
+                      noise_fn=torch.randn, clip_denoised=True, partial_boxes=None, sampler=None,
+                      context_mask=None):
         """
         Complete samples based on partial samples
-        keep_running: True if we run 2 x num_timesteps, False if we just run num_timesteps
+        sampler: Sampler used for the reverse process, the full DDPM chain by default
 
         """
 
-        assert isinstance(shape, (tuple, list))
-        img_t = noise_fn(size=shape, dtype=torch.float, device=device)
-        for t in reversed(range(0, self.num_timesteps if not keep_running else len(self.betas))):
-            t_ = torch.empty(shape[0], dtype=torch.int64, device=device).fill_(t)
-
-            # diffusion clean scenes
-            noise =  noise_fn(size=partial_boxes.shape, dtype=torch.float, device=device)
-            partial_boxes_t = self.q_sample(x_start=partial_boxes, t=t_, noise=noise)
-            num_partial = partial_boxes_t.shape[1]
-
-            # combine noisy version of clean scenes & denoising scenes
-            img_t = torch.cat([ partial_boxes_t, img_t[:, num_partial:, :] ], dim=1).contiguous()
+        return self.sample_loop(denoise_fn, shape, device, condition, condition_cross, sampler=sampler, noise_fn=noise_fn,
+                                clip_denoised=clip_denoised, known_boxes=partial_boxes, context_mask=context_mask)
 
-            # reverse diffusion
-            img_t = self.p_sample(denoise_fn=denoise_fn, data=img_t,t=t_, condition=condition, condition_cross=condition_cross, noise_fn=noise_fn,
-                                clip_denoised=clip_denoised, return_pred_xstart=False)
-            if t == 0:
-                print('last:', t, self.num_timesteps, len(self.betas))
-                img_t = torch.cat([ partial_boxes, img_t[:, num_partial:, :] ], dim=1).contiguous()
-
-        assert img_t.shape == shape
-        return img_t
+    def p_sample_loop_refine(self, denoise_fn, shape, device, condition, condition_cross, x_start, t_start,
+                             noise_fn=torch.randn, clip_denoised=True, num_fixed=0, sampler=None, context_mask=None):
+        """
+        Resample the layouts x_start from timestep t_start (SDEdit, https://arxiv.org/abs/2108.01073):
+        x_start is diffused to t_start with q_sample and denoised from there, which
+        costs about t_start / num_timesteps of a full generation. The first
+        num_fixed objects are kept like the given objects of the scene completion.
+        sampler: Sampler used for the reverse process, the full DDPM chain by default
+        """
+        assert 0 <= t_start < self.num_timesteps, t_start
+        known_boxes = x_start[:, :num_fixed, :] if num_fixed > 0 else None
+        return self.sample_loop(denoise_fn, shape, device, condition, condition_cross, sampler=sampler, noise_fn=noise_fn,
+                                clip_denoised=clip_denoised, known_boxes=known_boxes, x_start=x_start, t_start=t_start,
+                                context_mask=context_mask)
 
     def p_sample_loop_arrange(self, denoise_fn, shape, device, condition, condition_cross,
-                      noise_fn=torch.randn, clip_denoised=True, keep_running=False, input_boxes=None):
+                      noise_fn=torch.randn, clip_denoised=True, input_boxes=None, sampler=None,
+                      context_mask=None):
         """
         Arrangement: complete other properies based on some propeties
-        keep_running: True if we run 2 x num_timesteps, False if we just run num_timesteps
+        sampler: Sampler used for the reverse process, the full DDPM chain by default
 
         """
 
         assert isinstance(shape, (tuple, list))
-        img_t = noise_fn(size=(shape[0], shape[1], self.translation_dim+self.angle_dim), dtype=torch.float, device=device)
-        for t in reversed(range(0, self.num_timesteps if not keep_running else len(self.betas))):
-            t_ = torch.empty(shape[0], dtype=torch.int64, device=device).fill_(t)
-
-            # reverse diffusion
-            img_t = self.p_sample(denoise_fn=denoise_fn, data=img_t,t=t_, condition=condition, condition_cross=condition_cross, noise_fn=noise_fn,
-                                clip_denoised=clip_denoised, return_pred_xstart=False)
-            if t == 0:
-                print('last:', t, self.num_timesteps, len(self.betas))
-                img_t_trans = img_t[:, :, 0:self.translation_dim]
-                img_t_angle = img_t[:, :, self.translation_dim:] 
-                
-                input_boxes_trans = input_boxes[:, :, 0:self.translation_dim]
-                input_boxes_size  = input_boxes[:, :, self.translation_dim:self.translation_dim+self.size_dim]  
-                input_boxes_angle = input_boxes[:, :, self.translation_dim+self.size_dim:self.bbox_dim] 
-                input_boxes_other = input_boxes[:, :, self.bbox_dim:] 
-                img_t = torch.cat([ img_t_trans, input_boxes_size, img_t_angle, input_boxes_other ], dim=-1).contiguous()
+        img_t = self.sample_loop(denoise_fn, (shape[0], shape[1], self.translation_dim+self.angle_dim), device, condition, condition_cross,
+                                 sampler=sampler, noise_fn=noise_fn, clip_denoised=clip_denoised, context_mask=context_mask)
+
+        img_t_trans = img_t[:, :, 0:self.translation_dim]
+        img_t_angle = img_t[:, :, self.translation_dim:] 
+        
+        input_boxes_trans = input_boxes[:, :, 0:self.translation_dim]
+        input_boxes_size  = input_boxes[:, :, self.translation_dim:self.translation_dim+self.size_dim]  
+        input_boxes_angle = input_boxes[:, :, self.translation_dim+self.size_dim:self.bbox_dim] 
+        input_boxes_other = input_boxes[:, :, self.bbox_dim:] 
+        img_t = torch.cat([ img_t_trans, input_boxes_size, img_t_angle, input_boxes_other ], dim=-1).contiguous()
 
         assert img_t.shape == shape
         return img_t
@@ -555,14 +822,16 @@ class GaussianDiffusion:
             assert denoise_out.shape == data_start.shape
             #losses = ((target - denoise_out)**2).mean(dim=list(range(1, len(data_start.shape))))
 
+            # a single squared-error pass, reduced per attribute segment
+            num_points = data_start[0, ..., 0].numel()
             if self.room_arrange_condition:
                 assert data_start.shape[-1] == self.translation_dim + self.angle_dim
-                loss_trans = ((target[:, :, 0:self.translation_dim]  - denoise_out[:, :, 0:self.translation_dim])**2).mean(dim=list(range(1, len(data_start.shape))))
-                loss_angle = ((target[:, :, self.translation_dim:]  - denoise_out[:, :, self.translation_dim:])**2).mean(dim=list(range(1, len(data_start.shape))))
+                sq_err_c, _, seg_loss = self._segment_losses((target - denoise_out)**2)
+                loss_trans, loss_angle = seg_loss['trans'], seg_loss['angle']
                 if self.loss_separate:
                     losses = loss_trans + loss_angle
                 else:
-                    losses = ((target - denoise_out)**2).mean(dim=list(range(1, len(data_start.shape))))
+                    losses = sq_err_c.sum(dim=1) / (num_points * data_start.shape[-1])
                 losses_weight = losses * self._extract(self.loss_weight.to(losses.device), t, losses.shape).to(losses.device)
                 return losses_weight, {
                     'loss.trans': loss_trans.mean(),
@@ -570,20 +839,23 @@ class GaussianDiffusion:
                 }
 
             elif data_start.shape[-1] == self.objectness_dim+self.class_dim+self.bbox_dim+self.objfeat_dim:
-                loss_trans = ((target[:, :, 0:self.translation_dim]  - denoise_out[:, :, 0:self.translation_dim])**2).mean(dim=list(range(1, len(data_start.shape))))
-                loss_size  = ((target[:, :, self.translation_dim:self.translation_dim+self.size_dim]  - denoise_out[:, :, self.translation_dim:self.translation_dim+self.size_dim])**2).mean(dim=list(range(1, len(data_start.shape))))
-                loss_angle = ((target[:, :, self.translation_dim+self.size_dim:self.bbox_dim]  - denoise_out[:, :, self.translation_dim+self.size_dim:self.bbox_dim])**2).mean(dim=list(range(1, len(data_start.shape))))
-                loss_bbox  = ((target[:, :, 0:self.bbox_dim]  - denoise_out[:, :, 0:self.bbox_dim])**2).mean(dim=list(range(1, len(data_start.shape))))
-                loss_class = ((target[:, :, self.bbox_dim:self.bbox_dim+self.class_dim]  - denoise_out[:, :, self.bbox_dim:self.bbox_dim+self.class_dim])**2).mean(dim=list(range(1, len(data_start.shape))))
+                sq_err_c, seg_sum, seg_loss = self._segment_losses((target - denoise_out)**2)
+                loss_trans = seg_loss['trans']
+                loss_size  = seg_loss['size']
+                loss_angle = seg_loss['angle']
+                # the first three segments are translation, size and angle
+                loss_bbox  = seg_sum[:, 0:3].sum(dim=1) / (num_points * self.bbox_dim)
+                loss_class = seg_loss['class']
                 if self.objectness_dim == 0:
-                    loss_object = ((target[:, :, self.bbox_dim+self.class_dim-1:self.bbox_dim+self.class_dim ] - denoise_out[:, :, self.bbox_dim+self.class_dim-1:self.bbox_dim+self.class_dim ])**2).mean(dim=list(range(1, len(data_start.shape))))
+                    # the last class channel encodes the empty (end) label
+                    loss_object = sq_err_c[:, self.bbox_dim+self.class_dim-1] / num_points
                 else:
-                    loss_object = ((target[:, :, self.bbox_dim+self.class_dim:self.bbox_dim+self.class_dim+self.objectness_dim ] - denoise_out[:, :, self.bbox_dim+self.class_dim:self.bbox_dim+self.class_dim+self.objectness_dim ])**2).mean(dim=list(range(1, len(data_start.shape))))
+                    loss_object = seg_loss['object']
 
                 if self.objfeat_dim == 0:
                     loss_objfeat = torch.zeros(B).to(data_start.device)
                 else:
-                    loss_objfeat =  ((target[:, :, self.bbox_dim+self.class_dim+self.objectness_dim: ] - denoise_out[:, :, self.bbox_dim+self.class_dim+self.objectness_dim: ])**2).mean(dim=list(range(1, len(data_start.shape))))
+                    loss_objfeat = seg_loss['objfeat']
                     
                     
                 if self.loss_separate:
@@ -593,7 +865,7 @@ class GaussianDiffusion:
                     if self.objfeat_dim > 0:
                         losses += loss_objfeat
                 else:
-                    losses = ((target - denoise_out)**2).mean(dim=list(range(1, len(data_start.shape))))
+                    losses = sq_err_c.sum(dim=1) / (num_points * data_start.shape[-1])
                 #####
                 losses_weight = losses * self._extract(self.loss_weight.to(losses.device), t, losses.shape)
 
@@ -623,19 +895,18 @@ class GaussianDiffusion:
                     # get the bbox corners
                     axis_aligned_bbox_corn = torch.cat([ descale_trans - descale_sizes, descale_trans + descale_sizes], dim=-1)
                     assert axis_aligned_bbox_corn.shape[-1] == 6
-                    # compute iou
-                    bbox_iou = axis_aligned_bbox_overlaps_3d(axis_aligned_bbox_corn, axis_aligned_bbox_corn)
-                    bbox_iou_mask = valid_mask[:, :, None] * valid_mask[:, None, :]
-                    bbox_iou_valid = bbox_iou * bbox_iou_mask
-                    bbox_iou_valid_avg = bbox_iou_valid.sum( dim=list(range(1, len(bbox_iou_valid.shape))) ) / ( bbox_iou_mask.sum( dim=list(range(1, len(bbox_iou_valid.shape))) ) + 1e-6)
+                    # compute iou over the upper triangle of valid pairs only; the full
+                    # (symmetric) BxNxN sum is 2 * upper triangle + diagonal
+                    pairwise = axis_aligned_bbox_pairwise_overlaps_3d(axis_aligned_bbox_corn, valid_mask)
+                    self_iou = axis_aligned_bbox_self_ious_3d(axis_aligned_bbox_corn) * valid_mask
+                    bbox_iou_valid_sum = 2 * pairwise.ious.sum(dim=1) + self_iou.sum(dim=1)
+                    bbox_iou_mask_sum = 2 * pairwise.pair_mask.sum(dim=1) + valid_mask.sum(dim=1)
+                    bbox_iou_valid_avg = bbox_iou_valid_sum / ( bbox_iou_mask_sum + 1e-6)
                     # get the iou loss weight w.r.t time
-                    w_iou = self._extract(self.alphas_cumprod.to(data_start.device), t, bbox_iou.shape)
-                    loss_iou = (w_iou * 0.1 * bbox_iou).mean(dim=list(range(1, len(w_iou.shape))))
-                    loss_iou_valid_avg = (w_iou * 0.1 * bbox_iou_valid).sum( dim=list(range(1, len(bbox_iou_valid.shape))) ) / ( bbox_iou_mask.sum( dim=list(range(1, len(bbox_iou_valid.shape))) ) + 1e-6)
+                    w_iou = self._extract(self.alphas_cumprod.to(data_start.device), t, bbox_iou_valid_sum.shape)
+                    loss_iou_valid_avg = (w_iou * 0.1 * bbox_iou_valid_sum) / ( bbox_iou_mask_sum + 1e-6)
                     losses_weight += loss_iou_valid_avg
                 else:
-                    loss_iou = torch.zeros(B).to(data_start.device)
-                    bbox_iou = torch.zeros(B).to(data_start.device)
                     loss_iou_valid_avg = torch.zeros(B).to(data_start.device)
                     bbox_iou_valid_avg = torch.zeros(B).to(data_start.device)
                     
@@ -663,6 +934,40 @@ class GaussianDiffusion:
 
         assert losses.shape == torch.Size([B])
         return losses
+
+    def p_losses_distill(self, denoise_fn, teacher_denoise_fn, data_start, t, t_mid, t_next, noise=None,
+                         condition=None, condition_cross=None, teacher_condition=None, teacher_condition_cross=None):
+        """
+        Progressive distillation (https://arxiv.org/abs/2202.00512): the student
+        matches in one deterministic DDIM step t -> t_next what the teacher does
+        in two, t -> t_mid -> t_next (one where t_mid == t_next). t_next == -1
+        stands for x_0.
+        """
+        B = data_start.shape[0]
+        if noise is None:
+            noise = torch.randn(data_start.shape, dtype=data_start.dtype, device=data_start.device)
+        data_t = self.q_sample(x_start=data_start, t=t, noise=noise)
+
+        teacher = DDIMSampler(self, eta=0.)
+        with torch.no_grad():
+            data_mid, _ = teacher.step(teacher_denoise_fn, data_t, t, t_mid, teacher_condition, teacher_condition_cross, clip_denoised=False)
+            data_next, _ = teacher.step(teacher_denoise_fn, data_mid, t_mid, t_next, teacher_condition, teacher_condition_cross, clip_denoised=False)
+            data_next = torch.where(torch.reshape(t_mid == t_next, [B] + [1] * (len(data_t.shape) - 1)), data_mid, data_next)
+
+            # the x_0 that takes data_t to data_next in a single DDIM step
+            alpha_bar, alpha_bar_next = teacher._alphas_cumprod(t, data_t), teacher._alphas_cumprod(t_next, data_t)
+            ratio = ((1 - alpha_bar_next) / (1 - alpha_bar)).sqrt()
+            target = (data_next - ratio * data_t) / (alpha_bar_next.sqrt() - ratio * alpha_bar.sqrt())
+
+        pred_x_start = self.model_predictions(denoise_fn, data_t, t, condition, condition_cross).pred_x_start
+        # truncated SNR weighting, max(snr, 1)
+        weight = (alpha_bar / (1 - alpha_bar)).clamp(min=1.)
+        losses = (weight * (pred_x_start - target) ** 2).mean(dim=list(range(1, len(data_start.shape))))
+
+        assert losses.shape == torch.Size([B])
+        return losses, {
+            'loss.distill': losses.mean(),
+        }
                    
     
     def descale_to_origin(self, x, minimum, maximum):
@@ -674,6 +979,16 @@ class GaussianDiffusion:
         x = x * (maximum - minimum)[None, None, :] + minimum[None, None, :]
         return x
 
+    def emptiness(self, x):
+        '''
+            How empty the object slots of x (BxNxC) are, an empty slot is > 0:
+            the negated objectness channel, or the empty (last) class channel
+            without objectness channel
+        '''
+        if self.objectness_dim > 0:
+            return -x[..., self.bbox_dim+self.class_dim]
+        return x[..., self.bbox_dim+self.class_dim-1]
+
     '''debug'''
 
     def _prior_bpd(self, x_start):
@@ -687,35 +1002,85 @@ class GaussianDiffusion:
             assert kl_prior.shape == x_start.shape
             return kl_prior.mean(dim=list(range(1, len(kl_prior.shape)))) / np.log(2.)
 
-    def calc_bpd_loop(self, denoise_fn, x_start, condition, condition_cross, clip_denoised=True):
+    def _vb_terms_bt(self, denoise_fn, x_start, t_bk, condition, condition_cross, clip_denoised=True, max_batch_size=1024):
+        """
+        VLB terms (bpd) and x_0 MSE of every layout b at the timesteps t_bk[b, :],
+        both of shape [B, K]. Several timesteps are stacked along the batch
+        dimension so that each model call sees up to max_batch_size samples.
+        """
+        B, K = t_bk.shape
+        chunk = max(1, max_batch_size // B)
+        repeat = lambda x, k: None if x is None else x.repeat(k, *([1] * (len(x.shape) - 1)))
+
+        vals_bk, mse_bk = [], []
+        for k in range(0, K, chunk):
+            # [k0 for all b, k1 for all b, ...]
+            t_ = t_bk[:, k:k+chunk].t().reshape(-1)
+            n = t_.shape[0] // B
+            x_start_ = repeat(x_start, n)
+            vals, pred_xstart = self._vb_terms_bpd(
+                denoise_fn, data_start=x_start_, data_t=self.q_sample(x_start=x_start_, t=t_), t=t_,
+                condition=repeat(condition, n), condition_cross=repeat(condition_cross, n),
+                clip_denoised=clip_denoised, return_pred_xstart=True)
+            mse = ((pred_xstart - x_start_) ** 2).mean(dim=list(range(1, len(x_start.shape))))
+            vals_bk.append(vals.reshape(n, B).t())
+            mse_bk.append(mse.reshape(n, B).t())
+
+        return torch.cat(vals_bk, dim=1), torch.cat(mse_bk, dim=1)
+
+    def calc_bpd_loop(self, denoise_fn, x_start, condition, condition_cross, clip_denoised=True, max_batch_size=1024):
 
         with torch.no_grad():
             B, T = x_start.shape[0], self.num_timesteps
 
-            vals_bt_, mse_bt_= torch.zeros([B, T], device=x_start.device), torch.zeros([B, T], device=x_start.device)
-            for t in reversed(range(T)):
-
-                t_b = torch.empty(B, dtype=torch.int64, device=x_start.device).fill_(t)
-                # Calculate VLB term at the current timestep
-                new_vals_b, pred_xstart = self._vb_terms_bpd(
-                    denoise_fn, data_start=x_start, data_t=self.q_sample(x_start=x_start, t=t_b), t=t_b, condition=condition, condition_cross=condition_cross,
-                    clip_denoised=clip_denoised, return_pred_xstart=True)
-                # MSE for progressive prediction loss
-                assert pred_xstart.shape == x_start.shape
-                new_mse_b = ((pred_xstart-x_start)**2).mean(dim=list(range(1, len(x_start.shape))))
-                assert new_vals_b.shape == new_mse_b.shape ==  torch.Size([B])
-                # Insert the calculated term into the tensor of all terms
-                mask_bt = t_b[:, None]==torch.arange(T, device=t_b.device)[None, :].float()
-                vals_bt_ = vals_bt_ * (~mask_bt) + new_vals_b[:, None] * mask_bt
-                mse_bt_ = mse_bt_ * (~mask_bt) + new_mse_b[:, None] * mask_bt
-                assert mask_bt.shape == vals_bt_.shape == vals_bt_.shape == torch.Size([B, T])
+            t_bt = torch.arange(T, device=x_start.device)[None, :].repeat(B, 1)
+            vals_bt_, mse_bt_ = self._vb_terms_bt(denoise_fn, x_start, t_bt, condition, condition_cross,
+                                                  clip_denoised=clip_denoised, max_batch_size=max_batch_size)
 
             prior_bpd_b = self._prior_bpd(x_start)
             total_bpd_b = vals_bt_.sum(dim=1) + prior_bpd_b
             assert vals_bt_.shape == mse_bt_.shape == torch.Size([B, T]) and \
                    total_bpd_b.shape == prior_bpd_b.shape ==  torch.Size([B])
             return total_bpd_b.mean(), vals_bt_.mean(), prior_bpd_b.mean(), mse_bt_.mean()
-        
+
+    def calc_bpd_importance(self, denoise_fn, x_start, condition, condition_cross, num_samples=16, proposal=None,
+                            clip_denoised=True, max_batch_size=1024):
+        """
+        Unbiased estimate of the total bpd of every layout from num_samples
+        timesteps drawn from proposal (uniform by default), i.e. num_samples
+        instead of num_timesteps model evaluations per layout:
+            sum_t L_t = E_{t ~ p}[L_t / p(t)]
+        Returns the total and the prior bpd, both of shape [B].
+        """
+        with torch.no_grad():
+            B, T = x_start.shape[0], self.num_timesteps
+            if proposal is None:
+                proposal = torch.ones(T)
+            proposal = (proposal / proposal.sum()).to(x_start.device)
+
+            t_bk = torch.multinomial(proposal[None, :].expand(B, T), num_samples, replacement=True)
+            vals_bk, _ = self._vb_terms_bt(denoise_fn, x_start, t_bk, condition, condition_cross,
+                                           clip_denoised=clip_denoised, max_batch_size=max_batch_size)
+
+            prior_bpd_b = self._prior_bpd(x_start)
+            total_bpd_b = (vals_bk / proposal[t_bk]).mean(dim=1) + prior_bpd_b
+            assert total_bpd_b.shape == prior_bpd_b.shape == torch.Size([B])
+            return total_bpd_b, prior_bpd_b
+
+    def vlb_proposal(self, denoise_fn, x_start, condition, condition_cross, clip_denoised=True, max_batch_size=1024, uniform_weight=0.01):
+        """
+        Importance sampling proposal p(t) ~ sqrt(E[L_t^2]) (https://arxiv.org/abs/2102.09672),
+        estimated from the exact VLB terms of a few layouts and mixed with the
+        uniform distribution so that no timestep has zero probability.
+        """
+        with torch.no_grad():
+            B, T = x_start.shape[0], self.num_timesteps
+            t_bt = torch.arange(T, device=x_start.device)[None, :].repeat(B, 1)
+            vals_bt, _ = self._vb_terms_bt(denoise_fn, x_start, t_bt, condition, condition_cross,
+                                           clip_denoised=clip_denoised, max_batch_size=max_batch_size)
+            proposal = (vals_bt ** 2).mean(dim=0).sqrt()
+            proposal = proposal / proposal.sum()
+            return (1 - uniform_weight) * proposal + uniform_weight / T
 
 
 class DiffusionPoint(nn.Module):
@@ -734,8 +1099,9 @@ class DiffusionPoint(nn.Module):
     def prior_kl(self, x0):
         return self.diffusion._prior_bpd(x0)
 
-    def all_kl(self, x0, condition, condition_cross, clip_denoised=True):
-        total_bpd_b, vals_bt, prior_bpd_b, mse_bt =  self.diffusion.calc_bpd_loop(self._denoise, x0,  condition, condition_cross, clip_denoised)
+    def all_kl(self, x0, condition, condition_cross, clip_denoised=True, max_batch_size=1024):
+        total_bpd_b, vals_bt, prior_bpd_b, mse_bt =  self.diffusion.calc_bpd_loop(self._denoise, x0,  condition, condition_cross, clip_denoised,
+                                                                                  max_batch_size=max_batch_size)
 
         return {
             'total_bpd_b': total_bpd_b,
@@ -744,18 +1110,33 @@ class DiffusionPoint(nn.Module):
             'mse_bt':mse_bt
         }
 
+    def bpd_estimate(self, x0, condition, condition_cross, num_samples=16, proposal=None, clip_denoised=True, max_batch_size=1024):
+        total_bpd_b, prior_bpd_b = self.diffusion.calc_bpd_importance(self._denoise, x0, condition, condition_cross, num_samples=num_samples,
+                                                                      proposal=proposal, clip_denoised=clip_denoised, max_batch_size=max_batch_size)
+
+        return {
+            'total_bpd_b': total_bpd_b,
+            'prior_bpd_b': prior_bpd_b,
+        }
+
+    def vlb_proposal(self, x0, condition, condition_cross, clip_denoised=True, max_batch_size=1024):
+        return self.diffusion.vlb_proposal(self._denoise, x0, condition, condition_cross, clip_denoised, max_batch_size=max_batch_size)
 
-    def _denoise(self, data, t, condition, condition_cross):
+
+    def _denoise(self, data, t, condition, condition_cross, deep_cache=None, mask=None, context_mask=None):
         B, D,N= data.shape
         assert data.dtype == torch.float
         assert t.shape == torch.Size([B]) and t.dtype == torch.int64
 
-        out = self.model(data, t, condition, condition_cross)
+        # the optional sampling inputs, only given to the denoiser when used
+        kwargs = {k: v for k, v in [("deep_cache", deep_cache), ("mask", mask), ("context_mask", context_mask)] if v is not None}
+        out = self.model(data, t, condition, condition_cross, **kwargs)
         
         assert out.shape == torch.Size([B, D, N])
         return out
 
-    def get_loss_iter(self, data, noises=None, condition=None, condition_cross=None):
+    def get_loss_iter(self, data, noises=None, condition=None, condition_cross=None, mask=None):
+        """mask: optional (B, N) bool of the valid slots, the others are masked as attention keys"""
         
         if len(data.shape) == 3:
             B, D, N = data.shape
@@ -766,23 +1147,39 @@ class DiffusionPoint(nn.Module):
         if noises is not None:
             noises[t!=0] = torch.randn((t!=0).sum(), *noises.shape[1:]).to(noises)
 
+        denoise_fn = partial(self._denoise, mask=mask) if mask is not None else self._denoise
         losses, loss_dict = self.diffusion.p_losses(
-            denoise_fn=self._denoise, data_start=data, t=t, noise=noises, condition=condition, condition_cross=condition_cross)
+            denoise_fn=denoise_fn, data_start=data, t=t, noise=noises, condition=condition, condition_cross=condition_cross)
+        assert losses.shape == t.shape == torch.Size([B])
+        return losses.mean(), loss_dict
+
+    def get_distill_loss_iter(self, teacher, data, distillation_grid, condition=None, condition_cross=None,
+                              teacher_condition=None, teacher_condition_cross=None):
+        """
+        distillation_grid: int64 tensor of (t, t_mid, t_next) rows, one per student step
+        """
+        B = data.shape[0]
+        distillation_grid = distillation_grid.to(data.device)
+        steps = torch.randint(0, distillation_grid.shape[0], size=(B,), device=data.device)
+        t, t_mid, t_next = distillation_grid[steps].unbind(dim=-1)
+
+        losses, loss_dict = self.diffusion.p_losses_distill(
+            denoise_fn=self._denoise, teacher_denoise_fn=teacher._denoise, data_start=data, t=t, t_mid=t_mid, t_next=t_next,
+            condition=condition, condition_cross=condition_cross,
+            teacher_condition=teacher_condition, teacher_condition_cross=teacher_condition_cross)
         assert losses.shape == t.shape == torch.Size([B])
         return losses.mean(), loss_dict
     
 
     def gen_samples(self, shape, device, condition=None, condition_cross=None, noise_fn=torch.randn,
-                    clip_denoised=True, keep_running=False):
+                    clip_denoised=True, sampler=None, context_mask=None):
         return self.diffusion.p_sample_loop(self._denoise, shape=shape, device=device, condition=condition, condition_cross=condition_cross, noise_fn=noise_fn,
-                                            clip_denoised=clip_denoised,
-                                            keep_running=keep_running)
+                                            clip_denoised=clip_denoised, sampler=sampler, context_mask=context_mask)
 
     def gen_sample_traj(self, shape, device, freq, condition=None, condition_cross=None, noise_fn=torch.randn,
-                    clip_denoised=True,keep_running=False):
+                    clip_denoised=True, sampler=None, context_mask=None):
         return self.diffusion.p_sample_loop_trajectory(self._denoise, shape=shape, device=device, condition=condition, condition_cross=condition_cross, noise_fn=noise_fn, freq=freq,
-                                                       clip_denoised=clip_denoised,
-                                                       keep_running=keep_running)
+                                                       clip_denoised=clip_denoised, sampler=sampler, context_mask=context_mask)
     
 
     def gen_samples_ddim(self, shape, device, condition=None, condition_cross=None, noise_fn=torch.randn,
@@ -791,14 +1188,18 @@ class DiffusionPoint(nn.Module):
                                             clip_denoised=clip_denoised, sampling_timesteps=sampling_timesteps, ddim_sampling_eta=ddim_sampling_eta, return_all_timesteps=return_all_timesteps)
     
     def complete_samples(self, shape, device, condition=None, condition_cross=None, noise_fn=torch.randn,
-                    clip_denoised=True, keep_running=False, partial_boxes=None):
+                    clip_denoised=True, partial_boxes=None, sampler=None, context_mask=None):
         return self.diffusion.p_sample_loop_complete(self._denoise, shape=shape, device=device, condition=condition, condition_cross=condition_cross, noise_fn=noise_fn,
-                                            clip_denoised=clip_denoised,
-                                            keep_running=keep_running, partial_boxes=partial_boxes)
+                                            clip_denoised=clip_denoised, partial_boxes=partial_boxes, sampler=sampler, context_mask=context_mask)
+
+    def refine_samples(self, shape, device, x_start, t_start, condition=None, condition_cross=None, noise_fn=torch.randn,
+                       clip_denoised=True, num_fixed=0, sampler=None, context_mask=None):
+        return self.diffusion.p_sample_loop_refine(self._denoise, shape=shape, device=device, condition=condition, condition_cross=condition_cross,
+                                                   x_start=x_start, t_start=t_start, noise_fn=noise_fn, clip_denoised=clip_denoised,
+                                                   num_fixed=num_fixed, sampler=sampler, context_mask=context_mask)
 
     def arrange_samples(self, shape, device, condition=None, condition_cross=None, noise_fn=torch.randn,
-                    clip_denoised=True, keep_running=False, input_boxes=None):
+                    clip_denoised=True, input_boxes=None, sampler=None, context_mask=None):
         
         return self.diffusion.p_sample_loop_arrange(self._denoise, shape=shape, device=device, condition=condition, condition_cross=condition_cross, noise_fn=noise_fn,
-                                            clip_denoised=clip_denoised,
-                                            keep_running=keep_running, input_boxes=input_boxes)
\ No newline at end of file
+                                            clip_denoised=clip_denoised, input_boxes=input_boxes, sampler=sampler, context_mask=context_mask)
\ No newline at end of file
@@ -1,11 +1,16 @@
+import json
+from collections import OrderedDict
 from curses import noecho
 from doctest import debug_script
 import torch
 import torch.nn as nn
 from torch.nn import Module
 from torch.nn.utils import clip_grad_norm_
+from torch.nn.utils.rnn import pad_sequence
 
 from .diffusion_ddpm import DiffusionPoint
+from .inference import inference_sampler_factory
+from .samplers import Sampler
 from .denoise_net import Unet1D
 from ..stats_logger import StatsLogger
 from transformers import BertTokenizer, BertModel
@@ -54,6 +59,9 @@ class DiffusionSceneLayout_DDPM(Module):
 
         else:
             print('NOT use room and text as condition')
+        # sampling: the encoded prompts, LRU of at most text_cache_size entries keyed by normalized prompt
+        self.text_cache_size = config.get("text_cache_size", 1024)
+        self._text_cache = OrderedDict()
 
         # define the denoising network
         if config["net_type"] == "unet1d":
@@ -69,6 +77,11 @@ class DiffusionSceneLayout_DDPM(Module):
         )
         self.n_classes = n_classes
         self.config = config
+        # reverse process used for sampling, e.g. {"type": "ddim", "num_steps": 50}
+        # or {"type": "ddpm", "num_steps": 100, "backend": "jit", "cache_dir": "..."}
+        self.sampler_config = config.get("sampler", None)
+        # the samplers of the jit / compile / onnx backends, built once per config
+        self._backend_samplers = {}
         
         # read object property dimension
         self.objectness_dim = config.get("objectness_dim", 1)
@@ -83,6 +96,9 @@ class DiffusionSceneLayout_DDPM(Module):
         self.learnable_embedding = config.get("learnable_embedding", False)
         self.instance_condition = config.get("instance_condition", False)
         self.sample_num_points = config.get("sample_num_points", 12)
+        # mask_padding: the slots past the objects of a scene are masked as attention keys in
+        # training, for batches padded to their longest scene (pair with the prune_empty sampling)
+        self.mask_padding = config.get("mask_padding", False)
         self.instance_emb_dim = config.get("instance_emb_dim", 64)
         
         if self.learnable_embedding:
@@ -129,6 +145,38 @@ class DiffusionSceneLayout_DDPM(Module):
             self.arrange_emb_dim = 0
 
     def get_loss(self, sample_params):
+        room_layout_target, condition, condition_cross = self.get_diffusion_inputs(sample_params)
+        mask = self.padding_mask(sample_params, room_layout_target.shape[1]) if self.mask_padding else None
+
+        # denoise loss function
+        loss, loss_dict = self.diffusion.get_loss_iter(room_layout_target, condition=condition, condition_cross=condition_cross, mask=mask)
+
+        return loss, loss_dict
+
+    def get_distillation_loss(self, sample_params, teacher, distillation_grid):
+        """
+        Progressive distillation loss of this (student) network against a
+        teacher of the same architecture, see GaussianDiffusion.p_losses_distill
+        """
+        room_layout_target, condition, condition_cross = self.get_diffusion_inputs(sample_params)
+        with torch.no_grad():
+            _, teacher_condition, teacher_condition_cross = teacher.get_diffusion_inputs(sample_params)
+
+        loss, loss_dict = self.diffusion.get_distill_loss_iter(
+            teacher.diffusion, room_layout_target, distillation_grid, condition=condition, condition_cross=condition_cross,
+            teacher_condition=teacher_condition, teacher_condition_cross=teacher_condition_cross)
+
+        return loss, loss_dict
+
+    def padding_mask(self, sample_params, num_points):
+        """(B, num_points) bool of the slots holding an object of the scene (at least one)."""
+        lengths = sample_params["length"].clamp(min=1)
+        return torch.arange(num_points, device=lengths.device)[None, :] < lengths[:, None]
+
+    def get_diffusion_inputs(self, sample_params):
+        """
+        Diffusion target and the (cross attention) condition of a batch
+        """
         # Unpack the sample_params
         if self.objectness_dim >0:
             objectness   = sample_params["objectness"]
@@ -171,10 +219,11 @@ class DiffusionSceneLayout_DDPM(Module):
         # process instance & class condition f
         if self.instance_condition:
             if self.learnable_embedding:
-                instance_indices = torch.arange(self.sample_num_points).long().to(device)[None, :].repeat(batch_size, 1)
+                # batches padded to their longest scene only use the first num_points slots
+                instance_indices = torch.arange(num_points).long().to(device)[None, :].repeat(batch_size, 1)
                 instan_condition_f = self.positional_embedding[instance_indices, :]
             else:
-                instance_label = torch.eye(self.sample_num_points).float().to(device)[None, ...].repeat(batch_size, 1, 1)
+                instance_label = torch.eye(self.sample_num_points).float().to(device)[None, :num_points].repeat(batch_size, 1, 1)
                 instan_condition_f = self.fc_instance_condition(instance_label) 
         else:
             instan_condition_f = None
@@ -192,8 +241,9 @@ class DiffusionSceneLayout_DDPM(Module):
 
         # concat room_partial  condition
         if self.room_partial_condition:
-            partial_valid   = torch.ones((batch_size, self.partial_num_points, 1)).float().to(device)
-            partial_invalid = torch.zeros((batch_size, num_points - self.partial_num_points, 1)).float().to(device)
+            partial_num_points = min(self.partial_num_points, num_points)
+            partial_valid   = torch.ones((batch_size, partial_num_points, 1)).float().to(device)
+            partial_invalid = torch.zeros((batch_size, num_points - partial_num_points, 1)).float().to(device)
             partial_mask    = torch.cat([ partial_valid, partial_invalid ], dim=1).contiguous()
             partial_input   = room_layout_target * partial_mask
             partial_condition_f = self.fc_partial_condition(partial_input)
@@ -220,15 +270,89 @@ class DiffusionSceneLayout_DDPM(Module):
         else:
             condition_cross = None
 
-        # denoise loss function
-        loss, loss_dict = self.diffusion.get_loss_iter(room_layout_target, condition=condition, condition_cross=condition_cross)
+        return room_layout_target, condition, condition_cross
 
-        return loss, loss_dict
+    def train(self, mode=True):
+        # the cached prompt encodings and compiled denoisers are only valid for the current weights
+        self._text_cache.clear()
+        self._backend_samplers.clear()
+        return super().train(mode)
+
+    @staticmethod
+    def normalize_text(text):
+        # the tokenizers ignore repeated and surrounding whitespace
+        return " ".join(text.split())
+
+    @torch.no_grad()
+    def encode_text(self, text, device):
+        """
+        Encode the prompts text (a string or a list of strings, the GloVe
+        embeddings with text_glove_embedding) for the cross attention of the
+        sampling. Returns condition_cross and the (B, L) bool mask of its valid
+        tokens, None when all the prompts have the same length.
+        The prompts missing from the LRU cache of the network are tokenized
+        together, padded to the longest one, and encoded by a single forward of
+        BERT / CLIP; they are cached without their padding, so a prompt is
+        encoded as if alone whatever batch it comes with, and repeated prompts
+        are not encoded again.
+        """
+        if self.text_glove_embedding:
+            return self.fc_text_f(text), None
+        keys = [self.normalize_text(t) for t in ([text] if isinstance(text, str) else text)]
+
+        encoded = {}
+        for key in keys:
+            if key in self._text_cache:
+                self._text_cache.move_to_end(key)
+                encoded[key] = self._text_cache[key]
+        missing = list(OrderedDict.fromkeys(key for key in keys if key not in encoded))
+        if missing:
+            if self.text_clip_embedding:
+                # CLIP has a fixed context, its text feature is pooled to one vector
+                text_f = self.clip_model.encode_text(clip.tokenize(missing).to(device))
+                encoded.update((key, f.clone()) for key, f in zip(missing, text_f))
+            else:
+                tokenized = self.tokenizer(missing, return_tensors='pt', padding=True).to(device)
+                text_f = self.fc_text_f(self.bertmodel(**tokenized).last_hidden_state)
+                lengths = tokenized["attention_mask"].sum(dim=1).tolist()
+                encoded.update((key, f[:n].clone()) for key, f, n in zip(missing, text_f, lengths))
+            if not self.training:
+                for key in missing:
+                    self._text_cache[key] = encoded[key]
+                while len(self._text_cache) > self.text_cache_size:
+                    self._text_cache.popitem(last=False)
+
+        text_f = [encoded[key] for key in keys]
+        if self.text_clip_embedding:
+            return torch.stack(text_f), None
+        lengths = torch.tensor([f.shape[0] for f in text_f], device=device)
+        condition_cross = pad_sequence(text_f, batch_first=True)
+        if bool((lengths == lengths[0]).all()):
+            return condition_cross, None
+        return condition_cross, torch.arange(condition_cross.shape[1], device=device)[None, :] < lengths[:, None]
+
+    def get_sampler(self, sampler=None):
+        """Build the sampler from the given config, falling back to the network config (the backend ones once)."""
+        if isinstance(sampler, Sampler):
+            return sampler
+        if sampler is None:
+            sampler = self.sampler_config
+        if sampler is None or sampler.get("backend", "eager") == "eager":
+            return inference_sampler_factory(self.diffusion.diffusion, self.diffusion.model, sampler, net_config=self.config["net_kwargs"])
+        # reused across the sample calls, so that the denoiser is not traced / exported / loaded again
+        key = json.dumps(sampler, sort_keys=True, default=str)
+        if key not in self._backend_samplers:
+            self._backend_samplers[key] = inference_sampler_factory(
+                self.diffusion.diffusion, self.diffusion.model, sampler, net_config=self.config["net_kwargs"])
+        return self._backend_samplers[key]
 
     def sample(self, room_mask, num_points, point_dim, batch_size=1, text=None, 
                partial_boxes=None, input_boxes=None, ret_traj=False, ddim=False, clip_denoised=False, freq=40, batch_seeds=None, 
-                ):
+               sampler=None, refine_boxes=None, t_start=None, num_fixed=0, num_samples_per_condition=1):
         device = room_mask.device
+        if refine_boxes is not None and num_fixed > 0:
+            # the kept objects condition the network like the given objects of the scene completion
+            partial_boxes = refine_boxes[:, :num_fixed, :]
         noise = torch.randn((batch_size, num_points, point_dim))#, device=room_mask.device)
 
         # get the latent feature of room_mask
@@ -275,52 +399,80 @@ class DiffusionSceneLayout_DDPM(Module):
             condition = torch.cat([condition, arrange_condition_f], dim=-1).contiguous()
 
 
+        context_mask = None
         if self.text_condition:
-            if self.text_glove_embedding:
-                condition_cross = self.fc_text_f(text) #sample_params["desc_emb"]
-            elif self.text_clip_embedding:
-                tokenized = clip.tokenize(text).to(device)
-                condition_cross = self.clip_model.encode_text(tokenized)
-            else:
-                tokenized = self.tokenizer(text, return_tensors='pt',padding=True).to(device)
-                #print('tokenized:', tokenized.shape)
-                text_f = self.bertmodel(**tokenized).last_hidden_state
-                print('after bert:', text_f.shape)
-                condition_cross = self.fc_text_f( text_f )
+            # batched, cached encoding of the prompts, see encode_text
+            condition_cross, context_mask = self.encode_text(text, device)
         else:
             condition_cross = None
             
 
-        if input_boxes is not None:
+        shape = noise.shape
+        if num_samples_per_condition > 1:
+            # the conditions are encoded once, each one is sampled with num_samples_per_condition noise seeds
+            shape = (shape[0] * num_samples_per_condition,) + tuple(shape[1:])
+            repeat = lambda v: v.repeat_interleave(num_samples_per_condition, dim=0) if v is not None else None
+            condition, condition_cross, context_mask = repeat(condition), repeat(condition_cross), repeat(context_mask)
+            partial_boxes, input_boxes, refine_boxes = repeat(partial_boxes), repeat(input_boxes), repeat(refine_boxes)
+
+        # the ddim flag stays unused, DDIM sampling is selected with sampler={"type": "ddim", ...}
+        sampler = self.get_sampler(sampler)
+
+        if refine_boxes is not None:
+            print('scene refinement sampling from timestep {}'.format(t_start))
+            samples = self.diffusion.refine_samples(shape, room_mask.device, x_start=refine_boxes, t_start=t_start, condition=condition,
+                                                    condition_cross=condition_cross, clip_denoised=clip_denoised, num_fixed=num_fixed,
+                                                    sampler=sampler, context_mask=context_mask)
+
+        elif input_boxes is not None:
             print('scene arrangement sampling')
-            samples = self.diffusion.arrange_samples(noise.shape, room_mask.device, condition=condition, condition_cross=condition_cross, clip_denoised=clip_denoised, input_boxes=input_boxes)
+            samples = self.diffusion.arrange_samples(shape, room_mask.device, condition=condition, condition_cross=condition_cross, clip_denoised=clip_denoised, input_boxes=input_boxes,
+                                                     sampler=sampler, context_mask=context_mask)
 
         elif partial_boxes is not None:
             print('scene completion sampling')
-            samples = self.diffusion.complete_samples(noise.shape, room_mask.device, condition=condition, condition_cross=condition_cross, clip_denoised=clip_denoised, partial_boxes=partial_boxes)
+            samples = self.diffusion.complete_samples(shape, room_mask.device, condition=condition, condition_cross=condition_cross, clip_denoised=clip_denoised, partial_boxes=partial_boxes,
+                                                      sampler=sampler, context_mask=context_mask)
 
         else:
             print('unconditional / conditional generation sampling')
             # reverse sampling
             if ret_traj:
-                samples = self.diffusion.gen_sample_traj(noise.shape, room_mask.device, freq=freq, condition=condition, condition_cross=condition_cross, clip_denoised=clip_denoised)
+                samples = self.diffusion.gen_sample_traj(shape, room_mask.device, freq=freq, condition=condition, condition_cross=condition_cross, clip_denoised=clip_denoised,
+                                                         sampler=sampler, context_mask=context_mask)
             else:
-                samples = self.diffusion.gen_samples(noise.shape, room_mask.device, condition=condition, condition_cross=condition_cross, clip_denoised=clip_denoised)
+                samples = self.diffusion.gen_samples(shape, room_mask.device, condition=condition, condition_cross=condition_cross, clip_denoised=clip_denoised,
+                                                     sampler=sampler, context_mask=context_mask)
             
         return samples
 
+    def _delete_empty_per_sample(self, samples, device="cpu", keep_empty=False):
+        # the scenes of a batch (e.g. several prompts, or the num_samples_per_condition samples
+        # of every condition), as a list
+        if samples.shape[0] == 1:
+            return self.delete_empty_from_network_samples(samples, device=device, keep_empty=keep_empty)
+        return [self.delete_empty_from_network_samples(samples[i:i+1], device=device, keep_empty=keep_empty) for i in range(samples.shape[0])]
+
     @torch.no_grad()
-    def generate_layout(self, room_mask, num_points, point_dim, batch_size=1, text=None, ret_traj=False, ddim=False, clip_denoised=False, batch_seeds=None, device="cpu", keep_empty=False):
-        
-        samples = self.sample(room_mask, num_points, point_dim, batch_size, text=text, ret_traj=ret_traj, ddim=ddim, clip_denoised=clip_denoised, batch_seeds=batch_seeds)
+    def generate_layout(self, room_mask, num_points, point_dim, batch_size=1, text=None, ret_traj=False, ddim=False, clip_denoised=False, batch_seeds=None, device="cpu", keep_empty=False, sampler=None,
+                        num_samples_per_condition=1):
+        """
+        num_samples_per_condition: if > 1, the floor plan / text of every scene is
+        encoded once and sampled that many times in the same batch
+        The scenes of a batch of several conditions (batch_size, a list of
+        prompts text) or samples are returned as a list (the samples of the
+        first condition first).
+        """
+        samples = self.sample(room_mask, num_points, point_dim, batch_size, text=text, ret_traj=ret_traj, ddim=ddim, clip_denoised=clip_denoised, batch_seeds=batch_seeds, sampler=sampler,
+                              num_samples_per_condition=num_samples_per_condition)
         
-        return self.delete_empty_from_network_samples(samples, device=device, keep_empty=keep_empty)
+        return self._delete_empty_per_sample(samples, device, keep_empty)
 
     @torch.no_grad()
-    def generate_layout_progressive(self, room_mask, num_points, point_dim, batch_size=1, text=None, ret_traj=False, ddim=False, clip_denoised=False, batch_seeds=None, device="cpu", keep_empty=False, num_step=100):
+    def generate_layout_progressive(self, room_mask, num_points, point_dim, batch_size=1, text=None, ret_traj=False, ddim=False, clip_denoised=False, batch_seeds=None, device="cpu", keep_empty=False, num_step=100, sampler=None):
         
         # output dictionary of sample trajectory & sample some key steps
-        samples_traj = self.sample(room_mask, num_points, point_dim, batch_size, text=text, ret_traj=ret_traj, ddim=ddim, clip_denoised=clip_denoised, batch_seeds=batch_seeds, freq=num_step)
+        samples_traj = self.sample(room_mask, num_points, point_dim, batch_size, text=text, ret_traj=ret_traj, ddim=ddim, clip_denoised=clip_denoised, batch_seeds=batch_seeds, freq=num_step, sampler=sampler)
         boxes_traj = {}
 
         # delete the initial noisy
@@ -333,18 +485,39 @@ class DiffusionSceneLayout_DDPM(Module):
         return boxes_traj
     
     @torch.no_grad()
-    def complete_scene(self, room_mask, num_points, point_dim, partial_boxes, batch_size=1, ret_traj=False, ddim=False, clip_denoised=False, batch_seeds=None, device="cpu", keep_empty=False):
+    def complete_scene(self, room_mask, num_points, point_dim, partial_boxes, batch_size=1, ret_traj=False, ddim=False, clip_denoised=False, batch_seeds=None, device="cpu", keep_empty=False, sampler=None,
+                       num_samples_per_condition=1):
         
-        samples = self.sample(room_mask, num_points, point_dim, batch_size, partial_boxes=partial_boxes, ret_traj=ret_traj, ddim=ddim, clip_denoised=clip_denoised, batch_seeds=batch_seeds)
+        samples = self.sample(room_mask, num_points, point_dim, batch_size, partial_boxes=partial_boxes, ret_traj=ret_traj, ddim=ddim, clip_denoised=clip_denoised, batch_seeds=batch_seeds, sampler=sampler,
+                              num_samples_per_condition=num_samples_per_condition)
 
-        return self.delete_empty_from_network_samples(samples, device=device, keep_empty=keep_empty)
+        return self._delete_empty_per_sample(samples, device, keep_empty)
     
     @torch.no_grad()
-    def arrange_scene(self, room_mask, num_points, point_dim, input_boxes, batch_size=1, ret_traj=False, ddim=False, clip_denoised=False, batch_seeds=None, device="cpu", keep_empty=False):
+    def refine_layout(self, room_mask, boxes, t_start, num_fixed=0, text=None, ddim=False, clip_denoised=False, batch_seeds=None, device="cpu", keep_empty=False, sampler=None,
+                      num_samples_per_condition=1):
+        """
+        Warm-start resampling (SDEdit) of the layouts boxes, network samples of
+        shape (B, num_points, point_dim) like the partial_boxes of complete_scene:
+        they are noised to timestep t_start and denoised from there, keeping their
+        first num_fixed objects. Small t_start gives small edits / variations at
+        a fraction of the cost of generate_layout.
+        """
+        batch_size, num_points, point_dim = boxes.shape
+        samples = self.sample(room_mask, num_points, point_dim, batch_size, text=text, ddim=ddim, clip_denoised=clip_denoised, batch_seeds=batch_seeds,
+                              sampler=sampler, refine_boxes=boxes.to(room_mask.device), t_start=t_start, num_fixed=num_fixed,
+                              num_samples_per_condition=num_samples_per_condition)
+
+        return self._delete_empty_per_sample(samples, device, keep_empty)
+
+    @torch.no_grad()
+    def arrange_scene(self, room_mask, num_points, point_dim, input_boxes, batch_size=1, ret_traj=False, ddim=False, clip_denoised=False, batch_seeds=None, device="cpu", keep_empty=False, sampler=None,
+                      num_samples_per_condition=1):
         
-        samples = self.sample(room_mask, num_points, point_dim, batch_size, input_boxes=input_boxes, ret_traj=ret_traj, ddim=ddim, clip_denoised=clip_denoised, batch_seeds=batch_seeds)
+        samples = self.sample(room_mask, num_points, point_dim, batch_size, input_boxes=input_boxes, ret_traj=ret_traj, ddim=ddim, clip_denoised=clip_denoised, batch_seeds=batch_seeds, sampler=sampler,
+                              num_samples_per_condition=num_samples_per_condition)
 
-        return self.delete_empty_from_network_samples(samples, device=device, keep_empty=keep_empty)
+        return self._delete_empty_per_sample(samples, device, keep_empty)
     
     
 
@@ -361,6 +534,8 @@ class DiffusionSceneLayout_DDPM(Module):
         }
         if self.objfeat_dim > 0:
             samples_dict["objfeats"] = samples[:, :, self.bbox_dim+self.class_dim:self.bbox_dim+self.class_dim+self.objfeat_dim]
+        # same empty slots as the SlotPruner of the sampling loop
+        empty = self.diffusion.diffusion.emptiness(samples) >= 0
 
         #initilization
         boxes = {
@@ -376,7 +551,7 @@ class DiffusionSceneLayout_DDPM(Module):
         max_boxes = samples.shape[1]
         for i in range(max_boxes):
             # Check if we have the end symbol 
-            if not keep_empty and samples_dict['objectness'][0, i, -1] > 0:
+            if not keep_empty and empty[0, i]:
                 continue
             else:
                 for k in samples_dict.keys():
@@ -473,6 +648,26 @@ def train_on_batch(model, optimizer, sample_params, config):
     return loss.item()
 
 
+def distill_on_batch(model, teacher, optimizer, sample_params, config, distillation_grid):
+    # Make sure that everything has the correct size
+    optimizer.zero_grad()
+    # Compute the loss
+    loss, loss_dict = model.get_distillation_loss(sample_params, teacher, distillation_grid)
+    for k, v in loss_dict.items():
+        StatsLogger.instance()[k].value = v.item()
+    # Do the backpropagation
+    loss.backward()
+    # Compuite model norm
+    grad_norm = clip_grad_norm_(model.parameters(), config["training"]["max_grad_norm"])
+    StatsLogger.instance()["gradnorm"].value = grad_norm.item()
+    # log learning rate
+    StatsLogger.instance()["lr"].value = optimizer.param_groups[0]['lr']
+    # Do the update
+    optimizer.step()
+
+    return loss.item()
+
+
 @torch.no_grad()
 def validate_on_batch(model, sample_params, config):
     # Compute the loss
@@ -0,0 +1,374 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import torch
+import torch.nn as nn
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+from .samplers import Sampler, DDPMSampler, sampler_factory, early_exit_factory, parallel_config
+
+
+class DenoiseStep(nn.Module):
+    """
+    One reverse step of GaussianDiffusion.p_sample, denoiser included, as a
+    single module so that it can be traced / compiled as a whole. The
+    coefficient tables are buffers, so the step runs without host-side
+    indexing or .to(device) copies. diffusion may be a respaced one
+    (GaussianDiffusion.respace), t is then its own timestep index.
+    """
+    def __init__(self, denoise_net, diffusion, clip_denoised=False, has_condition=True, has_condition_cross=False):
+        super().__init__()
+        self.model = denoise_net
+        self.model_mean_type = diffusion.model_mean_type
+        self.clip_denoised = clip_denoised
+        self.has_condition = has_condition
+        self.has_condition_cross = has_condition_cross
+
+        if diffusion.model_var_type == 'fixedsmall':
+            log_variance = diffusion.posterior_log_variance_clipped
+        elif diffusion.model_var_type == 'fixedlarge':
+            log_variance = torch.log(torch.cat([diffusion.posterior_variance[1:2], diffusion.betas[1:]]))
+        else:
+            raise NotImplementedError(diffusion.model_var_type)
+
+        timestep_map = getattr(diffusion, "timestep_map", None)
+        if timestep_map is None:
+            timestep_map = torch.arange(diffusion.num_timesteps, dtype=torch.int64)
+        self.register_buffer("timestep_map", timestep_map.clone())
+        self.register_buffer("sqrt_recip_alphas_cumprod", diffusion.sqrt_recip_alphas_cumprod.clone())
+        self.register_buffer("sqrt_recipm1_alphas_cumprod", diffusion.sqrt_recipm1_alphas_cumprod.clone())
+        self.register_buffer("sqrt_alphas_cumprod", diffusion.sqrt_alphas_cumprod.clone())
+        self.register_buffer("sqrt_one_minus_alphas_cumprod", diffusion.sqrt_one_minus_alphas_cumprod.clone())
+        self.register_buffer("posterior_mean_coef1", diffusion.posterior_mean_coef1.clone())
+        self.register_buffer("posterior_mean_coef2", diffusion.posterior_mean_coef2.clone())
+        self.register_buffer("std", torch.exp(0.5 * log_variance))
+
+    @staticmethod
+    def _extract(a, t):
+        return a[t][:, None, None]
+
+    def forward(self, x_t, t, noise, *conditions):
+        """
+        conditions: condition and/or condition_cross, the ones the step was
+        built with, in this order. Returns the next sample and the predicted x_0.
+        """
+        conditions = list(conditions)
+        condition = conditions.pop(0) if self.has_condition else None
+        condition_cross = conditions.pop(0) if self.has_condition_cross else None
+
+        model_output = self.model(x_t, self.timestep_map[t], condition, condition_cross)
+        if self.model_mean_type == 'eps':
+            x_start = self._extract(self.sqrt_recip_alphas_cumprod, t) * x_t - \
+                      self._extract(self.sqrt_recipm1_alphas_cumprod, t) * model_output
+        elif self.model_mean_type == 'x0':
+            x_start = model_output
+        else:
+            x_start = self._extract(self.sqrt_alphas_cumprod, t) * x_t - \
+                      self._extract(self.sqrt_one_minus_alphas_cumprod, t) * model_output
+        if self.clip_denoised:
+            x_start = x_start.clamp(-1., 1.)
+
+        model_mean = self._extract(self.posterior_mean_coef1, t) * x_start + \
+                     self._extract(self.posterior_mean_coef2, t) * x_t
+        # no noise when t == 0
+        nonzero_mask = (t != 0).to(x_t.dtype)[:, None, None]
+        return model_mean + nonzero_mask * self._extract(self.std, t) * noise, x_start
+
+
+def state_dict_hash(module):
+    """sha1 of the parameters and buffers of a module."""
+    h = hashlib.sha1()
+    for k, v in sorted(module.state_dict().items()):
+        h.update(k.encode())
+        h.update(v.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def cache_key(**kwargs):
+    """sha1 of the json of the given (config, weights hash, shapes, ...) values."""
+    kwargs["torch"] = torch.__version__
+    return hashlib.sha1(json.dumps(kwargs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class CompiledDDPMSampler(DDPMSampler):
+    """
+    DDPMSampler (respacing included) whose steps run a traced ("jit") or
+    torch.compile'd ("compile") DenoiseStep instead of the eager denoiser.
+
+    The jit artifact is saved under cache_dir, keyed by the denoiser config,
+    the hash of its weights, the sampling shapes and the torch version, so
+    later processes load it instead of tracing again. The compile backend
+    requires torch >= 2.0 (the pinned torch 1.13 only has the jit backend)
+    and keeps the inductor FX graph cache under cache_dir for the same
+    purpose. The step is built lazily on the first call, when the shapes
+    are known.
+    """
+    def __init__(self, diffusion, denoise_net, num_steps=None, backend="jit", cache_dir=None, net_config=None):
+        super().__init__(diffusion, num_steps)
+        assert backend in ["eager", "jit", "compile"]
+        if backend == "compile" and not hasattr(torch, "compile"):
+            raise NotImplementedError(
+                "the compile backend requires torch >= 2.0, found {}, use the jit backend".format(torch.__version__)
+            )
+        self._num_steps = num_steps
+        self.denoise_net = denoise_net
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.net_config = net_config or {}
+        self._steps = {}
+        self._weights_hash = None
+
+    def eager(self):
+        # the built step calls the denoiser without the context mask
+        sampler = DDPMSampler(self.diffusion, self._num_steps)
+        sampler.early_exit = self.early_exit
+        sampler.parallel = self.parallel
+        return sampler
+
+    def cache_key(self, example_inputs, clip_denoised):
+        if self._weights_hash is None:
+            self._weights_hash = state_dict_hash(self.denoise_net)
+        return cache_key(
+            backend=self.backend,
+            net_config=self.net_config,
+            weights=self._weights_hash,
+            shapes=[list(x.shape) for x in example_inputs],
+            use_timesteps=self.use_timesteps,
+            clip_denoised=clip_denoised
+        )
+
+    def _build(self, example_inputs, has_condition, has_condition_cross, clip_denoised):
+        diffusion = self.spaced if self.spaced is not None else self.diffusion
+        step = DenoiseStep(self.denoise_net, diffusion, clip_denoised, has_condition, has_condition_cross)
+        step = step.to(example_inputs[0].device).eval()
+        if self.backend == "eager":
+            return step
+
+        if self.backend == "compile":
+            if self.cache_dir is not None:
+                os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(self.cache_dir, "inductor"))
+                import torch._inductor.config
+                torch._inductor.config.fx_graph_cache = True
+            return torch.compile(step, dynamic=False)
+
+        path = None
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, "denoise_step_{}.pt".format(self.cache_key(example_inputs, clip_denoised)))
+            if os.path.exists(path):
+                return torch.jit.load(path, map_location=example_inputs[0].device)
+
+        with torch.no_grad():
+            traced = torch.jit.trace(step, example_inputs, check_trace=False)
+            traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            torch.jit.save(traced, path)
+        return traced
+
+    def step(self, denoise_fn, x_t, t, t_next, condition, condition_cross, noise_fn=torch.randn, clip_denoised=True):
+        if self.spaced is not None:
+            t = self._spaced_index.to(t.device)[t]
+        noise = noise_fn(size=x_t.shape, dtype=x_t.dtype, device=x_t.device)
+        inputs = [x_t, t, noise] + [c for c in [condition, condition_cross] if c is not None]
+
+        key = (tuple(tuple(x.shape) for x in inputs), condition is not None, condition_cross is not None, clip_denoised)
+        if key not in self._steps:
+            self._steps[key] = self._build(tuple(inputs), condition is not None, condition_cross is not None, clip_denoised)
+        with torch.no_grad():
+            return self._steps[key](*inputs)
+
+    # the fused step allocates its outputs, copy them into the buffers
+    step_ = Sampler.step_
+
+
+def export_onnx(denoise_net, path, x, t, condition=None, condition_cross=None, opset_version=17):
+    """
+    Export the denoiser to ONNX with the inputs x, t and, if given, condition
+    (room feature and instance embedding, per object) and condition_cross
+    (text context). The batch size and the text length are dynamic.
+    """
+    input_names = ["x", "t"]
+    example_inputs = [x, t]
+    dynamic_axes = {"x": {0: "batch"}, "t": {0: "batch"}, "out": {0: "batch"}}
+    if condition is not None:
+        input_names.append("condition")
+        example_inputs.append(condition)
+        dynamic_axes["condition"] = {0: "batch"}
+    if condition_cross is not None:
+        input_names.append("condition_cross")
+        example_inputs.append(condition_cross)
+        dynamic_axes["condition_cross"] = {0: "batch", 1: "tokens"}
+
+    class _Denoiser(nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, x, t, *conditions):
+            conditions = list(conditions)
+            condition = conditions.pop(0) if "condition" in input_names else None
+            condition_cross = conditions.pop(0) if "condition_cross" in input_names else None
+            return self.model(x, t, condition, condition_cross)
+
+    with torch.no_grad():
+        torch.onnx.export(
+            _Denoiser(denoise_net).eval(), tuple(example_inputs), path,
+            input_names=input_names, output_names=["out"], dynamic_axes=dynamic_axes,
+            opset_version=opset_version, do_constant_folding=True
+        )
+    return path
+
+
+class OnnxDenoiser:
+    """
+    Drop-in replacement of DiffusionPoint._denoise that runs an exported
+    denoiser (export_onnx) with onnxruntime on the CPU.
+    """
+    def __init__(self, path, num_threads=None, optimized_model_path=None):
+        if onnxruntime is None:
+            raise ImportError("the onnx backend requires onnxruntime")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        if optimized_model_path is not None:
+            options.optimized_model_filepath = optimized_model_path
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, data, t, condition, condition_cross):
+        inputs = {"x": data, "t": t, "condition": condition, "condition_cross": condition_cross}
+        feed = {k: inputs[k].detach().cpu().numpy() for k in self.input_names}
+        out, = self.session.run(["out"], feed)
+        return torch.from_numpy(out).to(data.device)
+
+
+class DenoiserBackendSampler(Sampler):
+    """Runs a sampler with its denoise_fn replaced, e.g. by an OnnxDenoiser."""
+    def __init__(self, sampler, denoise_fn):
+        super().__init__(sampler.diffusion)
+        self.sampler = sampler
+        self.denoise_fn = denoise_fn
+
+    def timesteps(self):
+        return self.sampler.timesteps()
+
+    def reset(self):
+        self.sampler.reset()
+
+    @property
+    def stochastic(self):
+        return self.sampler.stochastic
+
+    @property
+    def early_exit(self):
+        return self.sampler.early_exit
+
+    @property
+    def parallel(self):
+        return self.sampler.parallel
+
+    @property
+    def stateless(self):
+        return self.sampler.stateless
+
+    def select_(self, index):
+        self.sampler.select_(index)
+
+    def eager(self):
+        return self.sampler.eager()
+
+    def step(self, denoise_fn, x_t, t, t_next, condition, condition_cross, noise_fn=torch.randn, clip_denoised=True):
+        return self.sampler.step(self.denoise_fn, x_t, t, t_next, condition, condition_cross, noise_fn=noise_fn, clip_denoised=clip_denoised)
+
+    def step_(self, denoise_fn, x_t, time, time_next, t, t_next, condition, condition_cross, noise, out, clip_denoised=True,
+              pred_x0=None):
+        return self.sampler.step_(self.denoise_fn, x_t, time, time_next, t, t_next, condition, condition_cross,
+                                  noise=noise, out=out, clip_denoised=clip_denoised, pred_x0=pred_x0)
+
+
+class OnnxSampler(DenoiserBackendSampler):
+    """
+    Any sampler of sampler_factory with the denoiser running in onnxruntime.
+    The model is exported on the first step, when the condition inputs are
+    known, and saved under cache_dir keyed like CompiledDDPMSampler (by
+    default a directory of the system temp dir shared by every process).
+    """
+    def __init__(self, sampler, denoise_net, cache_dir=None, num_threads=None, net_config=None):
+        super().__init__(sampler, None)
+        self.denoise_net = denoise_net
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(tempfile.gettempdir(), "diffuscene_onnx")
+        self.num_threads = num_threads
+        self.net_config = net_config or {}
+        self._denoisers = {}
+
+    def _denoiser(self, x_t, t, condition, condition_cross):
+        key = (condition is not None, condition_cross is not None)
+        if key not in self._denoisers:
+            path = os.path.join(self.cache_dir, "denoiser_{}.onnx".format(cache_key(
+                backend="onnx",
+                net_config=self.net_config,
+                weights=state_dict_hash(self.denoise_net),
+                conditions=key
+            )))
+            if not os.path.exists(path):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # exported next to its final path, concurrent processes may export the same model
+                tmp_path = "{}.{}.tmp".format(path, os.getpid())
+                export_onnx(self.denoise_net, tmp_path, x_t, t, condition, condition_cross)
+                os.replace(tmp_path, path)
+            self._denoisers[key] = OnnxDenoiser(path, num_threads=self.num_threads)
+        return self._denoisers[key]
+
+    def step(self, denoise_fn, x_t, t, t_next, condition, condition_cross, noise_fn=torch.randn, clip_denoised=True):
+        self.denoise_fn = self._denoiser(x_t, t, condition, condition_cross)
+        return super().step(denoise_fn, x_t, t, t_next, condition, condition_cross, noise_fn=noise_fn, clip_denoised=clip_denoised)
+
+    def step_(self, denoise_fn, x_t, time, time_next, t, t_next, condition, condition_cross, noise, out, clip_denoised=True,
+              pred_x0=None):
+        self.denoise_fn = self._denoiser(x_t, t, condition, condition_cross)
+        return super().step_(denoise_fn, x_t, time, time_next, t, t_next, condition, condition_cross,
+                             noise=noise, out=out, clip_denoised=clip_denoised, pred_x0=pred_x0)
+
+
+def inference_sampler_factory(diffusion, denoise_net, config=None, net_config=None):
+    """
+    sampler_factory for sampling with a given inference backend,
+    e.g. {"type": "ddpm", "num_steps": 100, "backend": "jit", "cache_dir": "..."}
+    """
+    config = config or {}
+    backend = config.get("backend", "eager")
+    if backend == "eager":
+        return sampler_factory(diffusion, config)
+    for option in ["deep_cache", "prune_empty"]:
+        if config.get(option, None):
+            raise NotImplementedError("{} is only available for the eager backend".format(option))
+    if backend == "onnx":
+        return OnnxSampler(
+            sampler_factory(diffusion, config),
+            denoise_net,
+            cache_dir=config.get("cache_dir", None),
+            num_threads=config.get("num_threads", None),
+            net_config=net_config
+        )
+
+    if config.get("type", "ddpm") != "ddpm":
+        raise NotImplementedError("backend {} is only available for the ddpm sampler".format(backend))
+    sampler = CompiledDDPMSampler(
+        diffusion,
+        denoise_net,
+        num_steps=config.get("num_steps", None),
+        backend=backend,
+        cache_dir=config.get("cache_dir", None),
+        net_config=net_config
+    )
+    sampler.early_exit = early_exit_factory(config)
+    sampler.parallel = parallel_config(config)
+    return sampler
@@ -1,4 +1,5 @@
 import torch
+from collections import namedtuple
 
 '''
  https://github.com/open-mmlab/mmdetection3d/blob/master/mmdet3d/core/bbox/iou_calculators/iou3d_calculator.py
@@ -100,3 +101,55 @@ def axis_aligned_bbox_overlaps_3d(bboxes1,
     enclose_area = torch.max(enclose_area, eps)
     gious = ious - (enclose_area - union) / enclose_area
     return gious
+
+
+PairwiseOverlaps = namedtuple('PairwiseOverlaps', ['ious', 'overlaps', 'areas', 'pair_mask'])
+
+def axis_aligned_bbox_pairwise_overlaps_3d(bboxes, valid_mask=None, eps=1e-6):
+    """Calculate the symmetric pairwise overlaps within one set of axis
+        aligned 3D bboxes. Only the strict upper triangle (pairs i < j) is
+        computed, so the intermediates are of shape (B, n*(n-1)/2, 3) instead of
+        (B, n, n, 3), and the diagonal (self-overlap) is never materialized.
+        Pairs are ordered as ``torch.triu_indices(n, n, offset=1)``.
+        Args:
+            bboxes (Tensor): shape (B, n, 6) in <x1, y1, z1, x2, y2, z2> format.
+            valid_mask (Tensor, optional): shape (B, n), 1 for real objects and
+                0 for padded or empty slots. Defaults to all valid.
+            eps (float, optional): A value added to the denominator for numerical
+                stability. Defaults to 1e-6.
+        Returns:
+            PairwiseOverlaps: ``ious`` and ``overlaps`` of shape (B, n*(n-1)/2),
+                ``areas`` of shape (B, n) and ``pair_mask`` of shape
+                (B, n*(n-1)/2); all of them are zero for invalid boxes/pairs.
+    """
+    assert bboxes.size(-1) == 6
+    num_boxes = bboxes.size(-2)
+    if valid_mask is None:
+        valid_mask = bboxes.new_ones(bboxes.shape[:-1])
+    valid_mask = valid_mask.to(bboxes.dtype)
+
+    areas = (bboxes[..., 3] - bboxes[..., 0]) * (bboxes[..., 4] - bboxes[..., 1]) * \
+            (bboxes[..., 5] - bboxes[..., 2])
+    areas = areas * valid_mask
+
+    rows, cols = torch.triu_indices(num_boxes, num_boxes, offset=1, device=bboxes.device)
+    lt = torch.max(bboxes[..., rows, :3], bboxes[..., cols, :3])  # [B, pairs, 3]
+    rb = torch.min(bboxes[..., rows, 3:], bboxes[..., cols, 3:])  # [B, pairs, 3]
+    wh = (rb - lt).clamp(min=0)
+    pair_mask = valid_mask[..., rows] * valid_mask[..., cols]
+    overlaps = wh[..., 0] * wh[..., 1] * wh[..., 2] * pair_mask
+
+    union = (areas[..., rows] + areas[..., cols] - overlaps).clamp(min=eps)
+    ious = overlaps / union
+    return PairwiseOverlaps(ious, overlaps, areas, pair_mask)
+
+
+def axis_aligned_bbox_self_ious_3d(bboxes, eps=1e-6):
+    """IoU of every axis aligned 3D bbox with itself, i.e. the diagonal of
+        ``axis_aligned_bbox_overlaps_3d(bboxes, bboxes)`` of shape (B, n).
+    """
+    area = (bboxes[..., 3] - bboxes[..., 0]) * (bboxes[..., 4] - bboxes[..., 1]) * \
+           (bboxes[..., 5] - bboxes[..., 2])
+    wh = (bboxes[..., 3:] - bboxes[..., :3]).clamp(min=0)
+    overlap = wh[..., 0] * wh[..., 1] * wh[..., 2]
+    return overlap / (2 * area - overlap).clamp(min=eps)
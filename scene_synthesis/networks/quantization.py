@@ -0,0 +1,154 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import QuantWrapper, get_default_qconfig, prepare, convert, quantize_dynamic
+
+from .denoise_net import WeightStandardizedConv2d, WeightStandardizedLinear, GroupedProjection
+
+
+def _standardize(weight):
+    """The weight standardization of the Unet1D blocks, constant at inference."""
+    var, mean = torch.var_mean(weight, dim=list(range(1, weight.dim())), unbiased=False, keepdim=True)
+    return (weight - mean) * (var + 1e-5).rsqrt()
+
+
+class Conv1x1Linear(nn.Module):
+    """
+    A 1x1 nn.Conv1d on BxCxN features as an nn.Linear, which the int8
+    quantization of torch supports (dynamic quantization has no Conv1d).
+    """
+    def __init__(self, linear):
+        super().__init__()
+        self.linear = linear
+
+    @classmethod
+    def from_conv(cls, conv):
+        weight = conv.weight
+        if isinstance(conv, WeightStandardizedConv2d):
+            weight = _standardize(weight)
+        linear = nn.Linear(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        with torch.no_grad():
+            linear.weight.copy_(weight[:, :, 0])
+            if conv.bias is not None:
+                linear.bias.copy_(conv.bias)
+        return cls(linear)
+
+    def forward(self, x):
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+def _is_conv1x1(module):
+    return isinstance(module, nn.Conv1d) and module.kernel_size == (1,) and module.stride == (1,) and \
+        module.padding == (0,) and module.dilation == (1,) and module.groups == 1
+
+
+def _plain_linear(linear):
+    """A WeightStandardizedLinear as an nn.Linear with the standardized weights."""
+    plain = nn.Linear(linear.in_features, linear.out_features, bias=linear.bias is not None)
+    with torch.no_grad():
+        plain.weight.copy_(_standardize(linear.weight))
+        if linear.bias is not None:
+            plain.bias.copy_(linear.bias)
+    return plain
+
+
+def _grouped_linear(grouped):
+    """A GroupedProjection as the nn.Linear (Conv1x1Linear) of its block-diagonal weights."""
+    linear = nn.Linear(grouped.weight.shape[1], grouped.weight.shape[0])
+    with torch.no_grad():
+        linear.weight.copy_(grouped.weight.reshape(linear.weight.shape))
+        linear.bias.copy_(grouped.bias)
+    return linear if grouped.channels_last else Conv1x1Linear(linear)
+
+
+def linearize_conv1x1(module):
+    """
+    Replace (in place) every 1x1 Conv1d of module by the equivalent Conv1x1Linear,
+    every WeightStandardizedLinear (channels_last Unet1D) by an nn.Linear and
+    every GroupedProjection (fuse_attribute_mlps) by its dense equivalent.
+    """
+    for name, child in module.named_children():
+        if _is_conv1x1(child):
+            setattr(module, name, Conv1x1Linear.from_conv(child))
+        elif isinstance(child, WeightStandardizedLinear):
+            setattr(module, name, _plain_linear(child))
+        elif isinstance(child, GroupedProjection):
+            setattr(module, name, _grouped_linear(child))
+        else:
+            linearize_conv1x1(child)
+    return module
+
+
+def _wrap_linears(module, qconfig):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            wrapper = QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_linears(child, qconfig)
+    return module
+
+
+@torch.no_grad()
+def calibrate(network, batches, num_rooms=256):
+    """
+    Run the denoiser on noised training layouts (random timesteps) of
+    num_rooms rooms of batches, an iterable of sample_params, to collect the
+    activation ranges of a statically quantized network.
+    """
+    diffusion = network.diffusion.diffusion
+    seen = 0
+    for sample_params in batches:
+        room_layout_target, condition, condition_cross = network.get_diffusion_inputs(sample_params)
+        B = room_layout_target.shape[0]
+        t = torch.randint(0, diffusion.num_timesteps, size=(B,), device=room_layout_target.device)
+        data_t = diffusion.q_sample(x_start=room_layout_target, t=t)
+        network.diffusion._denoise(data_t, t, condition, condition_cross)
+        seen += B
+        if seen >= num_rooms:
+            break
+    return seen
+
+
+def quantize_denoiser(denoise_net, mode="dynamic", calibrate_fn=None):
+    """
+    Post-training int8 quantization (CPU only, in place) of the 1x1 convs and
+    linear layers of a Unet1D denoiser.
+        dynamic: int8 weights, activations quantized on the fly
+        static:  int8 weights and activations, calibrate_fn() runs the
+                 denoiser on representative inputs to collect the activation
+                 ranges
+    """
+    assert mode in ["dynamic", "static"], mode
+    denoise_net = linearize_conv1x1(denoise_net.eval())
+
+    if mode == "dynamic":
+        quantize_dynamic(denoise_net, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    else:
+        assert calibrate_fn is not None, "static quantization needs calibration inputs"
+        _wrap_linears(denoise_net, get_default_qconfig(torch.backends.quantized.engine))
+        prepare(denoise_net, inplace=True)
+        calibrate_fn()
+        convert(denoise_net, inplace=True)
+    return denoise_net
+
+
+def quantize_network(network, mode="dynamic", calibration_batches=None, num_calibration_rooms=256):
+    """
+    int8 quantization of the denoiser of a DiffusionSceneLayout_DDPM (see
+    quantize_denoiser) and of its BERT text encoder if any, which is always
+    quantized dynamically. The static activation ranges are calibrated on
+    calibration_batches, sample_params of training rooms.
+    """
+    network.eval()
+
+    def calibrate_fn():
+        num_rooms = calibrate(network, calibration_batches, num_calibration_rooms)
+        print("calibrated the int8 activations on {} rooms".format(num_rooms))
+
+    quantize_denoiser(network.diffusion.model, mode, calibrate_fn if calibration_batches is not None else None)
+
+    if getattr(network, "bertmodel", None) is not None:
+        quantize_dynamic(network.bertmodel, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return network
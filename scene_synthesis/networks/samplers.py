@@ -0,0 +1,575 @@
+import numpy as np
+import torch
+
+
+def _broadcast(v, x):
+    """Reshape a per-sample coefficient of shape [B] for broadcasting against x."""
+    return torch.reshape(v, [x.shape[0]] + (len(x.shape) - 1) * [1])
+
+
+class Sampler:
+    """
+    Reverse process of a GaussianDiffusion. A sampler defines which timesteps are
+    visited and how a sample is moved from one of them to the next; the sampling
+    loops of GaussianDiffusion (generation, completion, rearrangement) are
+    written against this interface only.
+    """
+    # ConvergenceMonitor of the samples leaving the sampling loop early, if any
+    early_exit = None
+    # {"window", "tolerance"} of the parallel-in-time (Picard) sampling loop, if any
+    parallel = None
+    # DeepCache of the deep denoiser features reused across steps, if any
+    deep_cache = None
+    # SlotPruner of the empty object slots dropped from the denoiser inputs, if any
+    prune_empty = None
+    # whether step carries no state across steps, so that steps at different
+    # timesteps can run in one batch
+    stateless = True
+
+    def __init__(self, diffusion):
+        self.diffusion = diffusion
+
+    @property
+    def num_steps(self):
+        return len(self.timesteps())
+
+    def timesteps(self):
+        """
+        Descending list of (t, t_next) pairs, t_next == -1 for the last step.
+        """
+        raise NotImplementedError()
+
+    def reset(self):
+        """
+        Clear any state carried across steps before a new sampling run.
+        """
+        pass
+
+    def select_(self, index):
+        """
+        Keep the state carried across steps of the samples index only, when
+        samples leave the batch during a sampling run.
+        """
+        pass
+
+    def eager(self):
+        """
+        The sampler stepping with the denoise_fn of the sampling loop, e.g. to
+        pass it the mask of the prompt tokens; a compiled or exported backend
+        returns its eager equivalent.
+        """
+        return self
+
+    @property
+    def stochastic(self):
+        """Whether step draws noise (step_ then needs a noise tensor)."""
+        return True
+
+    def step(self, denoise_fn, x_t, t, t_next, condition, condition_cross, noise_fn=torch.randn, clip_denoised=True):
+        """
+        Move x_t from timesteps t to t_next (both int64 tensors of shape [B]).
+        Returns the new sample and the predicted x_0.
+        """
+        raise NotImplementedError()
+
+    def step_(self, denoise_fn, x_t, time, time_next, t, t_next, condition, condition_cross, noise, out, clip_denoised=True,
+              pred_x0=None):
+        """
+        step writing the new sample into out (and the predicted x_0 into pred_x0
+        if given), for a batch at the same timesteps (time and time_next are the
+        python ints of t and t_next). noise is the standard normal noise of the
+        step, drawn by the caller (None if the sampler is not stochastic); out
+        must not alias x_t. Samplers override it to update out in place, this
+        fallback copies the results of step.
+        """
+        noise_fn = (lambda **kwargs: noise) if noise is not None else torch.zeros
+        x_next, x_start = self.step(denoise_fn, x_t, t, t_next, condition, condition_cross, noise_fn=noise_fn, clip_denoised=clip_denoised)
+        if pred_x0 is not None:
+            pred_x0.copy_(x_start)
+        return out.copy_(x_next)
+
+
+def space_timesteps(num_timesteps, num_steps):
+    """num_steps evenly spaced timesteps of [0, num_timesteps-1], both ends included."""
+    return sorted(set(np.round(np.linspace(0, num_timesteps - 1, num_steps)).astype(np.int64).tolist()))
+
+
+class DDPMSampler(Sampler):
+    """
+    Ancestral sampling over the full Markov chain or, when num_steps is smaller
+    than the number of trained timesteps, over the respaced chain of
+    GaussianDiffusion.respace (no retraining needed).
+    """
+    def __init__(self, diffusion, num_steps=None):
+        super().__init__(diffusion)
+        num_timesteps = diffusion.num_timesteps
+        if num_steps is None or num_steps >= num_timesteps:
+            self.use_timesteps = list(range(num_timesteps))
+            self.spaced = None
+        else:
+            self.use_timesteps = space_timesteps(num_timesteps, num_steps)
+            self.spaced = diffusion.respace(self.use_timesteps)
+            # trained timestep -> index in the respaced chain
+            self._spaced_index = torch.full((num_timesteps,), -1, dtype=torch.int64)
+            self._spaced_index[self.spaced.timestep_map] = torch.arange(len(self.use_timesteps))
+        self._coefficients = None
+
+    def timesteps(self):
+        times = list(reversed(self.use_timesteps))
+        return list(zip(times, times[1:] + [-1]))
+
+    def _step_coefficients(self):
+        """Per trained timestep python floats of the p_sample arithmetic, for step_."""
+        if self._coefficients is None:
+            diffusion = self.spaced if self.spaced is not None else self.diffusion
+            if diffusion.model_var_type == 'fixedlarge':
+                log_variance = torch.log(torch.cat([diffusion.posterior_variance[1:2], diffusion.betas[1:]]))
+            else:
+                log_variance = diffusion.posterior_log_variance_clipped
+            tables = [diffusion.sqrt_recip_alphas_cumprod, diffusion.sqrt_recipm1_alphas_cumprod,
+                      diffusion.sqrt_alphas_cumprod, diffusion.sqrt_one_minus_alphas_cumprod,
+                      diffusion.posterior_mean_coef1, diffusion.posterior_mean_coef2, torch.exp(0.5 * log_variance)]
+            rows = list(zip(*[table.tolist() for table in tables]))
+            self._coefficients = dict(zip(self.use_timesteps, rows))
+        return self._coefficients
+
+    def step_(self, denoise_fn, x_t, time, time_next, t, t_next, condition, condition_cross, noise, out, clip_denoised=True,
+              pred_x0=None):
+        sqrt_recip, sqrt_recipm1, sqrt_ab, sqrt_1mab, coef1, coef2, std = self._step_coefficients()[time]
+        # the denoiser always sees the trained timesteps
+        model_output = denoise_fn(x_t, t, condition, condition_cross)
+
+        # predicted x_0 in out, then the posterior mean and the noise on top of it
+        mean_type = self.diffusion.model_mean_type
+        if mean_type == 'eps':
+            torch.mul(x_t, sqrt_recip, out=out).add_(model_output, alpha=-sqrt_recipm1)
+        elif mean_type == 'x0':
+            out.copy_(model_output)
+        elif mean_type == 'v':
+            torch.mul(x_t, sqrt_ab, out=out).add_(model_output, alpha=-sqrt_1mab)
+        else:
+            raise NotImplementedError(mean_type)
+        if clip_denoised:
+            out.clamp_(-1., 1.)
+        if pred_x0 is not None:
+            pred_x0.copy_(out)
+        out.mul_(coef1).add_(x_t, alpha=coef2)
+        # no noise at the last step
+        if time_next >= 0:
+            out.add_(noise, alpha=std)
+        return out
+
+    def step(self, denoise_fn, x_t, t, t_next, condition, condition_cross, noise_fn=torch.randn, clip_denoised=True):
+        if self.spaced is None:
+            return self.diffusion.p_sample(denoise_fn=denoise_fn, data=x_t, t=t, condition=condition, condition_cross=condition_cross, noise_fn=noise_fn,
+                                           clip_denoised=clip_denoised, return_pred_xstart=True)
+
+        timestep_map = self.spaced.timestep_map.to(t.device)
+        spaced_denoise_fn = lambda x, k, c, c_cross: denoise_fn(x, timestep_map[k], c, c_cross)
+        return self.spaced.p_sample(denoise_fn=spaced_denoise_fn, data=x_t, t=self._spaced_index.to(t.device)[t], condition=condition,
+                                    condition_cross=condition_cross, noise_fn=noise_fn, clip_denoised=clip_denoised, return_pred_xstart=True)
+
+
+class RespacedSampler(Sampler):
+    """
+    Base class of the samplers that visit a strided subset of the timesteps,
+    or the given use_timesteps (e.g. those of a distilled student).
+    """
+    def __init__(self, diffusion, num_steps=50, use_timesteps=None):
+        super().__init__(diffusion)
+        self.use_timesteps = sorted(use_timesteps) if use_timesteps is not None else None
+        self.sampling_timesteps = len(self.use_timesteps) if use_timesteps is not None else min(num_steps, diffusion.num_timesteps)
+
+    def timesteps(self):
+        if self.use_timesteps is not None:
+            times = list(reversed(self.use_timesteps)) + [-1]
+            return list(zip(times[:-1], times[1:]))
+        # [-1, 0, 1, 2, ..., T-1] when sampling_timesteps == total_timesteps
+        times = torch.linspace(-1, self.diffusion.num_timesteps - 1, steps=self.sampling_timesteps + 1)
+        times = list(reversed(times.int().tolist()))
+        return list(zip(times[:-1], times[1:]))
+
+    def _alphas_cumprod(self, t, x):
+        """alpha_bar at t (alpha_bar == 1 at t == -1), broadcastable against x."""
+        alphas_cumprod = self.diffusion.alphas_cumprod.to(x.device)
+        out = torch.where(t >= 0, alphas_cumprod.gather(0, t.clamp(min=0)), torch.ones_like(alphas_cumprod[:1]))
+        return _broadcast(out, x)
+
+    def _alpha_cumprod(self, time):
+        """alpha_bar at the python int time, as a python float."""
+        if not hasattr(self, "_alphas_cumprod_list"):
+            self._alphas_cumprod_list = self.diffusion.alphas_cumprod.tolist()
+        return self._alphas_cumprod_list[time] if time >= 0 else 1.
+
+
+class DDIMSampler(RespacedSampler):
+    """https://arxiv.org/abs/2010.02502, eta == 0 gives deterministic sampling."""
+    def __init__(self, diffusion, num_steps=50, eta=0., use_timesteps=None):
+        super().__init__(diffusion, num_steps, use_timesteps)
+        self.eta = eta
+
+    def step(self, denoise_fn, x_t, t, t_next, condition, condition_cross, noise_fn=torch.randn, clip_denoised=True):
+        pred_noise, x_start = self.diffusion.model_predictions(denoise_fn, x_t, t, condition, condition_cross, clip_x_start=clip_denoised)
+
+        alpha = self._alphas_cumprod(t, x_t)
+        alpha_next = self._alphas_cumprod(t_next, x_t)
+
+        sigma = self.eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
+        c = (1 - alpha_next - sigma ** 2).clamp(min=0).sqrt()
+
+        noise = noise_fn(size=x_t.shape, dtype=x_t.dtype, device=x_t.device)
+        x_next = x_start * alpha_next.sqrt() + c * pred_noise + sigma * noise
+        return x_next, x_start
+
+    @property
+    def stochastic(self):
+        return self.eta > 0
+
+    def step_(self, denoise_fn, x_t, time, time_next, t, t_next, condition, condition_cross, noise, out, clip_denoised=True,
+              pred_x0=None):
+        alpha, alpha_next = self._alpha_cumprod(time), self._alpha_cumprod(time_next)
+        sigma = self.eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)) ** 0.5
+        c = max(1 - alpha_next - sigma ** 2, 0.) ** 0.5
+        sqrt_recip, sqrt_recipm1 = (1. / alpha) ** 0.5, (1. / alpha - 1) ** 0.5
+
+        # model_predictions with the predicted x_0 in out and the noise in model_output
+        model_output = denoise_fn(x_t, t, condition, condition_cross)
+        mean_type = self.diffusion.model_mean_type
+        if mean_type == 'eps':
+            torch.mul(x_t, sqrt_recip, out=out).add_(model_output, alpha=-sqrt_recipm1)
+        elif mean_type == 'x0':
+            out.copy_(model_output)
+        elif mean_type == 'v':
+            torch.mul(x_t, alpha ** 0.5, out=out).add_(model_output, alpha=-(1 - alpha) ** 0.5)
+        else:
+            raise NotImplementedError(mean_type)
+        if clip_denoised:
+            out.clamp_(-1., 1.)
+        if pred_x0 is not None:
+            pred_x0.copy_(out)
+        if mean_type != 'eps':
+            model_output.copy_(x_t).mul_(sqrt_recip).sub_(out).div_(sqrt_recipm1)
+
+        out.mul_(alpha_next ** 0.5).add_(model_output, alpha=c)
+        if sigma > 0:
+            out.add_(noise, alpha=sigma)
+        return out
+
+
+class DPMSolverSampler(RespacedSampler):
+    """
+    Multistep DPM-Solver++ (https://arxiv.org/abs/2211.01095) on the discrete
+    alpha_bar of the diffusion, with the data (x_0) prediction as the solver
+    variable. order=2 reuses the previous x_0 prediction, so it costs one
+    model call per step like order=1.
+    """
+    stateless = False
+
+    def __init__(self, diffusion, num_steps=20, order=2):
+        super().__init__(diffusion, num_steps)
+        assert order in [1, 2]
+        self.order = order
+        self.reset()
+
+    def reset(self):
+        self._prev_x_start = None
+        self._prev_h = None
+
+    @property
+    def stochastic(self):
+        return False
+
+    def select_(self, index):
+        if self._prev_x_start is not None:
+            self._prev_x_start, self._prev_h = self._prev_x_start[index], self._prev_h[index]
+
+    def step(self, denoise_fn, x_t, t, t_next, condition, condition_cross, noise_fn=torch.randn, clip_denoised=True):
+        _, x_start = self.diffusion.model_predictions(denoise_fn, x_t, t, condition, condition_cross, clip_x_start=clip_denoised)
+
+        last = _broadcast(t_next < 0, x_t)
+        alpha_bar = self._alphas_cumprod(t, x_t)
+        # the last step jumps straight to x_0, keep the coefficients finite for it
+        alpha_bar_next = self._alphas_cumprod(t_next.clamp(min=0), x_t)
+
+        alpha, sigma = alpha_bar.sqrt(), (1 - alpha_bar).sqrt()
+        alpha_next, sigma_next = alpha_bar_next.sqrt(), (1 - alpha_bar_next).sqrt()
+        h = (torch.log(alpha_next) - torch.log(sigma_next)) - (torch.log(alpha) - torch.log(sigma))
+
+        if self.order == 1 or self._prev_x_start is None:
+            d = x_start
+        else:
+            r = self._prev_h / h
+            d = (1 + 1 / (2 * r)) * x_start - 1 / (2 * r) * self._prev_x_start
+
+        x_next = (sigma_next / sigma) * x_t - alpha_next * torch.expm1(-h) * d
+        x_next = torch.where(last, x_start, x_next)
+
+        self._prev_x_start, self._prev_h = x_start, h
+        return x_next, x_start
+
+
+class ConvergenceMonitor:
+    """
+    Early exit of the sampling loop: a sample leaves the batch, with its
+    predicted x_0 as the final sample, once that prediction has been stable
+    for window consecutive steps. Stable means the continuous attributes
+    (bbox, objfeat) moved by at most tolerance and the class labels and the
+    objectness did not change. Samples without the class channels (the
+    translations and angles of the rearrangement) only have continuous ones.
+    """
+    def __init__(self, tolerance=1e-3, window=20):
+        self.tolerance = tolerance
+        self.window = window
+
+    def reset(self, diffusion, shape, num_steps, device):
+        bbox_dim, class_dim, objectness_dim = diffusion.bbox_dim, diffusion.class_dim, diffusion.objectness_dim
+        if shape[-1] >= bbox_dim + class_dim:
+            self._class = slice(bbox_dim, bbox_dim + class_dim)
+            self._objectness = slice(bbox_dim + class_dim, bbox_dim + class_dim + objectness_dim) if objectness_dim > 0 else None
+            self._continuous = [slice(0, bbox_dim), slice(bbox_dim + class_dim + objectness_dim, None)]
+        else:
+            self._class, self._objectness = None, None
+            self._continuous = [slice(0, None)]
+        batch_size = shape[0]
+        self._prev_x0 = None
+        self._stable = torch.zeros(batch_size, dtype=torch.int64, device=device)
+        # the samples still in the batch, in the order of the batch
+        self.active = torch.arange(batch_size, device=device)
+        self.steps = torch.zeros(batch_size, dtype=torch.int64, device=device)
+        self.num_steps = num_steps
+
+    @property
+    def steps_saved(self):
+        """The sampling steps skipped by every sample of the last run."""
+        return self.num_steps - self.steps
+
+    def update(self, pred_x0):
+        """Count a step of the active samples, returns the mask of those that converged."""
+        self.steps[self.active] += 1
+        if self._prev_x0 is not None:
+            prev = self._prev_x0
+            stable = torch.ones(pred_x0.shape[0], dtype=torch.bool, device=pred_x0.device)
+            if self._class is not None:
+                stable &= (pred_x0[..., self._class].argmax(dim=-1) == prev[..., self._class].argmax(dim=-1)).all(dim=1)
+            if self._objectness is not None:
+                stable &= ((pred_x0[..., self._objectness] > 0) == (prev[..., self._objectness] > 0)).flatten(1).all(dim=1)
+            for s in self._continuous:
+                if pred_x0[..., s].shape[-1] > 0:
+                    stable &= (pred_x0[..., s] - prev[..., s]).abs().flatten(1).amax(dim=1) <= self.tolerance
+            self._stable = torch.where(stable, self._stable + 1, torch.zeros_like(self._stable))
+            self._prev_x0.copy_(pred_x0)
+        else:
+            self._prev_x0 = pred_x0.clone()
+        return self._stable >= self.window
+
+    def select_(self, index):
+        self.active = self.active[index]
+        self._stable = self._stable[index]
+        self._prev_x0 = self._prev_x0[index]
+
+
+class DeepCache:
+    """
+    Feature reuse across adjacent steps (DeepCache, https://arxiv.org/abs/2312.00858):
+    the deep features of a Unet1D denoiser (all but its outermost down / up
+    levels) are only recomputed every interval denoiser calls, the calls in
+    between reuse them and run the shallow levels alone. Counts calls, not
+    timesteps, so it applies to any sampler making one call per step.
+    """
+    def __init__(self, interval=3):
+        assert interval >= 1
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.features = None
+        self.calls = 0
+        self.refreshes = 0
+
+    def lookup(self, x):
+        """The cached deep features for the shallow features x, None when they are due to be recomputed."""
+        hit = self.features is not None and self.calls % self.interval != 0 and \
+            self.features.shape[0] == x.shape[0]
+        self.calls += 1
+        return self.features if hit else None
+
+    def store(self, features):
+        self.features = features
+        self.refreshes += 1
+
+    def invalidate(self):
+        """Recompute the deep features on the next call, e.g. when its slots changed."""
+        self.features = None
+
+    def select_(self, index):
+        if self.features is not None:
+            self.features = self.features[index]
+
+
+class SlotPruner:
+    """
+    Dynamic pruning of the empty object slots: a slot whose predicted x_0 has
+    been confidently empty (GaussianDiffusion.emptiness >= threshold, from
+    the objectness channel or else the empty class channel) for window
+    consecutive steps is frozen to that prediction and dropped from the
+    denoiser inputs. The remaining slots of every sample are packed first,
+    padded to the longest sample with frozen slots, and the padding is masked
+    in the attention layers. The given slots (scene completion) and the last
+    slot of a sample are never frozen.
+    """
+    def __init__(self, threshold=0.5, window=10):
+        self.threshold = threshold
+        self.window = window
+
+    def reset(self, diffusion, shape, num_known, device):
+        batch_size, num_points, _ = shape
+        self._emptiness = diffusion.emptiness
+        self.num_known = num_known
+        self.frozen = torch.zeros(batch_size, num_points, dtype=torch.bool, device=device)
+        self.values = torch.zeros(shape, device=device)
+        self._count = torch.zeros(batch_size, num_points, dtype=torch.int64, device=device)
+        # the slots given to the denoiser (None for all of them) and their padding mask
+        self.slots, self.valid = None, None
+        # slots denoised / slots of the unpruned denoiser calls
+        self.denoised_slots, self.total_slots = 0, 0
+
+    @property
+    def slots_saved(self):
+        """The fraction of the slot evaluations of the denoiser skipped in the last run."""
+        return 1. - self.denoised_slots / max(self.total_slots, 1)
+
+    def update(self, pred_x0):
+        """Count the empty predictions of a step, returns whether slots were frozen."""
+        empty = self._emptiness(pred_x0) >= self.threshold
+        empty[:, :self.num_known] = False
+        self._count = torch.where(empty & ~self.frozen, self._count + 1, torch.zeros_like(self._count))
+        freeze = self._count >= self.window
+        # keep the first slot not frozen yet of the samples that would have none left
+        none_left = ~(~self.frozen & ~freeze).any(dim=1) & freeze.any(dim=1)
+        if none_left.any():
+            first = (~self.frozen).int().argmax(dim=1)
+            freeze[none_left, first[none_left]] = False
+        if not freeze.any():
+            return False
+        self.values[freeze] = pred_x0[freeze]
+        self.frozen |= freeze
+        self._pack()
+        return True
+
+    def _pack(self):
+        num_slots = int((~self.frozen).sum(dim=1).max())
+        # stable sort: the slots left in their order, then the frozen ones as padding
+        order = torch.sort(self.frozen.int(), dim=1, stable=True).indices[:, :num_slots]
+        self.slots, self.valid = order, ~self.frozen.gather(1, order)
+
+    def apply(self, x, inplace=True):
+        """x with the values of the frozen slots."""
+        if self.slots is None:
+            return x
+        if inplace:
+            x[self.frozen] = self.values[self.frozen]
+            return x
+        return torch.where(self.frozen[..., None], self.values, x)
+
+    def wrap(self, denoise_fn):
+        """denoise_fn evaluated on the slots left only, the frozen slots get a zero output."""
+        def pruned_denoise_fn(x, t, condition, condition_cross):
+            self.total_slots += x.shape[0] * x.shape[1]
+            if self.slots is None:
+                self.denoised_slots += x.shape[0] * x.shape[1]
+                return denoise_fn(x, t, condition, condition_cross)
+            gather = lambda v: v.gather(1, self.slots[..., None].expand(-1, -1, v.shape[-1]))
+            if condition is not None and condition.dim() == 3 and condition.shape[1] == x.shape[1]:
+                condition = gather(condition)
+            self.denoised_slots += self.slots.numel()
+            out = denoise_fn(gather(x), t, condition, condition_cross, mask=self.valid)
+            full = torch.zeros_like(x)
+            batch_index = torch.arange(x.shape[0], device=x.device)[:, None].expand_as(self.slots)
+            full[batch_index[self.valid], self.slots[self.valid]] = out[self.valid]
+            return full
+        return pruned_denoise_fn
+
+    def select_(self, index):
+        self.frozen, self.values, self._count = self.frozen[index], self.values[index], self._count[index]
+        if self.slots is not None:
+            self._pack()
+
+
+def distillation_grid(teacher_timesteps):
+    """
+    (t, t_mid, t_next) rows of the progressive distillation of a DDIM sampler
+    visiting the (t, t_next) steps teacher_timesteps: the student keeps every
+    other timestep of the teacher, so each of its steps covers two teacher
+    steps t -> t_mid -> t_next. With an odd number of teacher steps, the last
+    student step is the last teacher step (t_mid == t_next).
+    """
+    grid = []
+    for i in range(0, len(teacher_timesteps), 2):
+        t, t_mid = teacher_timesteps[i]
+        t_next = teacher_timesteps[i + 1][1] if i + 1 < len(teacher_timesteps) else t_mid
+        grid.append((t, t_mid, t_next))
+    return torch.tensor(grid, dtype=torch.int64)
+
+
+def sampler_factory(diffusion, config=None):
+    """Based on the provided config create the suitable sampler."""
+    config = config or {}
+    sampler = config.get("type", "ddpm")
+
+    if sampler == "ddpm":
+        sampler = DDPMSampler(diffusion, num_steps=config.get("num_steps", None))
+    elif sampler == "ddim":
+        sampler = DDIMSampler(
+            diffusion,
+            num_steps=config.get("num_steps", 50),
+            eta=config.get("eta", 0.),
+            use_timesteps=config.get("timesteps", None)
+        )
+    elif sampler == "dpm_solver":
+        sampler = DPMSolverSampler(
+            diffusion,
+            num_steps=config.get("num_steps", 20),
+            order=config.get("order", 2)
+        )
+    else:
+        raise NotImplementedError(sampler)
+    sampler.early_exit = early_exit_factory(config)
+    sampler.parallel = parallel_config(config)
+    sampler.deep_cache = deep_cache_factory(config)
+    sampler.prune_empty = prune_empty_factory(config)
+    return sampler
+
+
+def prune_empty_factory(config=None):
+    """The SlotPruner of the "prune_empty" entry of a sampler config, if any."""
+    prune_empty = (config or {}).get("prune_empty", None)
+    if not prune_empty:
+        return None
+    return SlotPruner(threshold=prune_empty.get("threshold", 0.5), window=prune_empty.get("window", 10))
+
+
+def deep_cache_factory(config=None):
+    """The DeepCache of the "deep_cache" entry of a sampler config, if any."""
+    deep_cache = (config or {}).get("deep_cache", None)
+    if not deep_cache:
+        return None
+    return DeepCache(interval=deep_cache.get("interval", 3))
+
+
+def parallel_config(config=None):
+    """The Picard sampling parameters of the "parallel" entry of a sampler config, if any."""
+    parallel = (config or {}).get("parallel", None)
+    if not parallel:
+        return None
+    return {"window": parallel.get("window", 16), "tolerance": parallel.get("tolerance", 0.1)}
+
+
+def early_exit_factory(config=None):
+    """The ConvergenceMonitor of the "early_exit" entry of a sampler config, if any."""
+    early_exit = (config or {}).get("early_exit", None)
+    if not early_exit:
+        return None
+    return ConvergenceMonitor(
+        tolerance=early_exit.get("tolerance", 1e-3),
+        window=early_exit.get("window", 20)
+    )
@@ -0,0 +1,181 @@
+import time
+from collections import OrderedDict, deque
+from functools import partial
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from .samplers import DDIMSampler, DDPMSampler, sampler_factory
+
+
+class GenerationJob:
+    """
+    A scene to sample with ContinuousBatchScheduler: its condition (N, C) and
+    condition_cross ((L, D) tokens or a (D,) vector), without batch dimension,
+    the config of its sampler, e.g. {"type": "ddim", "num_steps": 25}, and
+    optionally its initial noise x_T (drawn when it joins the batch otherwise).
+    """
+    def __init__(self, condition=None, condition_cross=None, sampler=None, x_T=None, job_id=None):
+        self.condition = condition
+        self.condition_cross = condition_cross
+        self.sampler = sampler or {"type": "ddim", "num_steps": 50}
+        self.x_T = x_T
+        self.job_id = job_id
+        # filled by the scheduler
+        self.result = None
+        self.submitted = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def latency(self):
+        """Seconds from submit to the last step."""
+        return self.finished - self.submitted
+
+
+def _condition_shapes(job):
+    """
+    The shape of the condition of job and the kind of its condition_cross,
+    (dim,) for a vector and (None, dim) for tokens of any length, None when absent.
+    """
+    condition = tuple(job.condition.shape) if job.condition is not None else None
+    cross = job.condition_cross
+    if cross is None:
+        return condition, None
+    return condition, ((cross.shape[-1],) if cross.dim() == 1 else (None, cross.shape[-1]))
+
+
+class _Slot:
+    def __init__(self, job, key, timesteps, x):
+        self.job = job
+        self.key = key
+        # the slots of a denoiser call share the sampler step and the shapes of the conditions
+        self.group = (key, _condition_shapes(job))
+        self.timesteps = timesteps
+        self.index = 0
+        self.x = x
+
+
+class ContinuousBatchScheduler:
+    """
+    Continuous (iteration-level) batching of a stream of sampling jobs. At most
+    max_batch_size samples are active, each at its own timestep; every step()
+    advances all of them by one step of their sampler in one batched denoiser
+    call, a sample leaves its slot as soon as its last step is done and a
+    waiting job takes the slot at the next step, instead of waiting for the
+    whole batch to finish. With continuous=False, jobs only join an empty
+    batch (static batching, for comparison).
+    The samplers must be stateless: the ddim ones with the same eta share the
+    denoiser call whatever their number of steps (the step only depends on
+    t and t_next of every sample), the ddpm ones when they have the same chain.
+    The jobs share a denoiser call when their conditions batch together: same
+    condition shape, and condition_cross both absent, vectors or tokens (of
+    any length, padded and masked).
+    """
+    def __init__(self, diffusion, denoise_fn, shape, max_batch_size=16, device="cpu", noise_fn=torch.randn,
+                 clip_denoised=True, continuous=True):
+        # diffusion: the GaussianDiffusion, denoise_fn: its denoiser, e.g. DiffusionPoint._denoise
+        # shape: (num_points, point_dim) of a sample
+        self.diffusion = diffusion
+        self.denoise_fn = denoise_fn
+        self.shape = tuple(shape)
+        self.max_batch_size = max_batch_size
+        self.device = device
+        self.noise_fn = noise_fn
+        self.clip_denoised = clip_denoised
+        self.continuous = continuous
+        self.waiting = deque()
+        self.active = []
+        self._samplers = {}
+        self._timesteps = {}
+        # statistics: denoiser calls and the sum of their batch sizes
+        self.denoiser_calls = 0
+        self.denoised_samples = 0
+
+    def _sampler(self, config):
+        """The sampler of a job config and the key of the samplers stepping with it."""
+        key = repr(sorted(config.items()))
+        if key not in self._timesteps:
+            sampler = sampler_factory(self.diffusion, config)
+            if not isinstance(sampler, (DDPMSampler, DDIMSampler)):
+                raise NotImplementedError("continuous batching needs a ddpm / ddim sampler, got {}".format(config))
+            if sampler.early_exit is not None or sampler.parallel is not None or \
+                    sampler.deep_cache is not None or sampler.prune_empty is not None:
+                raise NotImplementedError("no early exit / parallel / deep cache / slot pruning with continuous batching")
+            if isinstance(sampler, DDIMSampler):
+                step_key = ("ddim", sampler.eta)
+            else:
+                step_key = ("ddpm", tuple(sampler.use_timesteps))
+            self._samplers.setdefault(step_key, sampler)
+            self._timesteps[key] = (step_key, sampler.timesteps())
+        return self._timesteps[key]
+
+    def submit(self, job):
+        """Queue job, it is sampled from the next step with a free slot."""
+        # fails early on unsupported samplers
+        self._sampler(job.sampler)
+        job.submitted = time.perf_counter()
+        self.waiting.append(job)
+        return job
+
+    def _admit(self):
+        if not self.continuous and self.active:
+            return
+        while self.waiting and len(self.active) < self.max_batch_size:
+            job = self.waiting.popleft()
+            key, timesteps = self._sampler(job.sampler)
+            job.started = time.perf_counter()
+            x = job.x_T if job.x_T is not None else self.noise_fn(size=self.shape, dtype=torch.float, device=self.device)
+            self.active.append(_Slot(job, key, timesteps, x))
+
+    def _condition_cross(self, slots):
+        """The batched condition_cross of slots and the mask of its valid tokens, if needed."""
+        cross = [slot.job.condition_cross for slot in slots]
+        if cross[0] is None:
+            return None, None
+        if cross[0].dim() == 1:
+            return torch.stack(cross), None
+        lengths = torch.tensor([c.shape[0] for c in cross], device=cross[0].device)
+        condition_cross = pad_sequence(cross, batch_first=True)
+        if bool((lengths == lengths[0]).all()):
+            return condition_cross, None
+        return condition_cross, torch.arange(condition_cross.shape[1], device=lengths.device)[None, :] < lengths[:, None]
+
+    def step(self):
+        """Advance every active sample by one step, return the jobs finished by it."""
+        self._admit()
+        groups = OrderedDict()
+        for slot in self.active:
+            groups.setdefault(slot.group, []).append(slot)
+
+        for slots in groups.values():
+            x = torch.stack([slot.x for slot in slots])
+            t = torch.tensor([slot.timesteps[slot.index][0] for slot in slots], dtype=torch.int64, device=self.device)
+            t_next = torch.tensor([slot.timesteps[slot.index][1] for slot in slots], dtype=torch.int64, device=self.device)
+            condition = torch.stack([slot.job.condition for slot in slots]) if slots[0].job.condition is not None else None
+            condition_cross, context_mask = self._condition_cross(slots)
+            denoise_fn = partial(self.denoise_fn, context_mask=context_mask) if context_mask is not None else self.denoise_fn
+
+            x_next, _ = self._samplers[slots[0].key].step(denoise_fn, x, t, t_next, condition, condition_cross,
+                                                          noise_fn=self.noise_fn, clip_denoised=self.clip_denoised)
+            for slot, x_i in zip(slots, x_next):
+                slot.x = x_i
+                slot.index += 1
+            self.denoiser_calls += 1
+            self.denoised_samples += len(slots)
+
+        finished = [slot for slot in self.active if slot.index == len(slot.timesteps)]
+        if finished:
+            now = time.perf_counter()
+            self.active = [slot for slot in self.active if slot.index < len(slot.timesteps)]
+            for slot in finished:
+                slot.job.result = slot.x
+                slot.job.finished = now
+        return [slot.job for slot in finished]
+
+    def run(self):
+        """Step until no job is waiting or active, return the finished jobs in order of completion."""
+        finished = []
+        while self.waiting or self.active:
+            finished.extend(self.step())
+        return finished
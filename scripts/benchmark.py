@@ -0,0 +1,1452 @@
+"""Script used for micro-benchmarking the diffusion building blocks on CPU."""
+import argparse
+import copy
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from einops import rearrange
+
+from training_utils import load_config
+
+from scene_synthesis.datasets import get_encoded_dataset, filter_function, LengthBucketBatchSampler
+
+from scene_synthesis.networks.denoise_net import Unet1D, Attention, AttentionCross, LinearAttention, \
+    LinearAttentionCross, AttentionLast, LinearAttentionLast, LinearAttentionCrossLast, channels_last_state_dict
+from scene_synthesis.networks import build_network
+from scene_synthesis.networks.diffusion_ddpm import DiffusionPoint
+from scene_synthesis.networks.loss import axis_aligned_bbox_overlaps_3d, \
+    axis_aligned_bbox_pairwise_overlaps_3d
+from scene_synthesis.networks.inference import CompiledDDPMSampler, OnnxDenoiser, OnnxSampler, export_onnx
+from scene_synthesis.networks.quantization import quantize_denoiser
+from scene_synthesis.networks.samplers import DDPMSampler, sampler_factory
+from scene_synthesis.networks.scheduler import ContinuousBatchScheduler, GenerationJob
+
+
+def timeit(fn, n_warmup=3, n_repeats=20):
+    """Return the mean and std wall-clock time (in ms) of calling fn()."""
+    for _ in range(n_warmup):
+        fn()
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000.0)
+    return float(np.mean(times)), float(np.std(times))
+
+
+def random_boxes(batch_size, num_boxes, empty_ratio=0.5):
+    """Random axis aligned boxes <x1, y1, z1, x2, y2, z2> and a valid mask."""
+    centers = torch.rand(batch_size, num_boxes, 3) * 6 - 3
+    sizes = torch.rand(batch_size, num_boxes, 3) * 0.9 + 0.1
+    boxes = torch.cat([centers - sizes, centers + sizes], dim=-1)
+    valid_mask = (torch.rand(batch_size, num_boxes) >= empty_ratio).float()
+    return boxes, valid_mask
+
+
+def build_diffusion(config):
+    """A randomly initialized Unet1D wrapped in the diffusion of the given config."""
+    network_config = config["network"]
+    diffusion_kwargs = dict(network_config["diffusion_kwargs"], loss_iou=False, train_stats_file=None)
+    denoise_net = Unet1D(**network_config["net_kwargs"])
+    return DiffusionPoint(denoise_net, network_config, **diffusion_kwargs).eval()
+
+
+def random_condition(config, batch_size):
+    """Random condition / cross-attention context matching the denoiser inputs."""
+    net_kwargs = config["network"]["net_kwargs"]
+    num_points = config["network"]["sample_num_points"]
+    condition_dim = net_kwargs.get("context_dim", 256) + net_kwargs.get("instanclass_dim", 0)
+    condition = torch.randn(batch_size, num_points, condition_dim) if condition_dim > 0 else None
+    if net_kwargs.get("text_condition", False):
+        condition_cross = torch.randn(batch_size, 16, net_kwargs.get("text_dim", 256))
+    else:
+        condition_cross = None
+    return condition, condition_cross
+
+
+def parse_samplers(x):
+    """Comma separated list of <type>[:<num_steps>], e.g. ddpm,ddim:50,dpm_solver:20"""
+    samplers = []
+    for item in x.split(","):
+        name, _, num_steps = item.partition(":")
+        samplers.append(dict({"type": name}, **({"num_steps": int(num_steps)} if num_steps else {})))
+    return samplers
+
+
+def benchmark_samplers(args):
+    config = load_config(args.config_file)
+    diffusion = build_diffusion(config)
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    shape = (args.batch_size, num_points, point_dim)
+    condition, condition_cross = random_condition(config, args.batch_size)
+    partial_boxes = torch.rand(args.batch_size, args.num_partial, point_dim) * 2 - 1
+
+    print("Scene completion of {} scenes with {} given objects".format(args.batch_size, args.num_partial))
+    for sampler_config in args.samplers:
+        sampler = sampler_factory(diffusion.diffusion, sampler_config)
+
+        def complete():
+            return diffusion.complete_samples(shape, "cpu", condition=condition, condition_cross=condition_cross,
+                                              partial_boxes=partial_boxes, sampler=sampler)
+
+        # the given objects coming out unchanged is checked by tests/test_samplers.py
+        t_mean, t_std = timeit(complete, n_warmup=1, n_repeats=args.n_repeats)
+        print("{:12s} - {:4d} steps: {:.1f} +- {:.1f} ms/batch".format(
+            sampler_config["type"], sampler.num_steps, t_mean, t_std))
+
+
+def benchmark_bpd(args):
+    config = load_config(args.config_file)
+    diffusion = build_diffusion(config)
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    x0 = torch.rand(args.batch_size, num_points, point_dim) * 2 - 1
+    condition, condition_cross = random_condition(config, args.batch_size)
+    num_timesteps = diffusion.diffusion.num_timesteps
+
+    print("Bits per dim of {} layouts, {} timesteps".format(args.batch_size, num_timesteps))
+    exact = {}
+    for max_batch_size in [args.batch_size, args.max_batch_size]:
+        def calc_bpd():
+            exact[max_batch_size] = diffusion.all_kl(x0, condition, condition_cross, max_batch_size=max_batch_size)
+        t_mean, _ = timeit(calc_bpd, n_warmup=0, n_repeats=1)
+        print("exact - {:4d} timesteps per call: {:.1f} ms - total bpd: {:.4f}".format(
+            max_batch_size // args.batch_size, t_mean, float(exact[max_batch_size]["total_bpd_b"])))
+    total_bpd = float(exact[args.max_batch_size]["total_bpd_b"])
+
+    proposals = {
+        "uniform": None,
+        "sqrt(E[L_t^2])": diffusion.vlb_proposal(x0, condition, condition_cross, max_batch_size=args.max_batch_size),
+    }
+    for name, proposal in proposals.items():
+        for num_samples in args.num_samples:
+            estimates = []
+
+            def estimate():
+                bpd = diffusion.bpd_estimate(x0, condition, condition_cross, num_samples=num_samples, proposal=proposal,
+                                             max_batch_size=args.max_batch_size)
+                estimates.append(float(bpd["total_bpd_b"].mean()))
+
+            t_mean, t_std = timeit(estimate, n_warmup=0, n_repeats=args.n_repeats)
+            assert np.isfinite(estimates).all()
+            print("{:14s} K={:4d}: {:.1f} +- {:.1f} ms - total bpd: {:.4f} +- {:.4f} (rel. error {:.2%})".format(
+                name, num_samples, t_mean, t_std, np.mean(estimates), np.std(estimates),
+                abs(np.mean(estimates) - total_bpd) / abs(total_bpd)))
+
+
+def benchmark_compile(args):
+    config = load_config(args.config_file)
+    diffusion = build_diffusion(config)
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    x_t = torch.randn(args.batch_size, num_points, point_dim)
+    t = torch.full((args.batch_size,), diffusion.diffusion.num_timesteps // 2, dtype=torch.int64)
+    condition, condition_cross = random_condition(config, args.batch_size)
+    noise = torch.randn_like(x_t)
+    noise_fn = lambda size, dtype, device: noise
+
+    def step_fn(sampler):
+        return lambda: sampler.step(diffusion._denoise, x_t, t, t - 1, condition, condition_cross, noise_fn=noise_fn, clip_denoised=True)
+
+    reference, _ = step_fn(DDPMSampler(diffusion.diffusion))()
+    t_eager, s_eager = timeit(step_fn(DDPMSampler(diffusion.diffusion)), n_repeats=args.n_repeats)
+    print("Denoising step of {} scenes on {} threads".format(args.batch_size, torch.get_num_threads()))
+    print("{:8s} - {:.2f} +- {:.2f} ms/step".format("p_sample", t_eager, s_eager))
+
+    net_config = config["network"]["net_kwargs"]
+    for backend in args.backends:
+        if backend == "compile" and not hasattr(torch, "compile"):
+            print("{:8s} - skipped, requires torch >= 2.0".format(backend))
+            continue
+        # the first call builds (or loads from the cache) the step
+        for start in ["cold", "warm"]:
+            sampler = CompiledDDPMSampler(diffusion.diffusion, diffusion.model, backend=backend, cache_dir=args.cache_dir,
+                                          net_config=net_config)
+            t_build, _ = timeit(step_fn(sampler), n_warmup=0, n_repeats=1)
+            if backend == "eager":
+                break
+        x_next, _ = step_fn(sampler)()
+        assert torch.allclose(x_next, reference, atol=1e-4), (x_next - reference).abs().max()
+
+        t_mean, t_std = timeit(step_fn(sampler), n_repeats=args.n_repeats)
+        print("{:8s} - {:.2f} +- {:.2f} ms/step - speedup: {:.2f}x - first step ({} start): {:.0f} ms".format(
+            backend, t_mean, t_std, t_eager / t_mean, start, t_build))
+
+
+def benchmark_onnx(args):
+    config = load_config(args.config_file)
+    diffusion = build_diffusion(config)
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    num_timesteps = diffusion.diffusion.num_timesteps
+
+    path = os.path.join(tempfile.mkdtemp(), "denoiser.onnx")
+    condition, condition_cross = random_condition(config, 2)
+    export_onnx(diffusion.model, path, torch.randn(2, num_points, point_dim), torch.zeros(2, dtype=torch.int64),
+                condition, condition_cross)
+    denoiser = OnnxDenoiser(path, num_threads=args.n_threads)
+
+    # the batch size is dynamic, time other ones than the exported one
+    print("Denoiser call, onnxruntime vs pytorch")
+    for batch_size in [1, args.batch_size]:
+        x_t = torch.randn(batch_size, num_points, point_dim)
+        t = torch.randint(0, num_timesteps, size=(batch_size,))
+        condition, condition_cross = random_condition(config, batch_size)
+        out = diffusion._denoise(x_t, t, condition, condition_cross)
+        out_onnx = denoiser(x_t, t, condition, condition_cross)
+
+        t_torch, s_torch = timeit(lambda: diffusion._denoise(x_t, t, condition, condition_cross), n_repeats=args.n_repeats)
+        t_onnx, s_onnx = timeit(lambda: denoiser(x_t, t, condition, condition_cross), n_repeats=args.n_repeats)
+        print("B={:3d} - pytorch: {:.2f} +- {:.2f} ms - onnxruntime: {:.2f} +- {:.2f} ms - speedup: {:.2f}x - max abs diff: {:.2e}".format(
+            batch_size, t_torch, s_torch, t_onnx, s_onnx, t_torch / t_onnx, float((out - out_onnx).abs().max())))
+
+    # the same deterministic sampling loop driven by both
+    shape = (args.batch_size, num_points, point_dim)
+    condition, condition_cross = random_condition(config, args.batch_size)
+    sampler_config = {"type": "ddim", "num_steps": args.sampling_steps}
+    samples = {}
+    for name, sampler in [
+        ("pytorch", sampler_factory(diffusion.diffusion, sampler_config)),
+        ("onnxruntime", OnnxSampler(sampler_factory(diffusion.diffusion, sampler_config), diffusion.model,
+                                    cache_dir=os.path.dirname(path), num_threads=args.n_threads)),
+    ]:
+        def sample():
+            torch.manual_seed(0)
+            samples[name] = diffusion.gen_samples(shape, "cpu", condition=condition, condition_cross=condition_cross, sampler=sampler)
+        t_mean, t_std = timeit(sample, n_warmup=1, n_repeats=max(1, args.n_repeats // 10))
+        print("{:12s} - ddim:{} sampling: {:.1f} +- {:.1f} ms/batch".format(name, args.sampling_steps, t_mean, t_std))
+    # the agreement within tolerance is checked by tests/test_onnx.py
+    print("max abs diff of the samples: {:.2e}".format(float((samples["pytorch"] - samples["onnxruntime"]).abs().max())))
+
+
+def state_dict_size(module):
+    """Size in MB of the serialized state dict."""
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+
+def benchmark_quantize(args):
+    config = load_config(args.config_file)
+    network_config = config["network"]
+    num_points = network_config["sample_num_points"]
+    point_dim = network_config["point_dim"]
+    bbox_dim = network_config.get("translation_dim", 3) + network_config.get("size_dim", 3) + network_config.get("angle_dim", 1)
+    class_dim = network_config.get("class_dim", 21)
+    objfeat_dim = network_config.get("objfeat_dim", 0)
+
+    diffusion = build_diffusion(config)
+    num_timesteps = diffusion.diffusion.num_timesteps
+    x_t = torch.randn(args.batch_size, num_points, point_dim)
+    t = torch.randint(0, num_timesteps, size=(args.batch_size,))
+    condition, condition_cross = random_condition(config, args.batch_size)
+    shape = (args.batch_size, num_points, point_dim)
+    sampler_config = {"type": "ddim", "num_steps": args.sampling_steps}
+
+    def sample(model):
+        torch.manual_seed(0)
+        return model.gen_samples(shape, "cpu", condition=condition, condition_cross=condition_cross,
+                                 sampler=sampler_factory(model.diffusion, sampler_config))
+
+    def calibrate_fn(model):
+        # no dataset here: noised random layouts at random timesteps
+        def fn():
+            for _ in range(args.calibration_rooms // args.batch_size):
+                t_ = torch.randint(0, num_timesteps, size=(args.batch_size,))
+                x_ = model.diffusion.q_sample(torch.rand(shape) * 2 - 1, t_)
+                model._denoise(x_, t_, condition, condition_cross)
+        return fn
+
+    reference = sample(diffusion)
+    # a bank of object features standing in for the 3D-FUTURE models of the retrieval
+    bank = torch.randn(1000, objfeat_dim) if objfeat_dim > 0 else None
+
+    print("int8 quantization of the denoiser, batch size {}".format(args.batch_size))
+    for mode in ["fp32", "dynamic", "static"]:
+        model = copy.deepcopy(diffusion)
+        if mode != "fp32":
+            quantize_denoiser(model.model, mode, calibrate_fn(model))
+        t_mean, t_std = timeit(lambda: model._denoise(x_t, t, condition, condition_cross), n_repeats=args.n_repeats)
+        samples = sample(model)
+
+        # retrieval-level outputs: empty slots, object classes and retrieved objects
+        empty, ref_empty = samples[:, :, bbox_dim+class_dim-1] >= 0, reference[:, :, bbox_dim+class_dim-1] >= 0
+        classes = torch.argmax(samples[:, :, bbox_dim:bbox_dim+class_dim-1], dim=-1)
+        ref_classes = torch.argmax(reference[:, :, bbox_dim:bbox_dim+class_dim-1], dim=-1)
+        stats = "empty agreement: {:.3f} - class agreement: {:.3f} - bbox MAE: {:.4f}".format(
+            float((empty == ref_empty).float().mean()), float((classes == ref_classes).float().mean()),
+            float((samples[:, :, :bbox_dim] - reference[:, :, :bbox_dim]).abs().mean()))
+        if bank is not None:
+            objfeats = samples[:, :, -objfeat_dim:].reshape(-1, objfeat_dim)
+            ref_objfeats = reference[:, :, -objfeat_dim:].reshape(-1, objfeat_dim)
+            retrieved = torch.cdist(objfeats, bank).argmin(dim=-1)
+            ref_retrieved = torch.cdist(ref_objfeats, bank).argmin(dim=-1)
+            stats += " - retrieval agreement: {:.3f}".format(float((retrieved == ref_retrieved).float().mean()))
+
+        print("{:8s} - {:.2f} +- {:.2f} ms/call - {:.1f} MB - {}".format(mode, t_mean, t_std, state_dict_size(model.model), stats))
+
+
+def count_allocations(fn):
+    """Number and total size (in MB) of the CPU tensor allocations made by fn()."""
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    sizes = [e.cpu_memory_usage for e in prof.events() if e.name == "[memory]" and e.cpu_memory_usage > 0]
+    return len(sizes), sum(sizes) / 2 ** 20
+
+
+def benchmark_alloc(args):
+    config = load_config(args.config_file)
+    diffusion = build_diffusion(config)
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    shape = (args.batch_size, num_points, point_dim)
+    condition, condition_cross = random_condition(config, args.batch_size)
+
+    # a denoiser writing into a fixed tensor isolates the allocations of the loop itself
+    model_output = torch.empty(shape)
+    stub_fn = lambda x, t, c, c_cross: torch.mul(x, 0.5, out=model_output)
+
+    print("Tensor allocations of the sampling loop of {} scenes".format(args.batch_size))
+    for sampler_config in args.samplers:
+        for denoiser, denoise_fn in [("stub", stub_fn), ("Unet1D", diffusion._denoise)]:
+            for inplace in [False, True]:
+                row = []
+                for num_steps in args.num_steps:
+                    sampler = sampler_factory(diffusion.diffusion, dict(sampler_config, num_steps=num_steps))
+                    n_allocs, size = count_allocations(lambda: diffusion.diffusion.sample_loop(
+                        denoise_fn, shape, "cpu", condition, condition_cross, sampler=sampler, inplace=inplace))
+                    row.append("{:5d} steps: {:7d} allocs ({:.2f}/step, {:.1f} MB)".format(
+                        sampler.num_steps, n_allocs, n_allocs / sampler.num_steps, size))
+                print("{:10s} - {:6s} - {:8s} - {}".format(
+                    sampler_config["type"], denoiser, "step_" if inplace else "step", " - ".join(row)))
+
+
+def benchmark_layout(args):
+    config = load_config(args.config_file)
+    net_kwargs = config["network"]["net_kwargs"]
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    channels_first = Unet1D(**dict(net_kwargs, channels_last=False)).eval()
+    channels_last = Unet1D(**dict(net_kwargs, channels_last=True)).eval()
+    # the channels-first checkpoint loads into the channels-last network
+    channels_last.load_state_dict(channels_first.state_dict())
+
+    print("Unet1D forward on {} threads".format(torch.get_num_threads()))
+    for batch_size in args.batch_sizes:
+        x = torch.randn(batch_size, num_points, point_dim)
+        t = torch.randint(0, 1000, (batch_size,))
+        condition, condition_cross = random_condition(config, batch_size)
+        reference = channels_first(x, t, condition, condition_cross)
+        out = channels_last(x, t, condition, condition_cross)
+        assert torch.allclose(out, reference, atol=1e-4), (out - reference).abs().max()
+
+        results = []
+        for name, net in [("channels-first", channels_first), ("channels-last", channels_last)]:
+            t_mean, t_std = timeit(lambda: net(x, t, condition, condition_cross), n_repeats=args.n_repeats)
+            results.append("{}: {:.2f} +- {:.2f} ms ({:.0f} scenes/s)".format(
+                name, t_mean, t_std, batch_size * 1000.0 / t_mean))
+        print("batch {:4d} - {}".format(batch_size, " - ".join(results)))
+
+
+def count_ops(fn):
+    """Number of aten operators called by fn()."""
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as prof:
+        fn()
+    return sum(1 for e in prof.events() if e.name.startswith("aten::"))
+
+
+def benchmark_fuse(args):
+    config = load_config(args.config_file)
+    net_kwargs = dict(config["network"]["net_kwargs"], seperate_all=True)
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    separate = Unet1D(**dict(net_kwargs, fuse_attribute_mlps=False)).eval()
+    fused = Unet1D(**dict(net_kwargs, fuse_attribute_mlps=True)).eval()
+    # the checkpoint of the separate MLPs loads into the fused ones
+    fused.load_state_dict(separate.state_dict())
+
+    print("Unet1D forward with separate vs fused attribute MLPs on {} threads".format(torch.get_num_threads()))
+    for batch_size in args.batch_sizes:
+        x = torch.randn(batch_size, num_points, point_dim)
+        t = torch.randint(0, 1000, (batch_size,))
+        condition, condition_cross = random_condition(config, batch_size)
+        reference = separate(x, t, condition, condition_cross)
+        out = fused(x, t, condition, condition_cross)
+        assert torch.allclose(out, reference, atol=1e-4), (out - reference).abs().max()
+
+        results = []
+        for name, net in [("separate", separate), ("fused", fused)]:
+            fn = lambda: net(x, t, condition, condition_cross)
+            t_mean, t_std = timeit(fn, n_repeats=args.n_repeats)
+            results.append("{}: {:.2f} +- {:.2f} ms, {} ops".format(name, t_mean, t_std, count_ops(fn)))
+        print("batch {:4d} - {}".format(batch_size, " - ".join(results)))
+
+
+def reference_linear_attention(module, x, context=None):
+    """The einsum chain of the channels-first (cross) linear attention layers."""
+    if context is None:
+        q, k, v = module.to_qkv(x).chunk(3, dim=1)
+    else:
+        q = module.to_q(x)
+        k, v = module.to_kv(context).chunk(2, dim=1)
+    q, k, v = map(lambda t: rearrange(t, 'b (h c) n -> b h c n', h=module.heads), (q, k, v))
+    q = q.softmax(dim=-2) * module.scale
+    k = k.softmax(dim=-1)
+    context = torch.einsum('b h d n, b h e n -> b h d e', k, v)
+    out = torch.einsum('b h d e, b h d n -> b h e n', context, q)
+    return module.to_out(rearrange(out, 'b h c n -> b (h c) n'))
+
+
+def reference_attention(module, x):
+    """The einsum chain of the channels-first softmax attention layer."""
+    q, k, v = map(lambda t: rearrange(t, 'b (h c) n -> b h c n', h=module.heads), module.to_qkv(x).chunk(3, dim=1))
+    sim = torch.einsum('b h d i, b h d j -> b h i j', q * module.scale, k)
+    out = torch.einsum('b h i j, b h d j -> b h i d', sim.softmax(dim=-1), v)
+    return module.to_out(rearrange(out, 'b h n d -> b (h d) n'))
+
+
+def benchmark_attention(args):
+    # the equivalence with the einsum chains is checked by tests/test_attention.py
+    x = torch.randn(args.batch_size, args.dim, args.num_objects)
+    context = torch.randn(args.batch_size, args.dim, args.num_tokens)
+
+    print("Attention layers on {} scenes of {} objects".format(args.batch_size, args.num_objects))
+    layers = [
+        ("Attention", Attention, AttentionLast, reference_attention, False),
+        ("LinearAttention", LinearAttention, LinearAttentionLast, reference_linear_attention, False),
+        ("LinearAttentionCross", LinearAttentionCross, LinearAttentionCrossLast, reference_linear_attention, True),
+        ("AttentionCross", AttentionCross, None, reference_linear_attention, True),
+    ]
+    for name, klass, klass_last, reference_fn, cross in layers:
+        module = klass(args.dim).eval()
+        inputs = (x, context) if cross else (x,)
+
+        results = []
+        t_ref, _ = timeit(lambda: reference_fn(module, *inputs), n_repeats=args.n_repeats)
+        t_new, _ = timeit(lambda: module(*inputs), n_repeats=args.n_repeats)
+        results.append("einsum: {:.3f} ms - fused: {:.3f} ms".format(t_ref, t_new))
+
+        if klass_last is not None:
+            module_last = klass_last(args.dim).eval()
+            module_last.load_state_dict(channels_last_state_dict(module.state_dict()))
+            inputs_last = tuple(i.transpose(1, 2).contiguous() for i in inputs)
+            t_last, _ = timeit(lambda: module_last(*inputs_last), n_repeats=args.n_repeats)
+            results.append("channels-last: {:.3f} ms".format(t_last))
+        print("{:20s} - {}".format(name, " - ".join(results)))
+
+
+def train_steps(config_file, net_kwargs, batch_size, n_repeats, n_threads=None):
+    """Mean / std time (ms) of a training step and peak RSS (MB) of the process."""
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    config = load_config(config_file)
+    config["network"]["net_kwargs"].update(net_kwargs)
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    diffusion = build_diffusion(config).train()
+    optimizer = torch.optim.AdamW(diffusion.parameters(), lr=1e-4)
+    x0 = torch.rand(batch_size, num_points, point_dim) * 2 - 1
+    condition, condition_cross = random_condition(config, batch_size)
+
+    def step():
+        optimizer.zero_grad()
+        loss, _ = diffusion.get_loss_iter(x0, condition=condition, condition_cross=condition_cross)
+        loss.backward()
+        optimizer.step()
+
+    with torch.enable_grad():
+        t_mean, t_std = timeit(step, n_warmup=1, n_repeats=n_repeats)
+    # ru_maxrss is in KB on linux
+    return t_mean, t_std, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def benchmark_checkpoint(args):
+    # every run in a fresh process, the peak RSS of a process never decreases
+    context = multiprocessing.get_context("spawn")
+    print("Training steps on {} threads".format(args.n_threads or torch.get_num_threads()))
+    for batch_size in args.batch_sizes:
+        for dim in args.dims:
+            results = []
+            for gradient_checkpointing in [False, True]:
+                net_kwargs = dict(gradient_checkpointing=gradient_checkpointing, **({"dim": dim} if dim else {}))
+                with context.Pool(1) as pool:
+                    t_mean, t_std, rss = pool.apply(train_steps, (
+                        args.config_file, net_kwargs, batch_size, args.n_repeats, args.n_threads))
+                results.append("{}: {:.0f} +- {:.0f} ms/step, peak RSS {:.0f} MB".format(
+                    "checkpointing" if gradient_checkpointing else "baseline", t_mean, t_std, rss))
+            print("batch {:4d} - dim {} - {}".format(batch_size, dim or "config", " - ".join(results)))
+
+
+def benchmark_early_exit(args):
+    config = load_config(args.config_file)
+    diffusion = build_diffusion(config)
+    if args.weight_file is not None:
+        # the denoiser of a trained DiffusionSceneLayout_DDPM
+        prefix = "diffusion.model."
+        state_dict = torch.load(args.weight_file, map_location="cpu")
+        diffusion.model.load_state_dict({k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)})
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    shape = (args.batch_size, num_points, point_dim)
+    condition, condition_cross = random_condition(config, args.batch_size)
+    gaussian_diffusion = diffusion.diffusion
+    classes = slice(gaussian_diffusion.bbox_dim, gaussian_diffusion.bbox_dim + gaussian_diffusion.class_dim)
+    early_exit = {"tolerance": args.tolerance, "window": args.window}
+
+    print("Early exit of {} scenes, tolerance {} over {} steps".format(args.batch_size, args.tolerance, args.window))
+    for sampler_config in args.samplers:
+        def sample(config):
+            sampler = sampler_factory(gaussian_diffusion, config)
+            torch.manual_seed(args.seed)
+            start = time.perf_counter()
+            samples = gaussian_diffusion.sample_loop(diffusion._denoise, shape, "cpu", condition, condition_cross,
+                                                     sampler=sampler, clip_denoised=True)
+            return samples, (time.perf_counter() - start) * 1000.0, sampler
+
+        reference, t_full, sampler = sample(sampler_config)
+        samples, t_exit, sampler_exit = sample(dict(sampler_config, early_exit=early_exit))
+
+        labels, reference_labels = samples[..., classes].argmax(-1), reference[..., classes].argmax(-1)
+        empty = gaussian_diffusion.class_dim - 1
+        print("{:10s} - {:.1f} of {} steps saved - {:.0f} vs {:.0f} ms - class agreement: {:.3f} - "
+              "objects: {:.2f} vs {:.2f} - bbox MAE: {:.4f}".format(
+                  sampler_config["type"], sampler_exit.early_exit.steps_saved.float().mean().item(), sampler.num_steps,
+                  t_exit, t_full, (labels == reference_labels).float().mean().item(),
+                  (labels != empty).float().sum(-1).mean().item(), (reference_labels != empty).float().sum(-1).mean().item(),
+                  (samples[..., :gaussian_diffusion.bbox_dim] - reference[..., :gaussian_diffusion.bbox_dim]).abs().mean().item()))
+
+
+def benchmark_picard(args):
+    config = load_config(args.config_file)
+    diffusion = build_diffusion(config)
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    shape = (args.batch_size, num_points, point_dim)
+    condition, condition_cross = random_condition(config, args.batch_size)
+    gaussian_diffusion = diffusion.diffusion
+
+    def sample(config):
+        sampler = sampler_factory(gaussian_diffusion, config)
+        torch.manual_seed(args.seed)
+        start = time.perf_counter()
+        samples = gaussian_diffusion.sample_loop(diffusion._denoise, shape, "cpu", condition, condition_cross,
+                                                 sampler=sampler, clip_denoised=True)
+        return samples, (time.perf_counter() - start) * 1000.0, sampler
+
+    print("Picard sampling of {} scenes, tolerance {}".format(args.batch_size, args.tolerance))
+    for n_threads in args.threads:
+        torch.set_num_threads(n_threads)
+        for sampler_config in args.samplers:
+            reference, t_sequential, sampler = sample(sampler_config)
+            print("{:10s} - {:2d} threads - sequential: {} calls - {:.0f} ms".format(
+                sampler_config["type"], n_threads, sampler.num_steps, t_sequential))
+            for window in args.windows:
+                parallel = {"window": window, "tolerance": args.tolerance}
+                samples, t_parallel, sampler = sample(dict(sampler_config, parallel=parallel))
+                print("{:10s} - {:2d} threads - window {:4d}: {} calls - {:.0f} ms ({:.2f}x) - max abs diff: {:.2e}".format(
+                    sampler_config["type"], n_threads, window, sampler.picard_iterations, t_parallel,
+                    t_sequential / t_parallel, (samples - reference).abs().max().item()))
+
+
+def benchmark_deep_cache(args):
+    config = load_config(args.config_file)
+    diffusion = build_diffusion(config)
+    if args.weight_file is not None:
+        prefix = "diffusion.model."
+        state_dict = torch.load(args.weight_file, map_location="cpu")
+        diffusion.model.load_state_dict({k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)})
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    shape = (args.batch_size, num_points, point_dim)
+    condition, condition_cross = random_condition(config, args.batch_size)
+    gaussian_diffusion = diffusion.diffusion
+    classes = slice(gaussian_diffusion.bbox_dim, gaussian_diffusion.bbox_dim + gaussian_diffusion.class_dim)
+
+    def sample(config):
+        sampler = sampler_factory(gaussian_diffusion, config)
+        torch.manual_seed(args.seed)
+        start = time.perf_counter()
+        samples = gaussian_diffusion.sample_loop(diffusion._denoise, shape, "cpu", condition, condition_cross,
+                                                 sampler=sampler, clip_denoised=True)
+        return samples, (time.perf_counter() - start) * 1000.0, sampler
+
+    print("DeepCache speed / quality of {} scenes, against sampling without it".format(args.batch_size))
+    for sampler_config in args.samplers:
+        reference, t_full, sampler = sample(sampler_config)
+        reference_labels = reference[..., classes].argmax(-1)
+        for interval in args.intervals:
+            samples, t_cached, sampler = sample(dict(sampler_config, deep_cache={"interval": interval}))
+            labels = samples[..., classes].argmax(-1)
+            print("{:10s} - {:4d} steps - interval {:2d}: {} deep refreshes - {:.0f} vs {:.0f} ms ({:.2f}x) - "
+                  "class agreement: {:.3f} - bbox MAE: {:.4f}".format(
+                      sampler_config["type"], sampler.num_steps, interval, sampler.deep_cache.refreshes, t_cached,
+                      t_full, t_full / t_cached, (labels == reference_labels).float().mean().item(),
+                      (samples[..., :gaussian_diffusion.bbox_dim] - reference[..., :gaussian_diffusion.bbox_dim]).abs().mean().item()))
+
+
+def benchmark_refine(args):
+    config = load_config(args.config_file)
+    diffusion = build_diffusion(config)
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    shape = (args.batch_size, num_points, point_dim)
+    condition, condition_cross = random_condition(config, args.batch_size)
+    boxes = torch.rand(shape) * 2 - 1
+
+    print("Warm-start refinement of {} scenes, {} objects kept".format(args.batch_size, args.num_fixed))
+    for sampler_config in args.samplers:
+        sampler = sampler_factory(diffusion.diffusion, sampler_config)
+
+        def generate():
+            return diffusion.gen_samples(shape, "cpu", condition=condition, condition_cross=condition_cross, sampler=sampler)
+
+        t_mean, t_std = timeit(generate, n_warmup=1, n_repeats=args.n_repeats)
+        print("{:10s} - generation: {:.1f} +- {:.1f} ms/batch".format(sampler_config["type"], t_mean, t_std))
+        for t_start in args.t_starts:
+            def refine():
+                return diffusion.refine_samples(shape, "cpu", boxes, t_start, condition=condition, condition_cross=condition_cross,
+                                                num_fixed=args.num_fixed, sampler=sampler)
+
+            # the kept objects must come out unchanged
+            assert torch.equal(refine()[:, :args.num_fixed, :], boxes[:, :args.num_fixed, :])
+            t_mean, t_std = timeit(refine, n_warmup=1, n_repeats=args.n_repeats)
+            print("{:10s} - refinement from t={:4d}: {:.1f} +- {:.1f} ms/batch".format(
+                sampler_config["type"], t_start, t_mean, t_std))
+
+
+def benchmark_prune(args):
+    config = load_config(args.config_file)
+    diffusion = build_diffusion(config)
+    if args.weight_file is not None:
+        prefix = "diffusion.model."
+        state_dict = torch.load(args.weight_file, map_location="cpu")
+        diffusion.model.load_state_dict({k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)})
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    shape = (args.batch_size, num_points, point_dim)
+    condition, condition_cross = random_condition(config, args.batch_size)
+    gaussian_diffusion = diffusion.diffusion
+    classes = slice(gaussian_diffusion.bbox_dim, gaussian_diffusion.bbox_dim + gaussian_diffusion.class_dim)
+    empty = gaussian_diffusion.class_dim - 1
+
+    def sample(config):
+        sampler = sampler_factory(gaussian_diffusion, config)
+        torch.manual_seed(args.seed)
+        start = time.perf_counter()
+        samples = gaussian_diffusion.sample_loop(diffusion._denoise, shape, "cpu", condition, condition_cross,
+                                                 sampler=sampler, clip_denoised=True)
+        return samples, (time.perf_counter() - start) * 1000.0, sampler
+
+    print("Empty slot pruning of {} scenes, threshold {}".format(args.batch_size, args.threshold))
+    for sampler_config in args.samplers:
+        reference, t_full, _ = sample(sampler_config)
+        reference_labels = reference[..., classes].argmax(-1)
+        for window in args.windows:
+            prune_empty = {"threshold": args.threshold, "window": window}
+            samples, t_pruned, sampler = sample(dict(sampler_config, prune_empty=prune_empty))
+            labels = samples[..., classes].argmax(-1)
+            print("{:10s} - window {:3d}: {:.1%} slot evaluations saved - {:.0f} vs {:.0f} ms - class agreement: {:.3f} - "
+                  "objects: {:.2f} vs {:.2f}".format(
+                      sampler_config["type"], window, sampler.prune_empty.slots_saved, t_pruned, t_full,
+                      (labels == reference_labels).float().mean().item(),
+                      (labels != empty).float().sum(-1).mean().item(), (reference_labels != empty).float().sum(-1).mean().item()))
+
+
+def benchmark_bucketing(args):
+    for config_file in args.config_files:
+        config = load_config(config_file)
+        splits = config["training"].get("splits", ["train", "val"])
+        dataset = get_encoded_dataset(
+            config["data"], filter_function(config["data"], split=splits), augmentations=None, split=splits
+        )
+        lengths = np.asarray(dataset.object_counts())
+        max_length = config["network"]["sample_num_points"]
+        point_dim = config["network"]["point_dim"]
+        diffusion = build_diffusion(config).train()
+        optimizer = torch.optim.AdamW(diffusion.parameters(), lr=1e-4)
+        x0 = torch.rand(args.batch_size, max_length, point_dim) * 2 - 1
+        condition, condition_cross = random_condition(config, args.batch_size)
+
+        samplers = {
+            "random": torch.utils.data.BatchSampler(
+                torch.utils.data.RandomSampler(range(len(lengths))), args.batch_size, drop_last=True),
+            "bucketed": LengthBucketBatchSampler(lengths, args.batch_size, pool_size=args.pool_size, drop_last=True),
+        }
+        print("{} - {} scenes, {:.1f} objects on average, padded to {}".format(
+            config_file, len(lengths), lengths.mean(), max_length))
+        for name, batch_sampler in samplers.items():
+            batches = [lengths[b] for b in batch_sampler]
+            bucketed = name == "bucketed"
+            num_points = [max(int(b.max()), 1) if bucketed else max_length for b in batches]
+            efficiency = lengths.sum() / float(sum(n * len(b) for n, b in zip(num_points, batches)))
+
+            def step(n, batch_lengths):
+                optimizer.zero_grad()
+                mask = None
+                if args.mask_padding:
+                    mask = torch.arange(n)[None, :] < torch.from_numpy(batch_lengths).clamp(min=1)[:, None]
+                loss, _ = diffusion.get_loss_iter(
+                    x0[:, :n], condition=condition[:, :n] if condition is not None else None,
+                    condition_cross=condition_cross, mask=mask)
+                loss.backward()
+                optimizer.step()
+
+            with torch.enable_grad():
+                step(num_points[0], batches[0])
+                start = time.perf_counter()
+                for n, b in list(zip(num_points, batches))[:args.n_batches]:
+                    step(n, b)
+                elapsed = time.perf_counter() - start
+            print("    {:8s}: {:.1%} of the slots hold objects - {:.1f} scenes/s".format(
+                name, efficiency, min(args.n_batches, len(batches)) * args.batch_size / elapsed))
+
+
+def benchmark_shared_condition(args):
+    config = load_config(args.config_file)
+    network_config = config["network"]
+    network, _, _ = build_network(None, network_config["class_dim"] + 1, config)
+    network.eval()
+    size = tuple(map(int, config["data"]["room_layout_size"].split(",")))
+    room_mask = (torch.rand(1, 1, *size) > 0.5).float()
+    text = ["The room has a double bed and a wardrobe. There is a nightstand to the left of the double bed."]
+    sampler = network.get_sampler(args.sampler)
+    kwargs = dict(num_points=network_config["sample_num_points"], point_dim=network_config["point_dim"],
+                  text=text if network.text_condition else None, sampler=sampler)
+
+    print("{} variations of one {} condition, {} sampler".format(
+        args.num_samples, "text" if network.text_condition else "floor plan", args.sampler["type"]))
+    for k in args.num_samples:
+        def separate():
+            return [network.generate_layout(room_mask, **kwargs) for _ in range(k)]
+
+        def shared():
+            return network.generate_layout(room_mask, num_samples_per_condition=k, **kwargs)
+
+        t_separate, _ = timeit(separate, n_warmup=1, n_repeats=args.n_repeats)
+        t_shared, _ = timeit(shared, n_warmup=1, n_repeats=args.n_repeats)
+        print("K = {:3d}: {:.0f} ms for K calls vs {:.0f} ms batched ({:.2f}x)".format(
+            k, t_separate, t_shared, t_separate / t_shared))
+
+
+def benchmark_text_encoding(args):
+    config = load_config(args.config_file)
+    network_config = config["network"]
+    network, _, _ = build_network(None, network_config["class_dim"] + 1, config)
+    network.eval()
+    assert network.text_condition and not network.text_glove_embedding, "a BERT / CLIP text conditioned config"
+    objects = ["a double bed", "a wardrobe", "a nightstand", "a desk", "a chair", "a ceiling lamp", "a tv stand"]
+    prompts = ["The room has {} and {}.".format(objects[i % len(objects)], objects[(i * 3 + 1) % len(objects)]) +
+               " There is {} next to {}.".format(objects[(i + 2) % len(objects)], objects[i % len(objects)]) * (i % 3)
+               for i in range(args.num_prompts)]
+    device = torch.device("cpu")
+
+    # the encodings of a padded batch match the ones of the prompts alone
+    network.text_cache_size = 0
+    batch, _ = network.encode_text(prompts, device)
+    error = 0.
+    for i, prompt in enumerate(prompts):
+        alone, _ = network.encode_text([prompt], device)
+        error = max(error, (batch[i, :alone.shape[1]] - alone[0]).abs().max().item())
+    print("{} prompts of {} tokens at most, max error of the batched encoding: {:.2e}".format(
+        len(prompts), batch.shape[1] if batch.dim() == 3 else 77, error))
+
+    def one_by_one():
+        return [network.encode_text([prompt], device) for prompt in prompts]
+
+    def batched():
+        return network.encode_text(prompts, device)
+
+    t_one, _ = timeit(one_by_one, n_warmup=1, n_repeats=args.n_repeats)
+    t_batch, _ = timeit(batched, n_warmup=1, n_repeats=args.n_repeats)
+    network.text_cache_size = len(prompts)
+    batched()
+    t_cached, _ = timeit(batched, n_warmup=1, n_repeats=args.n_repeats)
+    print("one by one: {:.1f} ms - batched: {:.1f} ms ({:.2f}x) - cached: {:.2f} ms".format(
+        t_one, t_batch, t_one / t_batch, t_cached))
+
+
+def benchmark_continuous_batching(args):
+    config = load_config(args.config_file)
+    diffusion = build_diffusion(config)
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+    condition, condition_cross = random_condition(config, args.n_jobs)
+    rng = np.random.RandomState(args.seed)
+    steps = rng.choice(args.steps, size=args.n_jobs)
+    x_T = torch.randn(args.n_jobs, num_points, point_dim)
+
+    def jobs():
+        return [GenerationJob(condition[i] if condition is not None else None,
+                              condition_cross[i] if condition_cross is not None else None,
+                              {"type": "ddim", "num_steps": int(steps[i])}, x_T=x_T[i], job_id=i)
+                for i in range(args.n_jobs)]
+
+    def run(continuous):
+        scheduler = ContinuousBatchScheduler(diffusion.diffusion, diffusion._denoise, (num_points, point_dim),
+                                             max_batch_size=args.batch_size, continuous=continuous)
+        pending, finished = jobs(), []
+        start = time.perf_counter()
+        while pending or scheduler.waiting or scheduler.active:
+            # arrivals_per_step jobs join the queue before every step, all of them at once if 0
+            n_arrivals = args.arrivals_per_step or len(pending)
+            arrivals, pending = pending[:n_arrivals], pending[n_arrivals:]
+            for job in arrivals:
+                scheduler.submit(job)
+            finished.extend(scheduler.step())
+        return finished, time.perf_counter() - start, scheduler
+
+    print("{} ddim jobs of {} steps, batches of {}, {} arrivals per step".format(
+        args.n_jobs, "/".join(map(str, args.steps)), args.batch_size, args.arrivals_per_step or "all"))
+    for name, continuous in [("static", False), ("continuous", True)]:
+        finished, elapsed, scheduler = run(continuous)
+        latencies = np.array([job.latency for job in finished]) * 1000.0
+        print("{:10s}: {:.2f} jobs/s - {} denoiser calls, {:.1f} samples per call - latency p50 {:.0f} ms, p95 {:.0f} ms".format(
+            name, len(finished) / elapsed, scheduler.denoiser_calls, scheduler.denoised_samples / scheduler.denoiser_calls,
+            np.percentile(latencies, 50), np.percentile(latencies, 95)))
+
+
+def benchmark_iou(args):
+    print("IoU of B x N boxes, batch size {}".format(args.batch_size))
+    for num_boxes in args.num_boxes:
+        boxes, valid_mask = random_boxes(args.batch_size, num_boxes)
+
+        def full():
+            ious = axis_aligned_bbox_overlaps_3d(boxes, boxes)
+            mask = valid_mask[:, :, None] * valid_mask[:, None, :]
+            return (ious * mask).sum(dim=[1, 2])
+
+        def pairwise():
+            return axis_aligned_bbox_pairwise_overlaps_3d(boxes, valid_mask).ious.sum(dim=1)
+
+        # both must agree on the off-diagonal valid pairs
+        diag = torch.diagonal(axis_aligned_bbox_overlaps_3d(boxes, boxes), dim1=1, dim2=2)
+        assert torch.allclose(full() - (diag * valid_mask).sum(dim=1), 2 * pairwise(), atol=1e-4)
+
+        t_full, s_full = timeit(full, n_repeats=args.n_repeats)
+        t_pair, s_pair = timeit(pairwise, n_repeats=args.n_repeats)
+        print("N={:3d} - full: {:.3f} +- {:.3f} ms - upper triangle: {:.3f} +- {:.3f} ms - speedup: {:.2f}x".format(
+            num_boxes, t_full, s_full, t_pair, s_pair, t_full / t_pair))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmark the diffusion building blocks"
+    )
+    parser.add_argument(
+        "--n_threads",
+        type=int,
+        default=None,
+        help="The number of intra-op threads used by torch"
+    )
+    parser.add_argument(
+        "--n_repeats",
+        type=int,
+        default=20,
+        help="The number of timed repetitions"
+    )
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    parser_iou = subparsers.add_parser(
+        "iou", help="Full vs upper-triangle pairwise bbox IoU"
+    )
+    parser_iou.add_argument(
+        "--batch_size",
+        type=int,
+        default=128,
+        help="The number of scenes per batch"
+    )
+    parser_iou.add_argument(
+        "--num_boxes",
+        type=lambda x: list(map(int, x.split(","))),
+        default="21,64",
+        help="Comma separated numbers of boxes per scene"
+    )
+    parser_iou.set_defaults(func=benchmark_iou)
+
+    parser_samplers = subparsers.add_parser(
+        "samplers", help="Scene completion under the different samplers"
+    )
+    parser_samplers.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_samplers.add_argument(
+        "--batch_size",
+        type=int,
+        default=4,
+        help="The number of scenes per batch"
+    )
+    parser_samplers.add_argument(
+        "--num_partial",
+        type=int,
+        default=3,
+        help="The number of given objects"
+    )
+    parser_samplers.add_argument(
+        "--samplers",
+        type=parse_samplers,
+        default="ddpm,ddpm:50,ddim:50,dpm_solver:20",
+        help="Comma separated list of <type>[:<num_steps>]"
+    )
+    parser_samplers.set_defaults(func=benchmark_samplers)
+
+    parser_bpd = subparsers.add_parser(
+        "bpd", help="Exact (chunked) vs importance sampled bits per dim"
+    )
+    parser_bpd.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_bpd.add_argument(
+        "--batch_size",
+        type=int,
+        default=4,
+        help="The number of layouts"
+    )
+    parser_bpd.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=1024,
+        help="The number of (layout, timestep) pairs per model call"
+    )
+    parser_bpd.add_argument(
+        "--num_samples",
+        type=lambda x: list(map(int, x.split(","))),
+        default="16,64",
+        help="Comma separated numbers of importance sampled timesteps"
+    )
+    parser_bpd.set_defaults(func=benchmark_bpd)
+
+    parser_compile = subparsers.add_parser(
+        "compile", help="Eager vs traced / compiled denoising step"
+    )
+    parser_compile.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_compile.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="The number of scenes per batch"
+    )
+    parser_compile.add_argument(
+        "--backends",
+        type=lambda x: x.split(","),
+        default="eager,jit,compile",
+        help="Comma separated list of backends"
+    )
+    parser_compile.add_argument(
+        "--cache_dir",
+        default="../.cache/denoise_step",
+        help="Directory of the compiled denoising steps"
+    )
+    parser_compile.set_defaults(func=benchmark_compile)
+
+    parser_onnx = subparsers.add_parser(
+        "onnx", help="onnxruntime vs pytorch denoiser (outputs and latency)"
+    )
+    parser_onnx.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_onnx.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="The number of scenes per batch"
+    )
+    parser_onnx.add_argument(
+        "--sampling_steps",
+        type=int,
+        default=50,
+        help="The number of ddim steps of the sampling comparison"
+    )
+    parser_onnx.set_defaults(func=benchmark_onnx)
+
+    parser_quantize = subparsers.add_parser(
+        "quantize", help="fp32 vs dynamic / static int8 denoiser"
+    )
+    parser_quantize.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_quantize.add_argument(
+        "--batch_size",
+        type=int,
+        default=16,
+        help="The number of scenes per batch"
+    )
+    parser_quantize.add_argument(
+        "--sampling_steps",
+        type=int,
+        default=50,
+        help="The number of ddim steps used to compare the layouts"
+    )
+    parser_quantize.add_argument(
+        "--calibration_rooms",
+        type=int,
+        default=256,
+        help="The number of layouts used to calibrate the static quantization"
+    )
+    parser_quantize.set_defaults(func=benchmark_quantize)
+
+    parser_alloc = subparsers.add_parser(
+        "alloc", help="Allocations of the sampling loop vs its number of steps"
+    )
+    parser_alloc.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_alloc.add_argument(
+        "--batch_size",
+        type=int,
+        default=4,
+        help="The number of scenes per batch"
+    )
+    parser_alloc.add_argument(
+        "--num_steps",
+        type=lambda x: list(map(int, x.split(","))),
+        default="10,100,1000",
+        help="Comma separated numbers of sampling steps"
+    )
+    parser_alloc.add_argument(
+        "--samplers",
+        type=parse_samplers,
+        default="ddpm,ddim",
+        help="Comma separated list of sampler types"
+    )
+    parser_alloc.set_defaults(func=benchmark_alloc)
+
+    parser_layout = subparsers.add_parser(
+        "layout", help="Channels-first (1x1 convs) vs channels-last (Linear) Unet1D"
+    )
+    parser_layout.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_layout.add_argument(
+        "--batch_sizes",
+        type=lambda x: list(map(int, x.split(","))),
+        default="1,16,128",
+        help="Comma separated numbers of scenes per batch"
+    )
+    parser_layout.set_defaults(func=benchmark_layout)
+
+    parser_fuse = subparsers.add_parser(
+        "fuse", help="Separate vs fused per-attribute encoder / decoder MLPs"
+    )
+    parser_fuse.add_argument(
+        "--config_file",
+        default="../config/text/diffusion_bedrooms_instancond_lat32_v_bert.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_fuse.add_argument(
+        "--batch_sizes",
+        type=lambda x: list(map(int, x.split(","))),
+        default="1,16,128",
+        help="Comma separated numbers of scenes per batch"
+    )
+    parser_fuse.set_defaults(func=benchmark_fuse)
+
+    parser_attention = subparsers.add_parser(
+        "attention", help="Fused / scaled_dot_product_attention layers vs the einsum chains"
+    )
+    parser_attention.add_argument(
+        "--batch_size",
+        type=int,
+        default=16,
+        help="The number of scenes per batch"
+    )
+    parser_attention.add_argument(
+        "--num_objects",
+        type=int,
+        default=32,
+        help="The number of object slots per scene"
+    )
+    parser_attention.add_argument(
+        "--num_tokens",
+        type=int,
+        default=16,
+        help="The number of context tokens of the cross attention"
+    )
+    parser_attention.add_argument(
+        "--dim",
+        type=int,
+        default=512,
+        help="The number of feature channels"
+    )
+    parser_attention.set_defaults(func=benchmark_attention)
+
+    parser_checkpoint = subparsers.add_parser(
+        "checkpoint", help="Training step time / peak RSS with and without gradient checkpointing"
+    )
+    parser_checkpoint.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_checkpoint.add_argument(
+        "--batch_sizes",
+        type=lambda x: list(map(int, x.split(","))),
+        default="128,256",
+        help="Comma separated numbers of scenes per batch"
+    )
+    parser_checkpoint.add_argument(
+        "--dims",
+        type=lambda x: list(map(int, x.split(","))),
+        default="0",
+        help="Comma separated Unet1D widths (0 for the one of the config)"
+    )
+    parser_checkpoint.set_defaults(func=benchmark_checkpoint)
+
+    parser_early_exit = subparsers.add_parser(
+        "early_exit", help="Steps saved by the early exit on converged x0 and its effect on the layouts"
+    )
+    parser_early_exit.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_early_exit.add_argument(
+        "--weight_file",
+        default=None,
+        help="Trained network weights (randomly initialized denoiser by default)"
+    )
+    parser_early_exit.add_argument(
+        "--batch_size",
+        type=int,
+        default=16,
+        help="The number of scenes per batch"
+    )
+    parser_early_exit.add_argument(
+        "--samplers",
+        type=parse_samplers,
+        default="ddpm,ddim:100",
+        help="Comma separated list of <type>[:<num_steps>]"
+    )
+    parser_early_exit.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-3,
+        help="Largest change of the continuous attributes of a converged x0"
+    )
+    parser_early_exit.add_argument(
+        "--window",
+        type=int,
+        default=20,
+        help="The number of consecutive steps x0 must be stable for"
+    )
+    parser_early_exit.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the sampling noise, shared by both runs"
+    )
+    parser_early_exit.set_defaults(func=benchmark_early_exit)
+
+    parser_picard = subparsers.add_parser(
+        "picard", help="Sequential vs parallel-in-time (Picard) sampling latency and sample agreement"
+    )
+    parser_picard.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_picard.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="The number of scenes per batch"
+    )
+    parser_picard.add_argument(
+        "--samplers",
+        type=parse_samplers,
+        default="ddpm,ddim:100",
+        help="Comma separated list of <type>[:<num_steps>]"
+    )
+    parser_picard.add_argument(
+        "--windows",
+        type=lambda x: list(map(int, x.split(","))),
+        default="8,16,32",
+        help="Comma separated Picard window sizes"
+    )
+    parser_picard.add_argument(
+        "--threads",
+        type=lambda x: list(map(int, x.split(","))),
+        default="1,4,8",
+        help="Comma separated numbers of intra-op threads"
+    )
+    parser_picard.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Tolerance of the Picard iterations, relative to the noise level of each step"
+    )
+    parser_picard.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the sampling noise, shared by all the runs"
+    )
+    parser_picard.set_defaults(func=benchmark_picard)
+
+    parser_deep_cache = subparsers.add_parser(
+        "deep_cache", help="Speed / quality tradeoff of reusing the deep denoiser features across steps"
+    )
+    parser_deep_cache.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_deep_cache.add_argument(
+        "--weight_file",
+        default=None,
+        help="Trained network weights (randomly initialized denoiser by default)"
+    )
+    parser_deep_cache.add_argument(
+        "--batch_size",
+        type=int,
+        default=16,
+        help="The number of scenes per batch"
+    )
+    parser_deep_cache.add_argument(
+        "--samplers",
+        type=parse_samplers,
+        default="ddpm,ddpm:200,ddim:100",
+        help="Comma separated list of <type>[:<num_steps>]"
+    )
+    parser_deep_cache.add_argument(
+        "--intervals",
+        type=lambda x: list(map(int, x.split(","))),
+        default="2,3,5,10",
+        help="Comma separated numbers of steps between the refreshes of the deep features"
+    )
+    parser_deep_cache.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the sampling noise, shared by all the runs"
+    )
+    parser_deep_cache.set_defaults(func=benchmark_deep_cache)
+
+    parser_refine = subparsers.add_parser(
+        "refine", help="Warm-start (SDEdit) refinement vs full generation latency"
+    )
+    parser_refine.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_refine.add_argument(
+        "--batch_size",
+        type=int,
+        default=16,
+        help="The number of scenes per batch"
+    )
+    parser_refine.add_argument(
+        "--samplers",
+        type=parse_samplers,
+        default="ddpm,ddim:100",
+        help="Comma separated list of <type>[:<num_steps>]"
+    )
+    parser_refine.add_argument(
+        "--t_starts",
+        type=lambda x: list(map(int, x.split(","))),
+        default="100,250,500",
+        help="Comma separated timesteps the layouts are noised to"
+    )
+    parser_refine.add_argument(
+        "--num_fixed",
+        type=int,
+        default=2,
+        help="The number of objects kept"
+    )
+    parser_refine.set_defaults(func=benchmark_refine)
+
+    parser_prune = subparsers.add_parser(
+        "prune", help="Compute saved by pruning the empty object slots and its effect on the layouts"
+    )
+    parser_prune.add_argument(
+        "--config_file",
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_prune.add_argument(
+        "--weight_file",
+        default=None,
+        help="Trained network weights (randomly initialized denoiser by default)"
+    )
+    parser_prune.add_argument(
+        "--batch_size",
+        type=int,
+        default=16,
+        help="The number of scenes per batch"
+    )
+    parser_prune.add_argument(
+        "--samplers",
+        type=parse_samplers,
+        default="ddpm,ddim:100",
+        help="Comma separated list of <type>[:<num_steps>]"
+    )
+    parser_prune.add_argument(
+        "--windows",
+        type=lambda x: list(map(int, x.split(","))),
+        default="5,10,20",
+        help="Comma separated numbers of consecutive empty predictions before a slot is frozen"
+    )
+    parser_prune.add_argument(
+        "--threshold",
+        type=float,
+        default=0.5,
+        help="The empty class value of the predicted x0 above which a slot counts as empty"
+    )
+    parser_prune.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the sampling noise, shared by both runs"
+    )
+    parser_prune.set_defaults(func=benchmark_prune)
+
+    parser_bucketing = subparsers.add_parser(
+        "bucketing", help="Training throughput of length-bucketed vs randomly composed batches"
+    )
+    parser_bucketing.add_argument(
+        "--config_files",
+        type=lambda x: x.split(","),
+        default="../config/uncond/diffusion_bedrooms_instancond_lat32_v.yaml,"
+                "../config/uncond/diffusion_livingrooms_instancond_lat32_v.yaml,"
+                "../config/uncond/diffusion_diningrooms_instancond_lat32_v.yaml",
+        help="Comma separated experiment configurations, their training split gives the room sizes"
+    )
+    parser_bucketing.add_argument(
+        "--batch_size",
+        type=int,
+        default=128,
+        help="The number of scenes per batch"
+    )
+    parser_bucketing.add_argument(
+        "--pool_size",
+        type=int,
+        default=50,
+        help="The number of batches sorted by length together"
+    )
+    parser_bucketing.add_argument(
+        "--n_batches",
+        type=int,
+        default=20,
+        help="The number of timed training steps"
+    )
+    parser_bucketing.add_argument(
+        "--mask_padding",
+        action="store_true",
+        help="Mask the slots past the objects of a scene as attention keys"
+    )
+    parser_bucketing.set_defaults(func=benchmark_bucketing)
+
+    parser_shared_condition = subparsers.add_parser(
+        "shared_condition", help="K generate_layout calls vs one with num_samples_per_condition=K"
+    )
+    parser_shared_condition.add_argument(
+        "--config_file",
+        default="../config/text/diffusion_bedrooms_instancond_lat32_v_bert.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_shared_condition.add_argument(
+        "--sampler",
+        type=lambda x: parse_samplers(x)[0],
+        default="ddim:50",
+        help="The sampler as <type>[:<num_steps>]"
+    )
+    parser_shared_condition.add_argument(
+        "--num_samples",
+        type=lambda x: list(map(int, x.split(","))),
+        default="1,4,16",
+        help="Comma separated numbers of variations K"
+    )
+    parser_shared_condition.set_defaults(func=benchmark_shared_condition)
+
+    parser_text_encoding = subparsers.add_parser(
+        "text_encoding", help="Prompts encoded one by one vs in one padded batch vs from the cache"
+    )
+    parser_text_encoding.add_argument(
+        "--config_file",
+        default="../config/text/diffusion_bedrooms_instancond_lat32_v_bert.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_text_encoding.add_argument(
+        "--num_prompts",
+        type=int,
+        default=32,
+        help="The number of prompts"
+    )
+    parser_text_encoding.set_defaults(func=benchmark_text_encoding)
+
+    parser_continuous = subparsers.add_parser(
+        "continuous_batching", help="Static vs continuous batching of a stream of jobs with mixed step counts"
+    )
+    parser_continuous.add_argument(
+        "--config_file",
+        default="../config/text/diffusion_bedrooms_instancond_lat32_v_bert.yaml",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser_continuous.add_argument(
+        "--batch_size",
+        type=int,
+        default=16,
+        help="The maximum number of samples in a denoiser call"
+    )
+    parser_continuous.add_argument(
+        "--n_jobs",
+        type=int,
+        default=64,
+        help="The number of jobs"
+    )
+    parser_continuous.add_argument(
+        "--steps",
+        type=lambda x: list(map(int, x.split(","))),
+        default="10,25,50",
+        help="Comma separated ddim step counts the jobs are drawn from"
+    )
+    parser_continuous.add_argument(
+        "--arrivals_per_step",
+        type=int,
+        default=0,
+        help="The number of jobs arriving before every step, 0 for all of them at once"
+    )
+    parser_continuous.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the step counts of the jobs"
+    )
+    parser_continuous.set_defaults(func=benchmark_continuous_batching)
+
+    args = parser.parse_args(argv)
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+
+    with torch.no_grad():
+        args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
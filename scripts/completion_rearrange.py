@@ -26,7 +26,7 @@ from simple_3dviz.utils import render
 from pyrr import Matrix44
 from utils import render as render_top2down
 from scene_synthesis.stats_logger import AverageAggregator
-from utils import merge_meshes,  computer_intersection, computer_symmetry
+from utils import merge_meshes,  computer_intersection, computer_symmetry, build_sampler_config
 import trimesh
 
 def main(argv):
@@ -177,6 +177,18 @@ def main(argv):
         action="store_true",
         help="if remove the texture"
     )
+    parser.add_argument(
+        "--sampler",
+        choices=["ddpm", "ddim", "dpm_solver"],
+        default=None,
+        help="Sampler for the reverse process (defaults to the network config, else ddpm)"
+    )
+    parser.add_argument(
+        "--sampling_steps",
+        type=int,
+        default=None,
+        help="Number of sampling steps (ddpm: respaced chain, defaults to all the trained timesteps)"
+    )
     parser.add_argument(
         "--path_to_3d_future_models_dir",
         default="../dataset/3D-FUTURE-model",
@@ -249,6 +261,7 @@ def main(argv):
         config, args.weight_file, device=device
     )
     network.eval()
+    sampler = build_sampler_config(args.sampler, args.sampling_steps)
 
     # Create the scene and the behaviour list for simple-3dviz
     scene = Scene(size=args.window_size)
@@ -399,6 +412,7 @@ def main(argv):
                     device=device,
                     clip_denoised=args.clip_denoised,
                     batch_seeds=torch.arange(i, i+1),
+                    sampler=sampler,
             )
         else:
             bbox_params = network.complete_scene(
@@ -409,6 +423,7 @@ def main(argv):
                     device=device,
                     clip_denoised=args.clip_denoised,
                     batch_seeds=torch.arange(i, i+1),
+                    sampler=sampler,
             )
     
         
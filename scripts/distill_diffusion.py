@@ -0,0 +1,361 @@
+"""Script used to progressively distill a trained DiffuScene into a few-step
+DDIM student, halving the number of sampling steps in every round."""
+import argparse
+import copy
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import yaml
+
+import torch
+from torch.utils.data import DataLoader
+
+from training_utils import id_generator, save_experiment_params, load_config, save_checkpoints
+
+from scene_synthesis.datasets import get_encoded_dataset, filter_function
+from scene_synthesis.networks import build_network, optimizer_factory
+from scene_synthesis.networks.diffusion_scene_layout_ddpm import distill_on_batch
+from scene_synthesis.networks.loss import axis_aligned_bbox_pairwise_overlaps_3d
+from scene_synthesis.networks.samplers import DDIMSampler, distillation_grid
+from scene_synthesis.stats_logger import StatsLogger
+
+
+def move_to_device(sample, device):
+    for k, v in sample.items():
+        if not isinstance(v, list):
+            sample[k] = v.to(device)
+    return sample
+
+
+def descale(x, bounds):
+    x = (x + 1) / 2
+    return x * (bounds[1] - bounds[0]) + bounds[0]
+
+
+def layout_metrics(samples, gt_class_labels, network, bounds):
+    """
+    Layout quality of the network samples w.r.t. the ground-truth scenes:
+    KL divergence between the object class distributions, number of objects
+    per scene and mean IoU between the objects of a scene (collisions).
+    """
+    bbox_dim, class_dim = network.bbox_dim, network.class_dim
+    translation_dim, size_dim = network.translation_dim, network.size_dim
+
+    # the last class is the empty (end) label
+    valid = samples[:, :, bbox_dim+class_dim-1] < 0
+    classes = torch.argmax(samples[:, :, bbox_dim:bbox_dim+class_dim-1], dim=-1)
+    gt_valid = gt_class_labels[:, :, -1] < 0
+    gt_classes = torch.argmax(gt_class_labels[:, :, :-1], dim=-1)
+
+    hist = torch.bincount(classes[valid], minlength=class_dim-1).float() + 1e-6
+    gt_hist = torch.bincount(gt_classes[gt_valid], minlength=class_dim-1).float() + 1e-6
+    hist, gt_hist = hist / hist.sum(), gt_hist / gt_hist.sum()
+    class_kl = float((gt_hist * torch.log(gt_hist / hist)).sum())
+
+    translations = descale(samples[:, :, 0:translation_dim], torch.from_numpy(np.asarray(bounds["translations"])).float())
+    sizes = descale(samples[:, :, translation_dim:translation_dim+size_dim], torch.from_numpy(np.asarray(bounds["sizes"])).float())
+    pairwise = axis_aligned_bbox_pairwise_overlaps_3d(torch.cat([translations - sizes, translations + sizes], dim=-1), valid)
+
+    return {
+        "class_kl": class_kl,
+        "num_objects": float(valid.float().sum(dim=1).mean()),
+        "gt_num_objects": float(gt_valid.float().sum(dim=1).mean()),
+        "mean_iou": float(pairwise.ious.sum() / pairwise.pair_mask.sum().clamp(min=1)),
+    }
+
+
+@torch.no_grad()
+def evaluate(network, sampler, val_loader, bounds, config, device, n_batches, seed):
+    """Sample one scene per validation scene, timing the reverse process."""
+    network.eval()
+    num_points = config["network"]["sample_num_points"]
+    point_dim = config["network"]["point_dim"]
+
+    all_samples, all_gt, elapsed = [], [], 0.0
+    for b, sample in zip(range(n_batches), val_loader):
+        sample = move_to_device(sample, device)
+        room_mask = sample["room_layout"]
+        if not network.text_condition:
+            text = None
+        elif network.text_glove_embedding:
+            # the GloVe embeddings of the description, as in get_diffusion_inputs
+            text = sample["desc_emb"]
+        else:
+            text = sample["description"]
+
+        # the same noise for every round
+        torch.manual_seed(seed + b)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        samples = network.sample(room_mask, num_points, point_dim, room_mask.shape[0], text=text, sampler=sampler)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        elapsed += time.perf_counter() - start
+
+        all_samples.append(samples.cpu())
+        all_gt.append(sample["class_labels"].cpu())
+
+    samples = torch.cat(all_samples, dim=0)
+    stats = layout_metrics(samples, torch.cat(all_gt, dim=0), network, bounds)
+    stats["ms_per_scene"] = 1000.0 * elapsed / samples.shape[0]
+    return stats, samples
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=("Progressively distill a trained diffusion model into a"
+                     " student that samples with half the steps per round")
+    )
+
+    parser.add_argument(
+        "config_file",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser.add_argument(
+        "output_directory",
+        help="Path to the output directory"
+    )
+    parser.add_argument(
+        "weight_file",
+        help="The path to the trained (teacher) model"
+    )
+    parser.add_argument(
+        "--min_steps",
+        type=int,
+        default=8,
+        help="The smallest number of sampling steps of a student"
+    )
+    parser.add_argument(
+        "--epochs_per_round",
+        type=int,
+        default=None,
+        help="The number of epochs of every round (default: distillation.epochs_per_round of the config or 100)"
+    )
+    parser.add_argument(
+        "--eval_batches",
+        type=int,
+        default=4,
+        help="The number of validation batches used to evaluate every round"
+    )
+    parser.add_argument(
+        "--n_processes",
+        type=int,
+        default=0,
+        help="The number of processed spawned by the batch provider"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=27,
+        help="Seed for the PRNG"
+    )
+    parser.add_argument(
+        "--experiment_tag",
+        default=None,
+        help="Tag that refers to the current experiment"
+    )
+
+    args = parser.parse_args(argv)
+
+    # Disable trimesh's logger
+    logging.getLogger("trimesh").setLevel(logging.ERROR)
+
+    # Set the random seed
+    np.random.seed(args.seed)
+    torch.manual_seed(np.random.randint(np.iinfo(np.int32).max))
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(np.random.randint(np.iinfo(np.int32).max))
+
+    if torch.cuda.is_available():
+        device = torch.device("cuda:0")
+    else:
+        device = torch.device("cpu")
+    print("Running code on", device)
+
+    # Create an experiment directory using the experiment_tag
+    if args.experiment_tag is None:
+        experiment_tag = id_generator(9)
+    else:
+        experiment_tag = args.experiment_tag
+
+    experiment_directory = os.path.join(
+        args.output_directory,
+        experiment_tag
+    )
+    if not os.path.exists(experiment_directory):
+        os.makedirs(experiment_directory)
+
+    # Save the parameters of this run to a file
+    save_experiment_params(args, experiment_tag, experiment_directory)
+    print("Save experiment statistics in {}".format(experiment_directory))
+
+    # Parse the config file
+    config = load_config(args.config_file)
+    distillation_config = config.get("distillation", {})
+    epochs_per_round = args.epochs_per_round or distillation_config.get("epochs_per_round", 100)
+
+    train_dataset = get_encoded_dataset(
+        config["data"],
+        filter_function(
+            config["data"],
+            split=config["training"].get("splits", ["train", "val"])
+        ),
+        path_to_bounds=None,
+        augmentations=config["data"].get("augmentations", None),
+        split=config["training"].get("splits", ["train", "val"])
+    )
+    path_to_bounds = os.path.join(experiment_directory, "bounds.npz")
+    np.savez(
+        path_to_bounds,
+        sizes=train_dataset.bounds["sizes"],
+        translations=train_dataset.bounds["translations"],
+        angles=train_dataset.bounds["angles"],
+        #add objfeats
+        objfeats=train_dataset.bounds["objfeats"],
+    )
+    print("Saved the dataset bounds in {}".format(path_to_bounds))
+
+    validation_dataset = get_encoded_dataset(
+        config["data"],
+        filter_function(
+            config["data"],
+            split=config["validation"].get("splits", ["test"])
+        ),
+        path_to_bounds=path_to_bounds,
+        augmentations=None,
+        split=config["validation"].get("splits", ["test"])
+    )
+
+    train_loader = DataLoader(
+        train_dataset,
+        batch_size=config["training"].get("batch_size", 128),
+        num_workers=args.n_processes,
+        collate_fn=train_dataset.collate_fn,
+        shuffle=True
+    )
+    print("Loaded {} training scenes with {} object types".format(
+        len(train_dataset), train_dataset.n_object_types)
+    )
+    val_loader = DataLoader(
+        validation_dataset,
+        batch_size=config["validation"].get("batch_size", 1),
+        num_workers=args.n_processes,
+        collate_fn=validation_dataset.collate_fn,
+        shuffle=False
+    )
+    print("Loaded {} validation scenes with {} object types".format(
+        len(validation_dataset), validation_dataset.n_object_types)
+    )
+
+    # The teacher of the first round is the trained model, its targets are
+    # deterministic DDIM steps over every timestep
+    teacher, _, _ = build_network(
+        train_dataset.feature_size, train_dataset.n_classes,
+        config, args.weight_file, device=device
+    )
+    teacher.eval()
+    for p in teacher.parameters():
+        p.requires_grad = False
+
+    # arrangement / completion models need input boxes to sample from
+    evaluate_rounds = not (teacher.room_partial_condition or teacher.room_arrange_condition)
+
+    num_timesteps = teacher.diffusion.diffusion.num_timesteps
+    teacher_timesteps = DDIMSampler(teacher.diffusion.diffusion, use_timesteps=range(num_timesteps)).timesteps()
+    teacher_steps = num_timesteps
+
+    results = []
+    if evaluate_rounds:
+        # The baseline of the speedups and the first mse_to_teacher is the
+        # full DDPM chain the model was trained for
+        stats, teacher_samples = evaluate(
+            teacher, {"type": "ddpm"}, val_loader, validation_dataset.bounds, config, device, args.eval_batches, args.seed
+        )
+        stats.update(num_steps=teacher_steps, speedup=1.0, mse_to_teacher=0.0)
+        results.append(stats)
+        baseline_ms = stats["ms_per_scene"]
+        print("teacher - {} steps: {}".format(teacher_steps, stats))
+
+    StatsLogger.instance().add_output_file(open(
+        os.path.join(experiment_directory, "stats.txt"),
+        "w"
+    ))
+
+    # Each student keeps every other timestep of its teacher,
+    # 1000 -> 500 -> 250 -> 125 -> 63 -> ... -> min_steps
+    grid = distillation_grid(teacher_timesteps)
+    num_steps = len(grid)
+    while num_steps >= args.min_steps and num_steps < teacher_steps:
+        round_directory = os.path.join(experiment_directory, "steps_{:04d}".format(num_steps))
+        if not os.path.exists(round_directory):
+            os.makedirs(round_directory)
+
+        # The student is a copy of the teacher that samples with deterministic
+        # DDIM steps over the timesteps of the grid, it loads through
+        # build_network with its own config
+        student_config = copy.deepcopy(config)
+        student_config["network"]["sampler"] = {
+            "type": "ddim",
+            "num_steps": num_steps,
+            "timesteps": sorted(grid[:, 0].tolist())
+        }
+        with open(os.path.join(round_directory, "config.yaml"), "w") as f:
+            yaml.dump(student_config, f)
+
+        student, _, _ = build_network(
+            train_dataset.feature_size, train_dataset.n_classes,
+            student_config, device=device
+        )
+        student.load_state_dict(teacher.state_dict())
+        optimizer = optimizer_factory(config["training"], filter(lambda p: p.requires_grad, student.parameters()))
+        print("Distilling {} into {} steps".format(teacher_steps, num_steps))
+
+        for i in range(epochs_per_round):
+            student.train()
+            for b, sample in enumerate(train_loader):
+                sample = move_to_device(sample, device)
+                batch_loss = distill_on_batch(student, teacher, optimizer, sample, config, grid)
+                StatsLogger.instance().print_progress(i+1, b+1, batch_loss)
+            StatsLogger.instance().clear()
+        save_checkpoints(epochs_per_round - 1, student, optimizer, round_directory)
+
+        if evaluate_rounds:
+            stats, samples = evaluate(
+                student, None, val_loader, validation_dataset.bounds, student_config, device, args.eval_batches, args.seed
+            )
+            stats.update(
+                num_steps=num_steps,
+                speedup=baseline_ms / stats["ms_per_scene"],
+                mse_to_teacher=float(((samples - teacher_samples) ** 2).mean())
+            )
+            results.append(stats)
+            teacher_samples = samples
+            print("student - {} steps: {}".format(num_steps, stats))
+
+            with open(os.path.join(experiment_directory, "distillation_eval.json"), "w") as f:
+                json.dump(results, f, indent=4)
+
+        teacher = student.eval()
+        for p in teacher.parameters():
+            p.requires_grad = False
+        teacher_timesteps = [(t, t_next) for t, _, t_next in grid.tolist()]
+        teacher_steps = num_steps
+        grid = distillation_grid(teacher_timesteps)
+        num_steps = len(grid)
+
+    if evaluate_rounds:
+        print("{:>6s} {:>12s} {:>8s} {:>9s} {:>12s} {:>9s} {:>14s}".format(
+            "steps", "ms/scene", "speedup", "class_kl", "num_objects", "mean_iou", "mse_to_teacher"))
+        for stats in results:
+            print("{:6d} {:12.1f} {:7.1f}x {:9.4f} {:5.2f}/{:5.2f} {:9.4f} {:14.5f}".format(
+                stats["num_steps"], stats["ms_per_scene"], stats["speedup"], stats["class_kl"],
+                stats["num_objects"], stats["gt_num_objects"], stats["mean_iou"], stats["mse_to_teacher"]))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -17,7 +17,7 @@ import numpy as np
 import torch
 
 from training_utils import load_config
-from utils import floor_plan_from_scene, export_scene, get_textured_objects_in_scene
+from utils import floor_plan_from_scene, export_scene, get_textured_objects_in_scene, build_sampler_config, quantize_network_for_sampling
 
 from scene_synthesis.datasets import filter_function, get_dataset_raw_and_encoded
 from scene_synthesis.datasets.threed_front import ThreedFront
@@ -173,6 +173,93 @@ def main(argv):
         action="store_true",
         help="if clip_denoised"
     )
+    parser.add_argument(
+        "--sampler",
+        choices=["ddpm", "ddim", "dpm_solver"],
+        default=None,
+        help="Sampler for the reverse process (defaults to the network config, else ddpm)"
+    )
+    parser.add_argument(
+        "--sampling_steps",
+        type=int,
+        default=None,
+        help="Number of sampling steps (ddpm: respaced chain, defaults to all the trained timesteps)"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["eager", "jit", "compile", "onnx"],
+        default=None,
+        help="Inference backend: traced / torch.compile'd (torch >= 2.0) ddpm step or onnxruntime denoiser"
+    )
+    parser.add_argument(
+        "--compile_cache_dir",
+        default="../.cache/denoise_step",
+        help="Directory of the compiled / exported denoisers, reused by later runs"
+    )
+    parser.add_argument(
+        "--backend_threads",
+        type=int,
+        default=None,
+        help="The number of intra-op threads of the onnxruntime backend"
+    )
+    parser.add_argument(
+        "--early_exit_tolerance",
+        type=float,
+        default=None,
+        help="Stop sampling a scene once its predicted x0 moves by at most this (with stable classes) "
+             "for --early_exit_window steps (not with --save_progressive_video)"
+    )
+    parser.add_argument(
+        "--early_exit_window",
+        type=int,
+        default=20,
+        help="The number of consecutive stable steps of the early exit"
+    )
+    parser.add_argument(
+        "--parallel_window",
+        type=int,
+        default=None,
+        help="Sample with Picard iterations over windows of this many steps evaluated in one "
+             "batched denoiser call (ddpm/ddim samplers, not with --save_progressive_video)"
+    )
+    parser.add_argument(
+        "--parallel_tolerance",
+        type=float,
+        default=0.1,
+        help="The tolerance of the Picard iterations, relative to the noise level of each step"
+    )
+    parser.add_argument(
+        "--deep_cache_interval",
+        type=int,
+        default=None,
+        help="Recompute the deep denoiser features every this many steps only and reuse them "
+             "in between (eager backend)"
+    )
+    parser.add_argument(
+        "--prune_empty_window",
+        type=int,
+        default=None,
+        help="Drop the object slots predicted empty for this many consecutive steps from the "
+             "denoiser inputs (eager backend)"
+    )
+    parser.add_argument(
+        "--prune_empty_threshold",
+        type=float,
+        default=0.5,
+        help="The empty class value of the predicted x0 above which a slot counts as empty"
+    )
+    parser.add_argument(
+        "--quantize",
+        choices=["dynamic", "static"],
+        default=None,
+        help="int8 quantization of the denoiser (and BERT) for CPU sampling"
+    )
+    parser.add_argument(
+        "--calibration_rooms",
+        type=int,
+        default=256,
+        help="The number of training rooms used to calibrate the static quantization"
+    )
     #
     parser.add_argument(
         "--retrive_objfeats",
@@ -212,9 +299,10 @@ def main(argv):
     # Disable trimesh's logger
     logging.getLogger("trimesh").setLevel(logging.ERROR)
 
-    if torch.cuda.is_available():
+    if torch.cuda.is_available() and args.quantize is None:
         device = torch.device("cuda:0")
     else:
+        # the quantized kernels are CPU only
         device = torch.device("cpu")
     print("Running code on", device)
 
@@ -273,6 +361,19 @@ def main(argv):
         config, args.weight_file, device=device
     )
     network.eval()
+    if args.quantize is not None:
+        network = quantize_network_for_sampling(network, args.quantize, train_dataset, args.calibration_rooms)
+    sampler = build_sampler_config(args.sampler, args.sampling_steps, args.backend, args.compile_cache_dir, args.backend_threads,
+                                   args.early_exit_tolerance, args.early_exit_window,
+                                   args.parallel_window, args.parallel_tolerance, args.deep_cache_interval,
+                                   args.prune_empty_window, args.prune_empty_threshold)
+    # one sampler for all the scenes, its early exit monitor counts the steps of the last one
+    sampler = network.get_sampler(sampler)
+    if sampler.early_exit is not None and args.save_progressive_video:
+        raise ValueError("--early_exit_tolerance does not apply to the progressive generation")
+    if sampler.parallel is not None and args.save_progressive_video:
+        raise ValueError("--parallel_window does not apply to the progressive generation")
+    steps_saved = []
 
     # Create the scene and the behaviour list for simple-3dviz
     # scene = Scene(size=args.window_size)
@@ -368,7 +469,8 @@ def main(argv):
                 clip_denoised=args.clip_denoised,
                 batch_seeds=torch.arange(i, i+1),
                 num_step=args.video_num_steps,
-                ret_traj=True
+                ret_traj=True,
+                sampler=sampler
             )
             print(f"Generated {len(boxes_traj)} intermediate steps for progressive video")
             
@@ -458,7 +560,17 @@ def main(argv):
                     device=device,
                     clip_denoised=args.clip_denoised,
                     batch_seeds=torch.arange(i, i+1),
+                    sampler=sampler,
             )
+            if sampler.early_exit is not None:
+                steps_saved.append(sampler.early_exit.steps_saved.float().mean().item())
+                print("early exit: {:.0f} of {} steps saved (average {:.1f})".format(
+                    steps_saved[-1], sampler.early_exit.num_steps, np.mean(steps_saved)))
+            if sampler.parallel is not None:
+                print("parallel sampling: {} denoiser calls for {} steps".format(
+                    sampler.picard_iterations, len(sampler.timesteps())))
+            if sampler.prune_empty is not None:
+                print("slot pruning: {:.1%} of the slot evaluations saved".format(sampler.prune_empty.slots_saved))
 
         boxes = dataset.post_process(bbox_params)
         bbox_params_t = torch.cat([
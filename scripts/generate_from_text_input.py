@@ -17,7 +17,7 @@ import numpy as np
 import torch
 
 from training_utils import load_config
-from utils import floor_plan_from_scene, export_scene, get_textured_objects_in_scene
+from utils import floor_plan_from_scene, export_scene, get_textured_objects_in_scene, quantize_network_for_sampling
 
 from scene_synthesis.datasets import filter_function, get_dataset_raw_and_encoded
 from scene_synthesis.datasets.threed_front import ThreedFront
@@ -154,6 +154,12 @@ def main(argv):
         type=int,
         help="The number of repetitions to generate for each text input (i.e., how many times to generate scenes from the same text)"
     )
+    parser.add_argument(
+        "--batch_size",
+        default=1,
+        type=int,
+        help="The number of scenes (text inputs and their repetitions) generated together, their prompts are encoded in one batch"
+    )
     parser.add_argument(
         "--background",
         type=lambda x: list(map(float, x.split(","))),
@@ -207,6 +213,18 @@ def main(argv):
         action="store_true",
         help="Clip denoised values"
     )
+    parser.add_argument(
+        "--quantize",
+        choices=["dynamic", "static"],
+        default=None,
+        help="int8 quantization of the denoiser (and BERT) for CPU sampling"
+    )
+    parser.add_argument(
+        "--calibration_rooms",
+        type=int,
+        default=256,
+        help="The number of training rooms used to calibrate the static quantization"
+    )
     parser.add_argument(
         "--retrive_objfeats",
         action="store_true",
@@ -224,9 +242,10 @@ def main(argv):
     # Disable trimesh's logger
     logging.getLogger("trimesh").setLevel(logging.ERROR)
 
-    if torch.cuda.is_available():
+    if torch.cuda.is_available() and args.quantize is None:
         device = torch.device("cuda:0")
     else:
+        # the quantized kernels are CPU only
         device = torch.device("cpu")
     print("Running code on", device)
 
@@ -335,6 +354,8 @@ def main(argv):
         config, args.weight_file, device=device
     )
     network.eval()
+    if args.quantize is not None:
+        network = quantize_network_for_sampling(network, args.quantize, train_dataset, args.calibration_rooms)
 
     # Create scene for top-down rendering
     if args.render_top2down:
@@ -366,6 +387,7 @@ def main(argv):
     if text_inputs is not None:
         # Custom text input mode
         total_generations = 0
+        text_output_dirs = []
         
         for text_idx, text_input in enumerate(text_inputs):
             text_description = text_input['text']
@@ -383,37 +405,59 @@ def main(argv):
                 text_input['filename'].replace('.txt', '')
             )
             os.makedirs(text_output_dir, exist_ok=True)
+            text_output_dirs.append(text_output_dir)
             
             # Save the input text
             input_text_file = os.path.join(text_output_dir, "input_text.txt")
             with open(input_text_file, 'w', encoding='utf-8') as f:
                 f.write(text_description)
+        
+        # The (text input, repetition) pairs are generated batch_size at a time: the
+        # prompts of a batch are tokenized and encoded together (the repeated ones come
+        # from the cache of the network) and their scenes are sampled in one batch
+        jobs = [(text_idx, seq_i) for text_idx in range(len(text_inputs)) for seq_i in range(args.n_sequences)]
+        durations = [0.] * len(text_inputs)
+        generation_start_time = datetime.now()
+        
+        for batch_start in range(0, len(jobs), args.batch_size):
+            batch_jobs = jobs[batch_start:batch_start + args.batch_size]
+            batch_start_time = datetime.now()
+            print(f"\nGenerating scenes {batch_start + 1}-{batch_start + len(batch_jobs)}/{len(jobs)}")
             
-            generation_start_time = datetime.now()
-            
-            for seq_i in range(args.n_sequences):
-                # Select scene for floor plan
+            # Select scenes for floor plan
+            floor_plans = []
+            for text_idx, seq_i in batch_jobs:
                 scene_idx = given_scene_id or np.random.choice(len(dataset))
                 current_scene = raw_dataset[scene_idx]
-                
-                print(f"  Repetition {seq_i + 1}/{args.n_sequences} for text input {text_idx + 1}")
-                print(f"    Using floor plan from scene {current_scene.scene_id}")
-                
-                # Get floor plan
                 floor_plan, tr_floor, room_mask = floor_plan_from_scene(
                     current_scene, args.path_to_floor_plan_textures, no_texture=args.no_texture
                 )
+                floor_plans.append((scene_idx, current_scene, floor_plan, tr_floor, room_mask))
+            
+            # Generate layouts with custom text
+            bbox_params_batch = network.generate_layout(
+                room_mask=torch.cat([room_mask for *_, room_mask in floor_plans]).to(device),
+                num_points=config["network"]["sample_num_points"],
+                point_dim=config["network"]["point_dim"],
+                batch_size=len(batch_jobs),
+                text=[text_inputs[text_idx]['text'] for text_idx, _ in batch_jobs],  # Use custom text
+                device=device,
+                clip_denoised=args.clip_denoised,
+                batch_seeds=torch.arange(total_generations, total_generations+len(batch_jobs)),
+            )
+            if len(batch_jobs) == 1:
+                bbox_params_batch = [bbox_params_batch]
+            batch_duration = (datetime.now() - batch_start_time).total_seconds()
+            
+            for (text_idx, seq_i), (scene_idx, current_scene, floor_plan, tr_floor, _), bbox_params in \
+                    zip(batch_jobs, floor_plans, bbox_params_batch):
+                scene_start_time = datetime.now()
+                text_input = text_inputs[text_idx]
+                text_description = text_input['text']
+                text_output_dir = text_output_dirs[text_idx]
                 
-                # Generate layout with custom text
-                bbox_params = network.generate_layout(
-                    room_mask=room_mask.to(device),
-                    num_points=config["network"]["sample_num_points"],
-                    point_dim=config["network"]["point_dim"],
-                    text=text_description,  # Use custom text
-                    device=device,
-                    clip_denoised=args.clip_denoised,
-                    batch_seeds=torch.arange(total_generations, total_generations+1),
-                )
+                print(f"  Repetition {seq_i + 1}/{args.n_sequences} for text input {text_idx + 1}")
+                print(f"    Using floor plan from scene {current_scene.scene_id}")
                 
                 boxes = dataset.post_process(bbox_params)
                 bbox_params_t = torch.cat([
@@ -487,17 +531,21 @@ def main(argv):
                     
                     save_generation_record(args.output_directory, record_data)
                 
+                # Time of the scene: its share of the batch sampling and its own processing
+                durations[text_idx] += batch_duration / len(batch_jobs) + (datetime.now() - scene_start_time).total_seconds()
                 total_generations += 1
-            
-            generation_end_time = datetime.now()
-            duration = (generation_end_time - generation_start_time).total_seconds()
+        
+        for text_idx, text_input in enumerate(text_inputs):
+            text_output_dir = text_output_dirs[text_idx]
+            duration = durations[text_idx]
             
             # Save summary for this text input
             summary_file = os.path.join(text_output_dir, "generation_summary.json")
             summary_data = {
-                'text_input': text_description,
+                'text_input': text_input['text'],
                 'text_source': text_input['source'],
                 'num_repetitions': args.n_sequences,
+                'batch_size': args.batch_size,
                 'generation_time_seconds': duration,
                 'output_directory': text_output_dir,
                 'config_file': args.config_file,
@@ -518,6 +566,7 @@ def main(argv):
         print(f"All generations completed!")
         print(f"Total text inputs processed: {len(text_inputs)}")
         print(f"Total scenes generated: {total_generations} ({len(text_inputs)} texts × {args.n_sequences} repetitions)")
+        print(f"Total time: {(datetime.now() - generation_start_time).total_seconds():.2f} seconds")
         print(f"Results saved to: {args.output_directory}")
         print(f"{'='*80}\n")
         
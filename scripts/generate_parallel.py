@@ -0,0 +1,363 @@
+"""Script used for generating many scenes on CPU with a pool of worker processes."""
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import time
+import traceback
+
+import numpy as np
+import torch
+
+from training_utils import load_config
+from utils import floor_plan_from_scene, build_sampler_config
+
+from scene_synthesis.datasets import filter_function, get_dataset_raw_and_encoded
+from scene_synthesis.networks import build_network
+
+
+def job_id(job):
+    """The name of the output of a job, stable across runs."""
+    if "text" in job:
+        digest = hashlib.sha1(" ".join(job["text"].split()).encode("utf-8")).hexdigest()[:12]
+        return "text_{}_{:06d}".format(digest, job["seed"])
+    return "{}_{:06d}".format(job["scene_id"], job["seed"])
+
+
+def test_scenes(args):
+    """The raw scenes of the evaluation split."""
+    config = load_config(args.config_file)
+    raw_dataset, _ = get_dataset_raw_and_encoded(
+        config["data"],
+        filter_fn=filter_function(
+            config["data"],
+            split=config["validation"].get("splits", ["test"])
+        ),
+        split=config["validation"].get("splits", ["test"])
+    )
+    return raw_dataset
+
+
+def read_jobs(args):
+    """The jobs of --jobs_file, else the prompts of --prompts_file or every test scene, n_seeds times."""
+    if args.jobs_file is not None:
+        with open(args.jobs_file, "r", encoding="utf-8") as f:
+            jobs = [json.loads(line) for line in f if line.strip()]
+        check_jobs(args, jobs)
+        return jobs
+    if args.prompts_file is not None:
+        with open(args.prompts_file, "r", encoding="utf-8") as f:
+            prompts = [line.strip() for line in f if line.strip()]
+        return [{"text": text, "seed": seed} for text in prompts for seed in range(args.n_seeds)]
+
+    return [{"scene_id": str(scene.scene_id), "seed": seed} for scene in test_scenes(args) for seed in range(args.n_seeds)]
+
+
+def check_jobs(args, jobs):
+    """Raise ValueError for the jobs of --jobs_file that cannot be generated, before starting the workers."""
+    for job in jobs:
+        if not isinstance(job.get("seed", None), int) or ("scene_id" in job) == ("text" in job):
+            raise ValueError("a job needs an integer seed and either a scene_id or a text, got {}".format(job))
+        if "scene_id" in job:
+            job["scene_id"] = str(job["scene_id"])
+    scene_ids = set(job["scene_id"] for job in jobs if "scene_id" in job)
+    if scene_ids:
+        unknown = scene_ids - set(str(scene.scene_id) for scene in test_scenes(args))
+        if unknown:
+            raise ValueError("scene_id not in the evaluation split: {}".format(", ".join(sorted(unknown))))
+
+
+def core_sets(n_workers, n_threads):
+    """The CPU cores of every worker, n_threads consecutive ones of the cores available to the process."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    if n_workers * n_threads > len(cores):
+        print("Warning: {} workers x {} threads oversubscribe the {} available cores".format(
+            n_workers, n_threads, len(cores)))
+    return [[cores[(w * n_threads + i) % len(cores)] for i in range(n_threads)] for w in range(n_workers)]
+
+
+def load_model(args):
+    """The test scenes (raw and encoded) and the network of the experiment, on CPU."""
+    config = load_config(args.config_file)
+    # the encoding of the evaluation, see generate_diffusion.py
+    if 'text' in config["data"]["encoding_type"]:
+        if 'textfix' not in config["data"]["encoding_type"]:
+            config["data"]["encoding_type"] = config["data"]["encoding_type"].replace('text', 'textfix')
+    if "no_prm" not in config["data"]["encoding_type"]:
+        config["data"]["encoding_type"] = config["data"]["encoding_type"] + "_no_prm"
+
+    raw_dataset, dataset = get_dataset_raw_and_encoded(
+        config["data"],
+        filter_fn=filter_function(
+            config["data"],
+            split=config["validation"].get("splits", ["test"])
+        ),
+        split=config["validation"].get("splits", ["test"])
+    )
+    network, _, _ = build_network(
+        dataset.feature_size, dataset.n_classes,
+        config, args.weight_file, device=torch.device("cpu")
+    )
+    network.eval()
+    return config, raw_dataset, dataset, network
+
+
+def generate(job, config, raw_dataset, dataset, network, scene_indices, sampler, args):
+    """The post-processed layout of a job, seeded by the job only."""
+    torch.manual_seed(job["seed"])
+    np.random.seed(job["seed"])
+    if "scene_id" in job:
+        scene = raw_dataset[scene_indices[str(job["scene_id"])]]
+        text = dataset[scene_indices[str(job["scene_id"])]].get("description", None)
+    else:
+        # the floor plan of a prompt, it only conditions the floor plan models
+        scene = raw_dataset[job["seed"] % len(raw_dataset)]
+        text = job["text"]
+    _, _, room_mask = floor_plan_from_scene(scene, None, no_texture=True)
+
+    bbox_params = network.generate_layout(
+        room_mask=room_mask,
+        num_points=config["network"]["sample_num_points"],
+        point_dim=config["network"]["point_dim"],
+        text=text if network.text_condition else None,
+        device="cpu",
+        clip_denoised=args.clip_denoised,
+        sampler=sampler,
+    )
+    boxes = dataset.post_process(bbox_params)
+    classes = np.array(dataset.class_labels)
+    return {
+        "job": job,
+        "scene_id": str(scene.scene_id),
+        "classes": classes[boxes["class_labels"][0].argmax(-1).numpy()].tolist(),
+        "translations": boxes["translations"][0].tolist(),
+        "sizes": boxes["sizes"][0].tolist(),
+        "angles": boxes["angles"][0].tolist(),
+    }
+
+
+def write_result(output_directory, name, result):
+    """Write atomically, a job is finished once its file exists."""
+    path = os.path.join(output_directory, name + ".json")
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+    os.replace(tmp_path, path)
+
+
+def worker(worker_idx, cores, args, jobs, ready, start, results):
+    """
+    Load the model once, then generate the jobs of the queue until its None.
+    A failed load is reported on ready, a failed job on results, with its traceback.
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+    logging.getLogger("trimesh").setLevel(logging.ERROR)
+
+    try:
+        config, raw_dataset, dataset, network = load_model(args)
+        scene_indices = {str(scene.scene_id): i for i, scene in enumerate(raw_dataset)}
+        sampler = network.get_sampler(build_sampler_config(args.sampler, args.sampling_steps))
+    except Exception:
+        ready.put((worker_idx, traceback.format_exc()))
+        return
+    ready.put((worker_idx, None))
+    start.wait()
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_start = time.perf_counter()
+        try:
+            result = generate(job, config, raw_dataset, dataset, network, scene_indices, sampler, args)
+            result["worker"] = worker_idx
+            result["time"] = time.perf_counter() - job_start
+            write_result(args.output_directory, job_id(job), result)
+        except Exception:
+            results.put((job_id(job), time.perf_counter() - job_start, traceback.format_exc()))
+            continue
+        results.put((job_id(job), result["time"], None))
+
+
+def get_from(q, processes, poll=1.):
+    """The next item of q, RuntimeError once a worker died or all of them exited without it."""
+    while True:
+        try:
+            return q.get(timeout=poll)
+        except queue.Empty:
+            pass
+        dead = [p for p in processes if p.exitcode not in (None, 0)]
+        if dead:
+            raise RuntimeError("worker {} died with exit code {}".format(processes.index(dead[0]), dead[0].exitcode))
+        if all(p.exitcode is not None for p in processes):
+            try:
+                return q.get(timeout=poll)
+            except queue.Empty:
+                raise RuntimeError("the workers exited before the end of the run")
+
+
+def wait_loaded(ready, processes):
+    """Wait for every worker to load the model, RuntimeError with the traceback of the first failed one."""
+    for _ in processes:
+        worker_idx, error = get_from(ready, processes)
+        if error is not None:
+            raise RuntimeError("worker {} failed to load the model:\n{}".format(worker_idx, error))
+
+
+def collect_results(results, processes, n_jobs):
+    """Print the n_jobs results as they arrive, with the traceback of the failed jobs, return their number."""
+    failed = 0
+    for i in range(n_jobs):
+        name, elapsed, error = get_from(results, processes)
+        if error is not None:
+            failed += 1
+            print("{}/{}: {} failed ({:.2f} s)\n{}".format(i + 1, n_jobs, name, elapsed, error))
+        else:
+            print("{}/{}: {} ({:.2f} s)".format(i + 1, n_jobs, name, elapsed))
+    return failed
+
+
+def run(args, jobs, n_workers, n_threads):
+    """
+    Generate jobs with n_workers processes of n_threads threads, return the
+    scenes/s once loaded and the number of failed jobs. A worker that fails to
+    load the model or dies aborts the run.
+    """
+    context = multiprocessing.get_context("spawn")
+    job_queue, ready, results = context.Queue(), context.Queue(), context.Queue()
+    start = context.Event()
+    for job in jobs:
+        job_queue.put(job)
+    for _ in range(n_workers):
+        job_queue.put(None)
+
+    load_start = time.perf_counter()
+    processes = [
+        context.Process(target=worker, args=(w, cores, args, job_queue, ready, start, results))
+        for w, cores in enumerate(core_sets(n_workers, n_threads))
+    ]
+    for p in processes:
+        p.start()
+    try:
+        wait_loaded(ready, processes)
+        print("{} workers loaded the model in {:.1f} s".format(n_workers, time.perf_counter() - load_start))
+
+        generation_start = time.perf_counter()
+        start.set()
+        failed = collect_results(results, processes, len(jobs))
+        elapsed = time.perf_counter() - generation_start
+    except BaseException:
+        for p in processes:
+            p.terminate()
+        raise
+    for p in processes:
+        p.join()
+    return (len(jobs) - failed) / elapsed, failed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=("Generate the layouts of (scene id or prompt, seed) jobs with several "
+                     "CPU worker processes, skipping the jobs already in the output directory")
+    )
+
+    parser.add_argument(
+        "config_file",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser.add_argument(
+        "output_directory",
+        help="Path to the output directory, one json layout per job"
+    )
+    parser.add_argument(
+        "--weight_file",
+        default=None,
+        help="Path to a pretrained model"
+    )
+    parser.add_argument(
+        "--jobs_file",
+        default=None,
+        help="A jsonl file of jobs, {\"scene_id\": ..., \"seed\": ...} or {\"text\": ..., \"seed\": ...}"
+    )
+    parser.add_argument(
+        "--prompts_file",
+        default=None,
+        help="A text file of prompts, one per line, generated --n_seeds times each"
+    )
+    parser.add_argument(
+        "--n_seeds",
+        type=int,
+        default=1,
+        help="The number of seeds of every test scene / prompt"
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=4,
+        help="The number of worker processes"
+    )
+    parser.add_argument(
+        "--n_threads",
+        type=int,
+        default=1,
+        help="The number of intra-op threads (and pinned cores) of every worker"
+    )
+    parser.add_argument(
+        "--configurations",
+        type=lambda x: [tuple(map(int, c.split("x"))) for c in x.split(",")],
+        default=None,
+        help=("Comma separated <workers>x<threads> to compare, e.g. 1x8,2x4,8x1, every one "
+              "generating all the jobs into its own subdirectory")
+    )
+    parser.add_argument(
+        "--sampler",
+        choices=["ddpm", "ddim", "dpm_solver"],
+        default=None,
+        help="Sampler for the reverse process (defaults to the network config, else ddpm)"
+    )
+    parser.add_argument(
+        "--sampling_steps",
+        type=int,
+        default=None,
+        help="Number of sampling steps"
+    )
+    parser.add_argument(
+        "--clip_denoised",
+        action="store_true",
+        help="if clip_denoised"
+    )
+
+    args = parser.parse_args(argv)
+    os.makedirs(args.output_directory, exist_ok=True)
+
+    jobs = read_jobs(args)
+    print("{} jobs".format(len(jobs)))
+
+    configurations = args.configurations or [(args.n_workers, args.n_threads)]
+    output_directory = args.output_directory
+    throughputs = []
+    for n_workers, n_threads in configurations:
+        if args.configurations is not None:
+            args.output_directory = os.path.join(output_directory, "{}x{}".format(n_workers, n_threads))
+            os.makedirs(args.output_directory, exist_ok=True)
+        todo = [job for job in jobs if not os.path.exists(os.path.join(args.output_directory, job_id(job) + ".json"))]
+        print("{} workers x {} threads: {} jobs to generate, {} already done".format(
+            n_workers, n_threads, len(todo), len(jobs) - len(todo)))
+        if todo:
+            throughput, failed = run(args, todo, min(n_workers, len(todo)), n_threads)
+            throughputs.append((n_workers, n_threads, len(todo) - failed, failed, throughput))
+
+    for n_workers, n_threads, n_scenes, failed, throughput in throughputs:
+        print("{:3d} workers x {:2d} threads: {:5d} scenes - {:.2f} scenes/s{}".format(
+            n_workers, n_threads, n_scenes, throughput, " ({} failed jobs)".format(failed) if failed else ""))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,356 @@
+"""Script used for serving layout generation over HTTP on localhost, with dynamic request batching."""
+import argparse
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from training_utils import load_config
+from utils import floor_plan_from_scene, build_sampler_config
+
+from scene_synthesis.datasets import filter_function, get_dataset_raw_and_encoded
+from scene_synthesis.datasets.threed_future_dataset import ThreedFutureDataset
+from scene_synthesis.networks import build_network
+
+
+class Histogram(object):
+    """A cumulative histogram in the Prometheus text format."""
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def lines(self):
+        yield "# HELP {} {}".format(self.name, self.help)
+        yield "# TYPE {} histogram".format(self.name)
+        for bound, count in zip(self.buckets, self.counts):
+            yield '{}_bucket{{le="{}"}} {}'.format(self.name, bound, count)
+        yield '{}_bucket{{le="+Inf"}} {}'.format(self.name, self.count)
+        yield "{}_sum {}".format(self.name, self.sum)
+        yield "{}_count {}".format(self.name, self.count)
+
+
+class Metrics(object):
+    def __init__(self, max_batch_size):
+        self.lock = threading.Lock()
+        self.queue_depth = Histogram(
+            "diffuscene_queue_depth", "Requests waiting when a batch is formed",
+            [0, 1, 2, 4, 8, 16, 32, 64, 128])
+        self.batch_size = Histogram(
+            "diffuscene_batch_size", "Requests per batched sample call",
+            [2 ** i for i in range(max(max_batch_size - 1, 1).bit_length() + 1)])
+        self.latency = Histogram(
+            "diffuscene_request_latency_seconds", "Time from the arrival of a request to its response",
+            [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60])
+        self.queue_time = Histogram(
+            "diffuscene_queue_seconds", "Time a request waits before its batch starts",
+            [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5])
+
+    def text(self, current_depth):
+        with self.lock:
+            lines = ["# HELP diffuscene_queue_depth_current Requests waiting now",
+                     "# TYPE diffuscene_queue_depth_current gauge",
+                     "diffuscene_queue_depth_current {}".format(current_depth)]
+            for histogram in [self.queue_depth, self.batch_size, self.latency, self.queue_time]:
+                lines.extend(histogram.lines())
+        return "\n".join(lines) + "\n"
+
+
+class Request(object):
+    def __init__(self, params):
+        self.params = params
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LayoutGenerator(object):
+    """The network, the bounds of its dataset and the furniture catalog, loaded once."""
+    def __init__(self, args, device):
+        config = load_config(args.config_file)
+        # the encoding of the evaluation, see generate_diffusion.py
+        if 'text' in config["data"]["encoding_type"]:
+            if 'textfix' not in config["data"]["encoding_type"]:
+                config["data"]["encoding_type"] = config["data"]["encoding_type"].replace('text', 'textfix')
+        if "no_prm" not in config["data"]["encoding_type"]:
+            config["data"]["encoding_type"] = config["data"]["encoding_type"] + "_no_prm"
+        self.config = config
+
+        self.raw_dataset, self.dataset = get_dataset_raw_and_encoded(
+            config["data"],
+            filter_fn=filter_function(
+                config["data"],
+                split=config["validation"].get("splits", ["test"])
+            ),
+            split=config["validation"].get("splits", ["test"])
+        )
+        self.scene_indices = {str(scene.scene_id): i for i, scene in enumerate(self.raw_dataset)}
+        self.classes = np.array(self.dataset.class_labels)
+        self.objects_dataset = ThreedFutureDataset.from_pickled_dataset(args.path_to_pickled_3d_futute_models)
+        print("Loaded {} scenes and {} 3D-FUTURE models".format(len(self.raw_dataset), len(self.objects_dataset)))
+
+        self.device = device
+        self.network, _, _ = build_network(
+            self.dataset.feature_size, self.dataset.n_classes,
+            config, args.weight_file, device=device
+        )
+        self.network.eval()
+        # the batches mixing prompts of different lengths are sampled with the eager
+        # equivalent of a jit / onnx backend, which takes no mask of their tokens (Sampler.eager)
+        self.sampler = self.network.get_sampler(build_sampler_config(args.sampler, args.sampling_steps))
+        self.clip_denoised = args.clip_denoised
+
+    def validate(self, params):
+        """Raise ValueError for the requests that cannot be generated."""
+        if "scene_id" in params and str(params["scene_id"]) not in self.scene_indices:
+            raise ValueError("unknown scene_id {}".format(params["scene_id"]))
+        if self.network.text_condition and not isinstance(params.get("text", None), str):
+            raise ValueError("the model is text conditioned, a \"text\" is required")
+
+    def generate(self, batch):
+        """The layouts of a batch of request parameters, one batched sample call."""
+        scenes = []
+        for params in batch:
+            if "scene_id" in params:
+                scenes.append(self.raw_dataset[self.scene_indices[str(params["scene_id"])]])
+            else:
+                scenes.append(self.raw_dataset[np.random.choice(len(self.raw_dataset))])
+        room_mask = torch.cat([floor_plan_from_scene(scene, None, no_texture=True)[2] for scene in scenes])
+
+        bbox_params = self.network.generate_layout(
+            room_mask=room_mask.to(self.device),
+            num_points=self.config["network"]["sample_num_points"],
+            point_dim=self.config["network"]["point_dim"],
+            batch_size=len(batch),
+            text=[params["text"] for params in batch] if self.network.text_condition else None,
+            device=self.device,
+            clip_denoised=self.clip_denoised,
+            sampler=self.sampler,
+        )
+        if len(batch) == 1:
+            bbox_params = [bbox_params]
+        return [self.layout(scene, samples) for scene, samples in zip(scenes, bbox_params)]
+
+    def layout(self, scene, bbox_params):
+        boxes = self.dataset.post_process(bbox_params)
+        objects = []
+        for j in range(boxes["class_labels"].shape[1]):
+            label = self.classes[boxes["class_labels"][0, j].argmax(-1).item()]
+            size = boxes["sizes"][0, j].numpy()
+            furniture = self.objects_dataset.get_closest_furniture_to_box(label, size)
+            objects.append({
+                "class": str(label),
+                "model_jid": furniture.raw_model_path.split('/')[-2],
+                "translation": boxes["translations"][0, j].tolist(),
+                "size": size.tolist(),
+                "angle": boxes["angles"][0, j].tolist(),
+            })
+        return {"scene_id": str(scene.scene_id), "objects": objects}
+
+
+class DynamicBatcher(object):
+    """
+    Coalesces the requests arriving within max_wait seconds of the first
+    waiting one into one batch of at most max_batch_size, generated by a
+    single thread. When a batch fails, its requests are generated again one
+    by one, so that a failing request does not fail the others.
+    """
+    def __init__(self, generator, metrics, max_batch_size=16, max_wait=0.02):
+        self.generator = generator
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, params):
+        request = Request(params)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result, request
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = batch[0].arrival + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            start = time.perf_counter()
+            with self.metrics.lock:
+                self.metrics.queue_depth.observe(self.requests.qsize())
+                self.metrics.batch_size.observe(len(batch))
+                for request in batch:
+                    self.metrics.queue_time.observe(start - request.arrival)
+            try:
+                self.generate(batch)
+            except Exception as e:
+                logging.exception("batch of %d requests failed", len(batch))
+                for request in batch:
+                    if len(batch) == 1:
+                        request.error = e
+                        continue
+                    try:
+                        self.generate([request])
+                    except Exception as e_request:
+                        logging.exception("request %s failed", request.params)
+                        request.error = e_request
+            for request in batch:
+                request.done.set()
+
+    def generate(self, batch):
+        with torch.no_grad():
+            results = self.generator.generate([request.params for request in batch])
+        for request, result in zip(batch, results):
+            request.result = dict(result, batch_size=len(batch))
+
+
+def make_handler(batcher, metrics):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, body, content_type="application/json"):
+            data = body.encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._send(200, metrics.text(batcher.requests.qsize()), "text/plain; version=0.0.4")
+            elif self.path == "/health":
+                self._send(200, json.dumps({"status": "ok"}))
+            else:
+                self._send(404, json.dumps({"error": "not found"}))
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self._send(404, json.dumps({"error": "not found"}))
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                params = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(params, dict):
+                    raise ValueError("the request body must be a json object")
+                batcher.generator.validate(params)
+            except ValueError as e:
+                self._send(400, json.dumps({"error": str(e)}))
+                return
+            try:
+                result, request = batcher.submit(params)
+            except Exception as e:
+                self._send(500, json.dumps({"error": str(e)}))
+                return
+            latency = time.perf_counter() - request.arrival
+            with metrics.lock:
+                metrics.latency.observe(latency)
+            self._send(200, json.dumps(dict(result, latency_seconds=latency)))
+
+        def log_message(self, format, *args):
+            logging.info("%s - %s", self.address_string(), format % args)
+
+    return Handler
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=("Serve layout generation on localhost: POST /generate with a json "
+                     "{\"text\": ..., \"scene_id\": ...}, GET /metrics, GET /health")
+    )
+
+    parser.add_argument(
+        "config_file",
+        help="Path to the file that contains the experiment configuration"
+    )
+    parser.add_argument(
+        "path_to_pickled_3d_futute_models",
+        help="Path to the 3D-FUTURE model meshes"
+    )
+    parser.add_argument(
+        "--weight_file",
+        default=None,
+        help="Path to a pretrained model"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8000,
+        help="The port of the server, bound to 127.0.0.1"
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=16,
+        help="The maximum number of requests generated in one batch"
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=20.,
+        help="The latency budget of the batching: how long the first waiting request waits for others"
+    )
+    parser.add_argument(
+        "--sampler",
+        choices=["ddpm", "ddim", "dpm_solver"],
+        default=None,
+        help="Sampler for the reverse process (defaults to the network config, else ddpm)"
+    )
+    parser.add_argument(
+        "--sampling_steps",
+        type=int,
+        default=None,
+        help="Number of sampling steps"
+    )
+    parser.add_argument(
+        "--clip_denoised",
+        action="store_true",
+        help="if clip_denoised"
+    )
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("trimesh").setLevel(logging.ERROR)
+
+    device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
+    print("Running code on", device)
+
+    generator = LayoutGenerator(args, device)
+    metrics = Metrics(args.max_batch_size)
+    batcher = DynamicBatcher(generator, metrics, args.max_batch_size, args.max_wait_ms / 1000.)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(batcher, metrics))
+    print("Serving on http://127.0.0.1:{}".format(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
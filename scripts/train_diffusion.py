@@ -19,7 +19,7 @@ from torch.utils.data import DataLoader
 
 from training_utils import id_generator, save_experiment_params, load_config, yield_forever, load_checkpoints, save_checkpoints
 
-from scene_synthesis.datasets import get_encoded_dataset, filter_function
+from scene_synthesis.datasets import get_encoded_dataset, filter_function, LengthBucketBatchSampler
 from scene_synthesis.networks import build_network, optimizer_factory, schedule_factory, adjust_learning_rate
 from scene_synthesis.stats_logger import StatsLogger, WandB
 
@@ -147,13 +147,26 @@ def main(argv):
         split=config["validation"].get("splits", ["test"])
     )
 
-    train_loader = DataLoader(
-        train_dataset,
-        batch_size=config["training"].get("batch_size", 128),
-        num_workers=args.n_processes,
-        collate_fn=train_dataset.collate_fn,
-        shuffle=True
-    )
+    if config["training"].get("bucket_by_length", False):
+        # batches of scenes with similar numbers of objects, padded to their longest scene
+        train_loader = DataLoader(
+            train_dataset,
+            batch_sampler=LengthBucketBatchSampler(
+                train_dataset.object_counts(),
+                config["training"].get("batch_size", 128),
+                pool_size=config["training"].get("bucket_pool_size", 50)
+            ),
+            num_workers=args.n_processes,
+            collate_fn=train_dataset.collate_fn_to_batch_length
+        )
+    else:
+        train_loader = DataLoader(
+            train_dataset,
+            batch_size=config["training"].get("batch_size", 128),
+            num_workers=args.n_processes,
+            collate_fn=train_dataset.collate_fn,
+            shuffle=True
+        )
     print("Loaded {} training scenes with {} object types".format(
         len(train_dataset), train_dataset.n_object_types)
     )
@@ -14,6 +14,8 @@ from simple_3dviz.behaviours.io import SaveFrames
 from simple_3dviz.utils import render as render_simple_3dviz
 
 from scene_synthesis.utils import get_textured_objects, get_textured_objects_based_on_objfeats
+from scene_synthesis.networks.loss import axis_aligned_bbox_pairwise_overlaps_3d
+from scene_synthesis.networks.quantization import quantize_network
 import trimesh
 import torch
 import open3d as o3d
@@ -356,6 +358,46 @@ def make_network_input(current_boxes, indices):
     )
 
 
+def build_sampler_config(sampler, num_steps=None, backend=None, cache_dir=None, num_threads=None,
+                         early_exit_tolerance=None, early_exit_window=20, parallel_window=None,
+                         parallel_tolerance=0.1, deep_cache_interval=None, prune_empty_window=None,
+                         prune_empty_threshold=0.5):
+    """
+    The sampler config of the --sampler/--sampling_steps/--backend/--early_exit_*
+    /--parallel_*/--deep_cache_interval/--prune_empty_* arguments, None to use the
+    network config.
+    """
+    if sampler is None and backend is None and early_exit_tolerance is None and parallel_window is None and \
+            deep_cache_interval is None and prune_empty_window is None:
+        return None
+    config = {"type": sampler or "ddpm"}
+    if num_steps is not None:
+        config["num_steps"] = num_steps
+    if backend is not None:
+        config["backend"] = backend
+        config["cache_dir"] = cache_dir
+        config["num_threads"] = num_threads
+    if early_exit_tolerance is not None:
+        config["early_exit"] = {"tolerance": early_exit_tolerance, "window": early_exit_window}
+    if parallel_window is not None:
+        config["parallel"] = {"window": parallel_window, "tolerance": parallel_tolerance}
+    if deep_cache_interval is not None:
+        config["deep_cache"] = {"interval": deep_cache_interval}
+    if prune_empty_window is not None:
+        config["prune_empty"] = {"threshold": prune_empty_threshold, "window": prune_empty_window}
+    return config
+
+
+def quantize_network_for_sampling(network, mode, train_dataset, num_calibration_rooms=256):
+    """int8 quantization of the network for CPU sampling, static calibrated on training rooms."""
+    calibration_batches = None
+    if mode == "static":
+        calibration_batches = torch.utils.data.DataLoader(
+            train_dataset, batch_size=32, shuffle=True, collate_fn=train_dataset.collate_fn
+        )
+    return quantize_network(network, mode, calibration_batches, num_calibration_rooms)
+
+
 def render_to_folder(
     args,
     folder,
@@ -555,111 +597,6 @@ def render_scene_from_bbox_params(
                 export_scene(path_to_scene, trimesh_meshes)
                 
                 
-## calcalte iou
-def axis_aligned_bbox_overlaps_3d(bboxes1,
-                                  bboxes2,
-                                  mode='iou',
-                                  is_aligned=False,
-                                  eps=1e-6):
-    """Calculate overlap between two set of axis aligned 3D bboxes. If
-        ``is_aligned`` is ``False``, then calculate the overlaps between each bbox
-        of bboxes1 and bboxes2, otherwise the overlaps between each aligned pair of
-        bboxes1 and bboxes2.
-        Args:
-            bboxes1 (Tensor): shape (B, m, 6) in <x1, y1, z1, x2, y2, z2>
-                format or empty.
-            bboxes2 (Tensor): shape (B, n, 6) in <x1, y1, z1, x2, y2, z2>
-                format or empty.
-                B indicates the batch dim, in shape (B1, B2, ..., Bn).
-                If ``is_aligned`` is ``True``, then m and n must be equal.
-            mode (str): "iou" (intersection over union) or "giou" (generalized
-                intersection over union).
-            is_aligned (bool, optional): If True, then m and n must be equal.
-                Defaults to False.
-            eps (float, optional): A value added to the denominator for numerical
-                stability. Defaults to 1e-6.
-        Returns:
-            Tensor: shape (m, n) if ``is_aligned`` is False else shape (m,)
-    """
-
-    assert mode in ['iou', 'giou'], f'Unsupported mode {mode}'
-    # Either the boxes are empty or the length of boxes's last dimension is 6
-    assert (bboxes1.size(-1) == 6 or bboxes1.size(0) == 0)
-    assert (bboxes2.size(-1) == 6 or bboxes2.size(0) == 0)
-
-    # Batch dim must be the same
-    # Batch dim: (B1, B2, ... Bn)
-    assert bboxes1.shape[:-2] == bboxes2.shape[:-2]
-    batch_shape = bboxes1.shape[:-2]
-
-    rows = bboxes1.size(-2)
-    cols = bboxes2.size(-2)
-    if is_aligned:
-        assert rows == cols
-
-    if rows * cols == 0:
-        if is_aligned:
-            return bboxes1.new(batch_shape + (rows, ))
-        else:
-            return bboxes1.new(batch_shape + (rows, cols))
-
-    area1 = (bboxes1[..., 3] -
-             bboxes1[..., 0]) * (bboxes1[..., 4] - bboxes1[..., 1]) * (
-                 bboxes1[..., 5] - bboxes1[..., 2])
-    area2 = (bboxes2[..., 3] -
-             bboxes2[..., 0]) * (bboxes2[..., 4] - bboxes2[..., 1]) * (
-                 bboxes2[..., 5] - bboxes2[..., 2])
-
-    if is_aligned:
-        lt = torch.max(bboxes1[..., :3], bboxes2[..., :3])  # [B, rows, 3]
-        rb = torch.min(bboxes1[..., 3:], bboxes2[..., 3:])  # [B, rows, 3]
-
-        wh = (rb - lt).clamp(min=0)  # [B, rows, 2]
-        overlap = wh[..., 0] * wh[..., 1] * wh[..., 2]
-
-        if mode in ['iou', 'giou']:
-            union = area1 + area2 - overlap
-        else:
-            union = area1
-        if mode == 'giou':
-            enclosed_lt = torch.min(bboxes1[..., :3], bboxes2[..., :3])
-            enclosed_rb = torch.max(bboxes1[..., 3:], bboxes2[..., 3:])
-    else:
-        lt = torch.max(bboxes1[..., :, None, :3],
-                       bboxes2[..., None, :, :3])  # [B, rows, cols, 3]
-        rb = torch.min(bboxes1[..., :, None, 3:],
-                       bboxes2[..., None, :, 3:])  # [B, rows, cols, 3]
-
-        wh = (rb - lt).clamp(min=0)  # [B, rows, cols, 3]
-        overlap = wh[..., 0] * wh[..., 1] * wh[..., 2]
-
-        if mode in ['iou', 'giou']:
-            union = area1[..., None] + area2[..., None, :] - overlap
-        if mode == 'giou':
-            enclosed_lt = torch.min(bboxes1[..., :, None, :3],
-                                    bboxes2[..., None, :, :3])
-            enclosed_rb = torch.max(bboxes1[..., :, None, 3:],
-                                    bboxes2[..., None, :, 3:])
-
-    eps = union.new_tensor([eps])
-    union = torch.max(union, eps)
-    ious = overlap / union
-    # make the diagonal line to zero
-    assert rows == cols
-    for i in range(rows):
-        overlap[:, i, i] = 0.0
-    overlap_sum = overlap.sum(dim=[1, 2]) / 2.0
-    area_sum = (area1.sum(dim=1) + area2.sum(dim=1)) / 2.0 - overlap_sum
-    overlap_ratio = overlap_sum / area_sum
-    if mode in ['iou']:
-        return ious, overlap_ratio
-    # calculate gious
-    enclose_wh = (enclosed_rb - enclosed_lt).clamp(min=0)
-    enclose_area = enclose_wh[..., 0] * enclose_wh[..., 1] * enclose_wh[..., 2]
-    enclose_area = torch.max(enclose_area, eps)
-    gious = ious - (enclose_area - union) / enclose_area
-    return gious
-
 def computer_intersection(trimeshes, judge_mesh_intersec=False):
     box_list = []
     for i in range(len(trimeshes)):
@@ -672,32 +609,23 @@ def computer_intersection(trimeshes, judge_mesh_intersec=False):
         return len(trimeshes), 1, 0, 0, 0
     
     box_tensor = torch.from_numpy(box_array[None, ])
-    box_iou, overlap_ratio = axis_aligned_bbox_overlaps_3d(box_tensor, box_tensor)
-    
-    box_iou = box_iou.squeeze(0).cpu().numpy()
-
-    iou_list = []
-    insec_list = []
-    for i in range(len(trimeshes)):
-        for j in range(i+1, len(trimeshes)):
-            if box_iou[i, j] > 0.0:
-                if judge_mesh_intersec:
-                    s1, s2 = pv.wrap(trimeshes[i]), pv.wrap(trimeshes[j])
-                    intersection, s1_split, s2_split = s1.intersection(s2)
-                    if intersection.n_verts >0 and intersection.n_faces >0:
-                        iou_list.append(box_iou[i, j])
-                        insec_list.append(1)
-                    else:
-                        iou_list.append(0)
-                        insec_list.append(0)
-                else:
-                    iou_list.append(box_iou[i, j])
-                    insec_list.append(1)
-            else:
-                iou_list.append(0)
-                insec_list.append(0)
+    # pairwise iou of the upper triangle (i < j) only, the diagonal is never computed
+    pairwise = axis_aligned_bbox_pairwise_overlaps_3d(box_tensor)
+    overlap_sum = pairwise.overlaps.sum(dim=1)
+    overlap_ratio = overlap_sum / (pairwise.areas.sum(dim=1) - overlap_sum)
+
+    box_iou = pairwise.ious.squeeze(0).cpu().numpy()
+    insec = box_iou > 0.0
+    if judge_mesh_intersec:
+        rows, cols = np.triu_indices(len(trimeshes), k=1)
+        for k in np.nonzero(insec)[0]:
+            s1, s2 = pv.wrap(trimeshes[rows[k]]), pv.wrap(trimeshes[cols[k]])
+            intersection, s1_split, s2_split = s1.intersection(s2)
+            if not (intersection.n_verts >0 and intersection.n_faces >0):
+                insec[k] = False
+    iou_list = np.where(insec, box_iou, 0.0)
     # return num_of_objects, number of pairs, avg iou (iou sum / pairs), avg intersection numbers ( intersec sum/ pairs)
-    return len(trimeshes), len(iou_list), float(sum(iou_list))/len(iou_list), float(sum(insec_list))/len(iou_list), overlap_ratio.item()
+    return len(trimeshes), len(iou_list), float(iou_list.sum())/len(iou_list), float(insec.sum())/len(iou_list), overlap_ratio.item()
 
 def judge_if_symmetry(box1, box2, size_diff=0.1, pos_diff=0.1):
     center1, size1 = (box1[3:6] + box1[0:3])/2.0,  (box1[3:6] - box1[0:3])/2.0
@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from scene_synthesis.networks.denoise_net import Unet1D
+from scene_synthesis.networks.diffusion_ddpm import DiffusionPoint
+
+
+# a tiny random-weight layout denoiser: scenes of 8 objects with a bbox of
+# translation (3), size (3) and angle (2), 4 classes, no objectness, an
+# instance embedding per object and a text context
+NUM_POINTS = 8
+POINT_DIM = 12
+INSTANCE_DIM = 16
+TEXT_DIM = 16
+
+NETWORK_CONFIG = {
+    "objectness_dim": 0,
+    "class_dim": 4,
+    "angle_dim": 2,
+    "objfeat_dim": 0,
+}
+
+NET_KWARGS = {
+    "dim": 32,
+    "dim_mults": [1, 1],
+    "channels": POINT_DIM,
+    "objectness_dim": 0,
+    "class_dim": 4,
+    "angle_dim": 2,
+    "objfeat_dim": 0,
+    "context_dim": 0,
+    "instanclass_dim": INSTANCE_DIM,
+    "seperate_all": True,
+    "merge_bbox": True,
+    "modulate_time_context_instanclass": True,
+    "text_condition": True,
+    "text_dim": TEXT_DIM,
+}
+
+
+@pytest.fixture
+def diffusion():
+    torch.manual_seed(0)
+    denoise_net = Unet1D(**NET_KWARGS)
+    return DiffusionPoint(denoise_net, NETWORK_CONFIG, time_num=100, model_mean_type="v").eval()
+
+
+@pytest.fixture
+def point_shape():
+    return (NUM_POINTS, POINT_DIM)
+
+
+@pytest.fixture
+def random_conditions():
+    """Random condition and condition_cross of the denoiser, for batch_size scenes."""
+    def conditions(batch_size, num_tokens=5):
+        return torch.randn(batch_size, NUM_POINTS, INSTANCE_DIM), torch.randn(batch_size, num_tokens, TEXT_DIM)
+    return conditions
@@ -0,0 +1,112 @@
+import pytest
+import torch
+
+from einops import rearrange
+
+from scene_synthesis.networks.denoise_net import Attention, AttentionCross, LinearAttention, LinearAttentionCross, \
+    AttentionLast, LinearAttentionLast, LinearAttentionCrossLast, PreNorm, Residual, channels_last_state_dict
+
+
+DIM = 32
+NUM_OBJECTS = 12
+NUM_TOKENS = 6
+
+
+def reference_linear_attention(module, x, context=None):
+    """The einsum chain of the channels-first (cross) linear attention layers."""
+    if context is None:
+        q, k, v = module.to_qkv(x).chunk(3, dim=1)
+    else:
+        q = module.to_q(x)
+        k, v = module.to_kv(context).chunk(2, dim=1)
+    q, k, v = map(lambda t: rearrange(t, 'b (h c) n -> b h c n', h=module.heads), (q, k, v))
+    q = q.softmax(dim=-2) * module.scale
+    k = k.softmax(dim=-1)
+    context = torch.einsum('b h d n, b h e n -> b h d e', k, v)
+    out = torch.einsum('b h d e, b h d n -> b h e n', context, q)
+    return module.to_out(rearrange(out, 'b h c n -> b (h c) n'))
+
+
+def reference_attention(module, x):
+    """The einsum chain of the channels-first softmax attention layer."""
+    q, k, v = map(lambda t: rearrange(t, 'b (h c) n -> b h c n', h=module.heads), module.to_qkv(x).chunk(3, dim=1))
+    sim = torch.einsum('b h d i, b h d j -> b h i j', q * module.scale, k)
+    out = torch.einsum('b h i j, b h d j -> b h i d', sim.softmax(dim=-1), v)
+    return module.to_out(rearrange(out, 'b h n d -> b (h d) n'))
+
+
+LAYERS = [
+    (Attention, AttentionLast, reference_attention, False),
+    (LinearAttention, LinearAttentionLast, reference_linear_attention, False),
+    (LinearAttentionCross, LinearAttentionCrossLast, reference_linear_attention, True),
+    (AttentionCross, None, reference_linear_attention, True),
+]
+
+
+@pytest.fixture
+def inputs():
+    torch.manual_seed(0)
+    return torch.randn(3, DIM, NUM_OBJECTS), torch.randn(3, DIM, NUM_TOKENS)
+
+
+@pytest.mark.parametrize("klass, klass_last, reference_fn, cross", LAYERS)
+def test_attention_matches_reference(inputs, klass, klass_last, reference_fn, cross):
+    x, context = inputs
+    module = klass(DIM).eval()
+    args = (x, context) if cross else (x,)
+    with torch.no_grad():
+        out = module(*args)
+        expected = reference_fn(module, *args)
+    assert torch.allclose(out, expected, atol=1e-5), (out - expected).abs().max()
+
+
+@pytest.mark.parametrize("klass, klass_last, reference_fn, cross", LAYERS)
+def test_attention_skips_padded_keys(inputs, klass, klass_last, reference_fn, cross):
+    x, context = inputs
+    module = klass(DIM).eval()
+    with torch.no_grad():
+        if cross:
+            # the outputs match the reference run on the valid tokens only
+            num_valid = NUM_TOKENS // 2
+            token_mask = (torch.arange(NUM_TOKENS) < num_valid).expand(x.shape[0], -1)
+            out = module(x, context, mask=token_mask)
+            expected = reference_fn(module, x, context[:, :, :num_valid])
+            assert torch.allclose(out, expected, atol=1e-5), (out - expected).abs().max()
+        else:
+            # random valid object slots, at least one per scene
+            mask = torch.rand(x.shape[0], NUM_OBJECTS) >= 0.5
+            mask[:, 0] = True
+            out = module(x, mask=mask)
+            for b in range(x.shape[0]):
+                valid = mask[b].nonzero()[:, 0]
+                expected = reference_fn(module, x[b:b + 1, :, valid])
+                assert torch.allclose(out[b:b + 1, :, valid], expected, atol=1e-5), (out[b:b + 1, :, valid] - expected).abs().max()
+
+
+@pytest.mark.parametrize("klass, klass_last, reference_fn, cross", [layer for layer in LAYERS if layer[1] is not None])
+def test_channels_last_attention_matches_reference(inputs, klass, klass_last, reference_fn, cross):
+    x, context = inputs
+    module = klass(DIM).eval()
+    module_last = klass_last(DIM).eval()
+    module_last.load_state_dict(channels_last_state_dict(module.state_dict()))
+    args = (x, context) if cross else (x,)
+    with torch.no_grad():
+        out = module_last(*(a.transpose(1, 2).contiguous() for a in args)).transpose(1, 2)
+        expected = reference_fn(module, *args)
+    assert torch.allclose(out, expected, atol=1e-5), (out - expected).abs().max()
+
+
+@pytest.mark.parametrize("klass", [Attention, LinearAttention])
+def test_padded_scene_matches_the_scene_alone(klass):
+    # the self-attention blocks of Unet1D on a batch padded to its longest scene,
+    # the slots past the objects of every scene masked as keys
+    torch.manual_seed(0)
+    block = Residual(PreNorm(DIM, klass(DIM))).eval()
+    lengths = [NUM_OBJECTS, 5, 1]
+    x = torch.randn(len(lengths), DIM, NUM_OBJECTS)
+    mask = torch.arange(NUM_OBJECTS)[None, :] < torch.tensor(lengths)[:, None]
+    with torch.no_grad():
+        out = block(x, mask=mask)
+        for b, length in enumerate(lengths):
+            alone = block(x[b:b + 1, :, :length])
+            assert torch.allclose(out[b:b + 1, :, :length], alone, atol=1e-5), (out[b:b + 1, :, :length] - alone).abs().max()
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from scene_synthesis.networks.inference import OnnxDenoiser, OnnxSampler, export_onnx
+from scene_synthesis.networks.samplers import sampler_factory
+
+pytest.importorskip("onnxruntime")
+
+
+def test_onnx_denoiser_matches_pytorch(diffusion, random_conditions, point_shape, tmp_path):
+    torch.manual_seed(0)
+    num_timesteps = diffusion.diffusion.num_timesteps
+    path = str(tmp_path / "denoiser.onnx")
+    condition, condition_cross = random_conditions(2)
+    export_onnx(diffusion.model, path, torch.randn((2,) + point_shape), torch.zeros(2, dtype=torch.int64),
+                condition, condition_cross)
+    denoiser = OnnxDenoiser(path, num_threads=1)
+
+    # the batch size and the text length are dynamic, check other ones than the exported ones
+    for batch_size, num_tokens in [(1, 5), (3, 7)]:
+        x_t = torch.randn((batch_size,) + point_shape)
+        t = torch.randint(0, num_timesteps, size=(batch_size,))
+        condition, condition_cross = random_conditions(batch_size, num_tokens)
+        with torch.no_grad():
+            out = diffusion._denoise(x_t, t, condition, condition_cross)
+        out_onnx = denoiser(x_t, t, condition, condition_cross)
+        assert torch.allclose(out, out_onnx, atol=1e-4, rtol=1e-4), (out - out_onnx).abs().max()
+
+
+def test_onnx_sampler_matches_pytorch(diffusion, random_conditions, point_shape, tmp_path):
+    torch.manual_seed(0)
+    shape = (2,) + point_shape
+    condition, condition_cross = random_conditions(2)
+    sampler_config = {"type": "ddim", "num_steps": 10}
+
+    samples = []
+    for sampler in [
+        sampler_factory(diffusion.diffusion, sampler_config),
+        OnnxSampler(sampler_factory(diffusion.diffusion, sampler_config), diffusion.model,
+                    cache_dir=str(tmp_path), num_threads=1),
+    ]:
+        # the same deterministic sampling loop, from the same noise
+        torch.manual_seed(1)
+        with torch.no_grad():
+            samples.append(diffusion.gen_samples(shape, "cpu", condition=condition, condition_cross=condition_cross,
+                                                 sampler=sampler))
+    assert torch.allclose(samples[0], samples[1], atol=1e-3), (samples[0] - samples[1]).abs().max()
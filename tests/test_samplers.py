@@ -0,0 +1,178 @@
+import copy
+import pytest
+import torch
+
+from scene_synthesis.networks.diffusion_ddpm import _SampleLoopState
+from scene_synthesis.networks.samplers import distillation_grid, sampler_factory
+
+
+@pytest.mark.parametrize("sampler_config", [
+    {"type": "ddpm"},
+    {"type": "ddpm", "num_steps": 10},
+    {"type": "ddim", "num_steps": 10},
+    {"type": "ddim", "num_steps": 10, "eta": 1.},
+    {"type": "dpm_solver", "num_steps": 10},
+])
+def test_completion_keeps_the_given_objects(diffusion, random_conditions, point_shape, sampler_config):
+    torch.manual_seed(0)
+    batch_size, num_partial = 2, 3
+    shape = (batch_size,) + point_shape
+    condition, condition_cross = random_conditions(batch_size)
+    partial_boxes = torch.rand(batch_size, num_partial, point_shape[1]) * 2 - 1
+
+    sampler = sampler_factory(diffusion.diffusion, sampler_config)
+    with torch.no_grad():
+        samples = diffusion.complete_samples(shape, "cpu", condition=condition, condition_cross=condition_cross,
+                                             partial_boxes=partial_boxes, sampler=sampler)
+
+    assert samples.shape == shape
+    assert torch.equal(samples[:, :num_partial, :], partial_boxes)
+    assert torch.isfinite(samples).all()
+
+
+@pytest.mark.parametrize("sampler_config, completion", [
+    ({"type": "ddpm"}, False),
+    ({"type": "ddpm", "num_steps": 10}, False),
+    ({"type": "ddim", "num_steps": 10}, False),
+    ({"type": "dpm_solver", "num_steps": 10}, False),
+    # the allocating step of a deterministic sampler draws unused noise, which shifts the
+    # noise of the given objects: completion only compares the stochastic ones
+    ({"type": "ddpm", "num_steps": 10}, True),
+    ({"type": "ddim", "num_steps": 10, "eta": 1.}, True),
+])
+def test_inplace_loop_matches_the_allocating_one(diffusion, random_conditions, point_shape, sampler_config, completion):
+    torch.manual_seed(0)
+    batch_size = 2
+    shape = (batch_size,) + point_shape
+    condition, condition_cross = random_conditions(batch_size)
+    known_boxes = torch.rand(batch_size, 3, point_shape[1]) * 2 - 1 if completion else None
+
+    samples = []
+    for inplace in [False, True]:
+        sampler = sampler_factory(diffusion.diffusion, sampler_config)
+        torch.manual_seed(1)
+        with torch.no_grad():
+            samples.append(diffusion.diffusion.sample_loop(diffusion._denoise, shape, "cpu", condition, condition_cross,
+                                                           sampler=sampler, known_boxes=known_boxes, inplace=inplace))
+    assert torch.allclose(samples[0], samples[1], atol=1e-5), (samples[0] - samples[1]).abs().max()
+
+
+def translation_angle_denoiser(x, t, condition, condition_cross):
+    """Stand-in denoiser of the rearrangement samples, which only carry translations and angles."""
+    return torch.tanh(x)
+
+
+def test_early_exit_on_rearrangement(diffusion, point_shape):
+    torch.manual_seed(0)
+    batch_size = 3
+    shape = (batch_size,) + point_shape
+    gaussian_diffusion = diffusion.diffusion
+    input_boxes = torch.rand(shape) * 2 - 1
+    # a tolerance no prediction exceeds: every sample leaves the batch after window steps
+    sampler = sampler_factory(gaussian_diffusion, {"type": "ddim", "num_steps": 10,
+                                                   "early_exit": {"tolerance": 1e3, "window": 2}})
+
+    with torch.no_grad():
+        samples = gaussian_diffusion.p_sample_loop_arrange(translation_angle_denoiser, shape, "cpu", None, None,
+                                                           input_boxes=input_boxes, sampler=sampler)
+
+    assert samples.shape == shape
+    assert torch.isfinite(samples).all()
+    # the sizes and the other attributes are the given ones
+    size = slice(gaussian_diffusion.translation_dim, gaussian_diffusion.translation_dim + gaussian_diffusion.size_dim)
+    assert torch.equal(samples[:, :, size], input_boxes[:, :, size])
+    assert torch.equal(samples[:, :, gaussian_diffusion.bbox_dim:], input_boxes[:, :, gaussian_diffusion.bbox_dim:])
+    assert bool((sampler.early_exit.steps_saved > 0).all())
+
+
+def test_masked_prompt_batch_matches_each_prompt_alone(diffusion, random_conditions, point_shape):
+    torch.manual_seed(0)
+    lengths = [3, 7, 5]
+    batch_size = len(lengths)
+    shape = (batch_size,) + point_shape
+    # prompts of different lengths padded into one batch, with the mask of their valid tokens
+    condition, condition_cross = random_conditions(batch_size, num_tokens=max(lengths))
+    context_mask = torch.arange(max(lengths))[None, :] < torch.tensor(lengths)[:, None]
+    x_T = torch.randn(shape)
+    t = torch.randint(0, diffusion.diffusion.num_timesteps, size=(batch_size,))
+    sampler = sampler_factory(diffusion.diffusion, {"type": "ddim", "num_steps": 10})
+
+    with torch.no_grad():
+        out = diffusion._denoise(x_T, t, condition, condition_cross, context_mask=context_mask)
+        samples = diffusion.gen_samples(shape, "cpu", condition=condition, condition_cross=condition_cross,
+                                        sampler=sampler, context_mask=context_mask,
+                                        noise_fn=lambda size, dtype, device: x_T.clone())
+        for i, length in enumerate(lengths):
+            prompt = condition_cross[i:i + 1, :length]
+            out_alone = diffusion._denoise(x_T[i:i + 1], t[i:i + 1], condition[i:i + 1], prompt)
+            assert torch.allclose(out[i], out_alone[0], atol=1e-5), (out[i] - out_alone[0]).abs().max()
+            alone = diffusion.gen_samples((1,) + point_shape, "cpu", condition=condition[i:i + 1], condition_cross=prompt,
+                                          sampler=sampler, noise_fn=lambda size, dtype, device: x_T[i:i + 1].clone())
+            assert torch.allclose(samples[i], alone[0], atol=1e-4), (samples[i] - alone[0]).abs().max()
+
+
+def test_distillation_grids_nest(diffusion):
+    gaussian_diffusion = diffusion.diffusion
+    teacher_timesteps = sampler_factory(gaussian_diffusion, {
+        "type": "ddim", "timesteps": range(gaussian_diffusion.num_timesteps)}).timesteps()
+    while len(teacher_timesteps) > 1:
+        grid = distillation_grid(teacher_timesteps)
+        teacher_times = set(t for t, _ in teacher_timesteps) | {-1}
+        # every student step is two teacher steps, the last one of an odd teacher aside
+        assert len(grid) == (len(teacher_timesteps) + 1) // 2
+        assert set(grid.flatten().tolist()) <= teacher_times
+        assert bool((grid[:-1, 0] > grid[:-1, 1]).all()) and bool((grid[:-1, 1] > grid[:-1, 2]).all())
+        assert grid[-1, 2] == -1
+        student = sampler_factory(gaussian_diffusion, {
+            "type": "ddim", "num_steps": len(grid), "timesteps": grid[:, 0].tolist()})
+        teacher_timesteps = student.timesteps()
+        assert teacher_timesteps == [(t, t_next) for t, _, t_next in grid.tolist()]
+
+
+def test_converged_samples_leave_the_loop_state(diffusion, random_conditions, point_shape):
+    torch.manual_seed(0)
+    batch_size = 3
+    shape = (batch_size,) + point_shape
+    gaussian_diffusion = diffusion.diffusion
+    condition, condition_cross = random_conditions(batch_size)
+    sampler = sampler_factory(gaussian_diffusion, {"type": "ddim", "num_steps": 10,
+                                                   "early_exit": {"tolerance": 1e-3, "window": 1}})
+    sampler.early_exit.reset(gaussian_diffusion, shape, 10, "cpu")
+    state = _SampleLoopState(torch.randn(shape), condition, condition_cross, None, None, pred_x0=True)
+    samples = torch.zeros(shape)
+
+    # the first prediction of every sample only starts its window
+    state.pred_x0.copy_(torch.randn(shape))
+    assert not gaussian_diffusion._exit_converged(sampler, None, state, samples)
+    # the prediction of the second sample is stable over the window, it leaves the batch with it
+    pred_x0 = state.pred_x0.clone()
+    state.pred_x0[[0, 2]] += 1.
+    assert not gaussian_diffusion._exit_converged(sampler, None, state, samples)
+    assert torch.equal(samples[1], pred_x0[1])
+    assert sampler.early_exit.active.tolist() == [0, 2]
+    assert state.img_t.shape[0] == state.pred_x0.shape[0] == 2
+    assert torch.equal(state.condition, condition[[0, 2]])
+    assert torch.equal(state.condition_cross, condition_cross[[0, 2]])
+
+
+@pytest.mark.parametrize("objectness_dim", [0, 1])
+def test_pruned_slots_follow_the_empty_channel(diffusion, objectness_dim):
+    gaussian_diffusion = copy.copy(diffusion.diffusion)
+    gaussian_diffusion.objectness_dim = objectness_dim
+    empty_class = gaussian_diffusion.bbox_dim + gaussian_diffusion.class_dim - 1
+    shape = (1, 4, empty_class + 1 + objectness_dim)
+    # slot 1 is empty by the empty channel, slot 2 only by the empty class
+    pred_x0 = torch.full(shape, -1.)
+    pred_x0[0, 2, empty_class] = 1.
+    if objectness_dim > 0:
+        pred_x0[..., empty_class + 1] = 1.
+        pred_x0[0, 1, empty_class + 1] = -1.
+    else:
+        pred_x0[0, 1, empty_class] = 1.
+    pruner = sampler_factory(gaussian_diffusion, {"type": "ddpm", "prune_empty": {"threshold": 0.5, "window": 1}}).prune_empty
+    pruner.reset(gaussian_diffusion, shape, 0, "cpu")
+
+    assert pruner.update(pred_x0)
+    expected = [False, True, objectness_dim == 0, False]
+    assert pruner.frozen[0].tolist() == expected
+    assert (gaussian_diffusion.emptiness(pred_x0)[0] >= 0).tolist() == expected
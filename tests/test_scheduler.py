@@ -0,0 +1,80 @@
+import torch
+
+from scene_synthesis.networks.samplers import sampler_factory
+from scene_synthesis.networks.scheduler import ContinuousBatchScheduler, GenerationJob
+
+
+def test_continuous_batch_matches_the_sampling_loop_of_each_job(diffusion, random_conditions, point_shape):
+    torch.manual_seed(0)
+    # more jobs than slots, with their own step counts and prompt lengths
+    lengths = [3, 7, 5, 7, 4]
+    steps = [10, 4, 7, 10, 5]
+    num_jobs = len(lengths)
+    condition, condition_cross = random_conditions(num_jobs, num_tokens=max(lengths))
+    x_T = torch.randn((num_jobs,) + point_shape)
+    jobs = [GenerationJob(condition[i], condition_cross[i, :lengths[i]], {"type": "ddim", "num_steps": steps[i]},
+                          x_T=x_T[i], job_id=i) for i in range(num_jobs)]
+
+    scheduler = ContinuousBatchScheduler(diffusion.diffusion, diffusion._denoise, point_shape, max_batch_size=3)
+    for job in jobs:
+        scheduler.submit(job)
+    with torch.no_grad():
+        finished = scheduler.run()
+    assert sorted(job.job_id for job in finished) == list(range(num_jobs))
+    # fewer denoiser calls than jobs run one after the other
+    assert scheduler.denoiser_calls < sum(steps)
+
+    for job in jobs:
+        sampler = sampler_factory(diffusion.diffusion, job.sampler)
+        with torch.no_grad():
+            expected = diffusion.gen_samples((1,) + point_shape, "cpu", condition=job.condition[None],
+                                             condition_cross=job.condition_cross[None], sampler=sampler,
+                                             noise_fn=lambda size, dtype, device: job.x_T[None].clone())
+        assert torch.allclose(job.result, expected[0], atol=1e-4), (job.result - expected[0]).abs().max()
+
+
+def test_jobs_with_other_conditions_get_their_own_denoiser_call(diffusion, point_shape):
+    torch.manual_seed(0)
+    calls = []
+
+    def denoise_fn(x, t, condition, condition_cross, context_mask=None):
+        # a stand-in denoiser that depends on both conditions, recording their batched shapes
+        calls.append((None if condition is None else tuple(condition.shape),
+                      None if condition_cross is None else tuple(condition_cross.shape)))
+        out = torch.tanh(x)
+        if condition is not None:
+            out = out + condition.mean(dim=(1, 2))[:, None, None]
+        if condition_cross is not None and condition_cross.dim() == 2:
+            out = out + condition_cross.mean(dim=1)[:, None, None]
+        elif condition_cross is not None:
+            # the mean of the valid tokens only
+            mask = context_mask if context_mask is not None else torch.ones(condition_cross.shape[:2], dtype=torch.bool)
+            mean = (condition_cross * mask[..., None]).sum(dim=(1, 2)) / (mask.sum(dim=1) * condition_cross.shape[-1])
+            out = out + mean[:, None, None]
+        return out
+
+    sampler = {"type": "ddim", "num_steps": 5}
+    jobs = [
+        GenerationJob(torch.randn(8, 16), torch.randn(3, 16), sampler),
+        GenerationJob(None, torch.randn(5, 16), sampler),
+        GenerationJob(torch.randn(8, 16), torch.randn(16), sampler),
+        GenerationJob(torch.randn(8, 16), torch.randn(4, 16), sampler),
+        GenerationJob(torch.randn(8, 16), None, sampler),
+    ]
+    for i, job in enumerate(jobs):
+        job.x_T, job.job_id = torch.randn(point_shape), i
+
+    scheduler = ContinuousBatchScheduler(diffusion.diffusion, denoise_fn, point_shape, max_batch_size=len(jobs))
+    for job in jobs:
+        scheduler.submit(job)
+    finished = scheduler.run()
+    assert sorted(job.job_id for job in finished) == list(range(len(jobs)))
+    # the two token prompts share their calls, every other job has its own
+    assert scheduler.denoiser_calls == 4 * 5
+    assert set(calls) == {((2, 8, 16), (2, 4, 16)), (None, (1, 5, 16)), ((1, 8, 16), (1, 16)), ((1, 8, 16), None)}
+
+    for job in jobs:
+        alone = ContinuousBatchScheduler(diffusion.diffusion, denoise_fn, point_shape)
+        alone.submit(GenerationJob(job.condition, job.condition_cross, sampler, x_T=job.x_T))
+        expected = alone.run()[0].result
+        assert torch.allclose(job.result, expected, atol=1e-5), (job.result - expected).abs().max()